@@ -19,6 +19,26 @@ SSL = False
 THREADED = True
 """is the web server in threaded mode"""
 
+# the runner's log (jperswordoutlog) is written by a background thread, from a queue.  Messages below LOG_LEVEL are
+# not even formatted
+LOG_LEVEL = "INFO"
+"""level of the messages to log: DEBUG, INFO, WARNING or ERROR"""
+
+LOG_FORMAT = "json"
+"""format of the log: "json" for one JSON object per line, with the account, notification and stage of the deposit each message concerns, or "text" for the plain format"""
+
+# read-only status server, run in the background of the runner (or supervisor) on PORT: /status gives the deposits
+# in flight, pass progress, backlogs, cache hit rates, queue depths and stage latencies as JSON, and /metrics the
+# same figures for Prometheus.  It reads only the state held in memory, so makes no requests to the index
+STATUS_ENABLE = True
+"""whether to run the status server"""
+
+STATUS_HOST = "127.0.0.1"
+"""interface for the status server to listen on"""
+
+STATUS_REPORT_INTERVAL = 5
+"""when the status server is running, how often worker processes report their state to the supervisor, in seconds"""
+
 ############################################
 # important overrides for the ES module
 
@@ -73,6 +93,31 @@ STORE_LOCAL_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store
 STORE_TMP_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store", "tmp")
 """path to local directory for temp file store - specified relative to this file"""
 
+SPOOL_CONTENT_THRESHOLD = 10 * 1024 * 1024
+"""packages up to this many bytes are held in memory on their way from JPER to the repository; larger ones are downloaded to a partial file in STORE_TMP_DIR/partial, which a later attempt can resume if the download fails part way.  0 to always use a partial file"""
+
+# housekeeping of the temp store (see service/tmpstore.py)
+TMP_STORE_MAX_AGE = 21600
+"""entries in the temp store which have not been modified for this many seconds are removed by the sweeper"""
+
+TMP_STORE_SWEEP_INTERVAL = 3600
+"""how often the temp store is swept, in seconds (it is also swept when the runner starts)"""
+
+TMP_STORE_QUOTA = 20 * 1024 * 1024 * 1024
+"""maximum total size of the temp store in bytes; None for no limit"""
+
+TMP_STORE_MIN_FREE = 2 * 1024 * 1024 * 1024
+"""bytes to leave free on the disk holding the temp store; None for no limit"""
+
+TMP_STORE_WAIT = 300
+"""how long a download waits for room in the temp store before the pass is cancelled, in seconds"""
+
+TMP_STORE_USAGE_TTL = 10
+"""how long the measured size of the temp store is relied on before it is measured again, in seconds (each sweep measures it afresh).  0 to measure it every time"""
+
+DEPOSIT_JOURNAL_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store", "journal")
+"""directory of the journal of deposits in flight (see service/journal.py), so that a deposit interrupted by a restart is reconciled with the repository rather than made again.  Not in the temp store, as it must outlive the sweeps.  None to disable"""
+
 
 #############################################
 # Re-try/back-off settings
@@ -104,9 +149,122 @@ DEFAULT_SINCE_DATE = "1970-01-01T00:00:00Z"
 RUN_THROTTLE = 2
 """delay between executions of the deposit script, in seconds"""
 
+# number of worker processes to run the deposit cycle in.  Each worker is responsible for a hash-partition
+# of the account ids.  Can also be set with the --workers option of service/runner.py
+WORKERS = 1
+"""number of worker processes; 1 means the deposit cycle runs in the runner process itself"""
+
+WORKER_RESTART_DELAY = 10
+"""delay before restarting a worker process which has exited, in seconds"""
+
+METRICS_REPORT_INTERVAL = 60
+"""how often worker processes report their metrics to the supervisor, and the supervisor logs them, in seconds"""
+
+# each successful deposit records how long after its creation the notification was delivered, in a histogram with
+# these buckets (in seconds), globally and per account; see /metrics on the status server
+DEPOSIT_LAG_BUCKETS = [60, 300, 900, 1800, 3600, 7200, 14400, 43200, 86400, 172800, 604800]
+"""upper bounds of the deposit lag histogram buckets, in seconds; needs a restart to change"""
+
+# on SIGTERM or SIGINT, the runner (and each worker) stops scheduling new notifications and lets the one in hand
+# finish.  After the grace period, a content download still in progress is abandoned.  The stopwaitsecs in
+# deployment/sword-out.conf must allow for this plus SWORD_TIMEOUT
+SHUTDOWN_GRACE_PERIOD = 300
+"""time allowed for the deposit in hand to finish after the process is asked to stop, in seconds"""
+
+# on-demand profiling (see service/profiling.py): SIGUSR1 profiles the next passes with cProfile and a stack sampler,
+# and SIGUSR2 dumps the stacks of all threads and the top memory allocations.  Nothing runs until a signal is sent
+PROFILE_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store", "profiles")
+"""directory the profiles and stack dumps are written to"""
+
+PROFILE_PASSES = 1
+"""number of passes to profile after SIGUSR1"""
+
+PROFILE_SAMPLE_INTERVAL = 0.01
+"""interval between samples of the stack of a profiled pass, for the collapsed stack file, in seconds"""
+
+PROFILE_MEMORY_TOP = 25
+"""number of lines of code holding the most memory to list in a stack dump"""
+
+# bounds on the time taken by a deposit pass.  When the pass deadline is reached, the pass stops at the next clean
+# boundary (between accounts, between notifications, or part way through a content download) with its progress
+# saved, and the next pass carries on from there
+PASS_DEADLINE = 3600
+"""maximum time to spend on a single deposit pass, in seconds; None or 0 for no limit"""
+
+DOWNLOAD_TIMEOUT = 600
+"""maximum time to spend downloading the content of a single notification from JPER, in seconds"""
+
+SWORD_TIMEOUT = 120
+"""timeout for connecting to a repository, and for each read of its response, in seconds"""
+
+# at the end of each pass, a summary of it (duration, accounts and notifications processed, bytes transferred,
+# requests made to the index, JPER and the repositories, and the slowest accounts) is written to the
+# sword_pass_summary type in a single request, so that the throughput can be followed over weeks
+PASS_SUMMARY_ENABLE = True
+"""write a summary of each pass to the index"""
+
+PASS_SUMMARY_SLOWEST_ACCOUNTS = 5
+"""number of the slowest accounts to list in each pass summary"""
+
+# watchdog for stuck deposits (see service/watchdog.py): a deposit which has spent longer in its current stage than
+# the budget for that stage is logged with its stack and counted in watchdog_stalls, and if WATCHDOG_ABORT is set its
+# request to the repository (or its content download) is aborted, so that it fails and is retried by a later pass
+WATCHDOG_ENABLE = True
+"""run the watchdog thread; needs a restart to change"""
+
+WATCHDOG_INTERVAL = 10
+"""how often the watchdog checks the deposits in flight, in seconds"""
+
+WATCHDOG_ABORT = True
+"""abort a deposit which has overrun the budget for its stage, rather than only logging it"""
+
+WATCHDOG_STAGE_BUDGETS = {
+    "download": 900,
+    "create": 1800,
+    "receipt": 300,
+    "update": 1800,
+    "complete": 300,
+    "es": 120
+}
+"""time allowed for each stage of a deposit, in seconds; a stage which is not listed (or is None) has no limit"""
+
 # whether to store sword response data (receipt, etc).  Recommend only to store during testing operation
 STORE_RESPONSE_DATA = False
 """Whether to store response data or not - set to True if testing"""
 
+XWALK_ENGINE = "dom"
+"""how the atom entry for a metadata deposit is built: "dom" with the sword client's Entry, or "stream" with the streaming serialiser in service/xwalk_stream.py, which produces the same XML faster and in less memory"""
+
+XWALK_CACHE_SIZE = 500
+"""number of crosswalked notifications to keep, so that a notification going to several repositories is only crosswalked once; 0 to disable"""
+
+EPRINTS_SEND_XML_FILE = True
+"""whether deposits to EPrints repositories also add the atom entry to the item as a file (sword.xml), as well as creating the item from it"""
+
 # How many deposit attempts to be made in total
 MAX_DEPOSIT_ATTEMPTS = 10
+
+# fair-share scheduling: each repository gets a quota per pass, so that one large backlog (e.g. after
+# re-activation) is drained over several passes instead of holding up every other repository
+ACCOUNT_PASS_DEPOSIT_QUOTA = 200
+"""maximum number of notifications deposited to one repository in a single pass; the rest of its backlog is resumed on the next pass. 0 for no limit"""
+
+ACCOUNT_PASS_TIME_QUOTA = 300
+"""maximum time spent on one repository in a single pass, in seconds. 0 for no limit"""
+
+ACCOUNT_QUOTA_WEIGHTS = {}
+"""per-account multipliers of the pass quotas, keyed by account id; accounts not listed have a weight of 1"""
+
+# filter of the notifications already deposited to each repository, so that the deposit record only needs to be
+# looked up for notifications which may have been deposited before
+DEPOSIT_FILTER_ENABLE = True
+"""whether to use the per-account deposit filter"""
+
+DEPOSIT_FILTER_AUTHORITATIVE = False
+"""if True, a notification in the filter is taken as deposited without checking its deposit record.  There is a small (DEPOSIT_FILTER_ERROR_RATE) chance of wrongly skipping a notification"""
+
+DEPOSIT_FILTER_CAPACITY = 50000
+"""minimum number of notification ids each filter is sized for; filters are rebuilt larger when they fill up"""
+
+DEPOSIT_FILTER_ERROR_RATE = 0.01
+"""false positive rate of the deposit filters"""
@@ -0,0 +1,214 @@
+"""
+Registry of repository adapters, which capture how the deposit has to be adjusted for particular repository
+software.
+
+Each adapter declares:
+
+* which accounts it applies to (by repository software or package format)
+* the round trips it makes for a deposit (see RepositoryAdapter.sequence)
+* how the packaging identifier is presented to the repository
+* the error documents it knows how to classify (see classify_error)
+
+The adapter for an account is chosen once, when its DepositPlan is made.  Software specific adapters are consulted
+in the order they were registered, before the packaging specific ones, and RepositoryAdapter is used for everything
+else.
+"""
+from octopus.core import app
+
+_registry = []
+
+# the steps of a deposit, as listed by RepositoryAdapter.sequence
+CREATE_PACKAGE = "create_package"
+"""create the item from the package, in a single request ('single zip file' deposits)"""
+
+CREATE = "create"
+"""create the item from the atom entry"""
+
+RECEIPT = "receipt"
+"""retrieve the deposit receipt, if the response to the create request did not include it"""
+
+XML_FILE = "xml_file"
+"""add the atom entry to the item as a file"""
+
+PACKAGE = "package"
+"""deposit the package to the item"""
+
+COMPLETE = "complete"
+"""tell the repository that the deposit is complete"""
+
+
+def register(adapter):
+    """
+    Add an adapter class to the registry
+
+    :param adapter: RepositoryAdapter subclass
+    :return: the adapter class, so that this can be used as a class decorator
+    """
+    _registry.append(adapter)
+    return adapter
+
+
+def for_account(acc):
+    """
+    Choose the adapter for an account
+
+    :param acc: the account (or a view of it)
+    :return: an instance of the first registered adapter which matches the account, or of RepositoryAdapter
+    """
+    packaging = acc.packaging[-1] if acc.packaging else None
+    for adapter in sorted(_registry, key=lambda a: not a.software):
+        if adapter.matches(acc.repository_software, packaging):
+            return adapter()
+    return RepositoryAdapter()
+
+
+def classify_error(error_document):
+    """
+    Classify an error document returned by a repository, for the failures which retrying cannot fix.
+
+    An error document identifies the repository itself in its error_href, so every registered adapter's error
+    classes are consulted, whichever adapter the account uses
+
+    :param error_document: sword2 Error_Document
+    :return: the metadata status for the failure (e.g. "invalidxml"), or None if it is not one of these
+    """
+    # safety check, e.g. if the code is 500 (INTERNAL SERVER ERROR), then error_href is None
+    href = error_document.error_href
+    if href is None:
+        return None
+    for adapter in _registry:
+        for needles, status in adapter.error_classes:
+            if all(n in href for n in needles):
+                return status
+    return None
+
+
+class RepositoryAdapter(object):
+    """
+    The standard SWORDv2 deposit, and the base class for the adapters
+    """
+    name = "sword"
+
+    software = None
+    """repository software this adapter is for, if it is chosen by software"""
+
+    packaging_marker = None
+    """lower case string which identifies the packaging of the repositories this adapter is for, if it is chosen by
+    packaging"""
+
+    in_progress_only = False
+    """whether the item must be left in progress, as the repository cannot handle the complete request"""
+
+    add_package_as_file = False
+    """whether the package is added as a file to the item's media resource, rather than replacing its files"""
+
+    error_classes = []
+    """list of (substrings of the error_href, metadata status) which classify the repository's error documents"""
+
+    @classmethod
+    def matches(cls, software, packaging):
+        """
+        Does this adapter apply to a repository
+
+        :param software: the account's repository software
+        :param packaging: the package format the account's deposits use
+        :return: True if it does
+        """
+        if cls.software is not None:
+            return software == cls.software
+        if cls.packaging_marker is not None:
+            return cls.packaging_marker in str(packaging).lower()
+        return False
+
+    def map_packaging(self, packaging):
+        """
+        The packaging identifier to send with a single zip file deposit
+
+        :param packaging: the package format
+        :return: the identifier
+        """
+        return packaging
+
+    @property
+    def send_xml_file(self):
+        """
+        Whether the atom entry is also added to the item as a file
+        """
+        return False
+
+    def sequence(self, deposit_method, has_content):
+        """
+        The round trips to the repository for a deposit
+
+        :param deposit_method: "single zip file" or "individual files"
+        :param has_content: whether there is a package to deposit
+        :return: tuple of steps
+        """
+        if deposit_method == "single zip file":
+            return (CREATE_PACKAGE,) if has_content else ()
+        steps = [CREATE]
+        # the receipt is needed for the requests which follow the create request, but not otherwise
+        if has_content or self.send_xml_file:
+            steps.append(RECEIPT)
+        if self.send_xml_file:
+            steps.append(XML_FILE)
+        if has_content:
+            steps.append(PACKAGE)
+            if not self.in_progress_only:
+                steps.append(COMPLETE)
+        return tuple(steps)
+
+    def classify_error(self, error_document):
+        """
+        Classify an error document from the repository (see classify_error)
+        """
+        return classify_error(error_document)
+
+    def __repr__(self):
+        return "<{x}>".format(x=type(self).__name__)
+
+
+@register
+class EPrintsAdapter(RepositoryAdapter):
+    """
+    EPrints doesn't allow "complete" requests, so everything is left in progress for consistency, and the package is
+    added as a file to the resource.  The atom entry is also sent as a file, unless EPRINTS_SEND_XML_FILE is off
+    """
+    name = "eprints"
+    software = "eprints"
+    in_progress_only = True
+    add_package_as_file = True
+
+    @property
+    def send_xml_file(self):
+        return app.config.get("EPRINTS_SEND_XML_FILE", True)
+
+
+@register
+class OPUS4Adapter(RepositoryAdapter):
+    """
+    OPUS4 rejects any explicit packaging identifier, and reports metadata it cannot use, or a package it will not
+    accept, with an error document which retrying cannot fix
+    """
+    name = "opus4"
+    packaging_marker = "opus4"
+    error_classes = [
+        (("opus-repository", "InvalidXml"), "invalidxml"),
+        # (note the typo here in OPUS4 ...)
+        (("opus-repository", "PayloadToLarge"), "payloadtoolarge")
+    ]
+
+    def map_packaging(self, packaging):
+        return None
+
+
+@register
+class EScidocAdapter(RepositoryAdapter):
+    """
+    eSciDoc (Pubman) expects its own packaging identifier
+    """
+    name = "escidoc"
+    packaging_marker = "escidoc"
+
+    def map_packaging(self, packaging):
+        return "http://purl.org/escidoc/metadata/schemas/0.1/publication"
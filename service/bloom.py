@@ -0,0 +1,95 @@
+"""
+A simple Bloom filter, which can be serialised to a string for storage in the index.
+
+A Bloom filter answers "have I seen this key" with no false negatives and a tunable rate of false positives, in a
+fixed and small amount of memory.
+"""
+import base64, hashlib, math
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over string keys, using double hashing of an md5 digest to derive the bit positions
+    """
+
+    def __init__(self, size, hashes, bits=None, count=0):
+        """
+        :param size: number of bits in the filter
+        :param hashes: number of bit positions set for each key
+        :param bits: existing bit array (bytes-like) to load, if any
+        :param count: number of keys already added to the existing bit array
+        """
+        self.size = size
+        self.hashes = hashes
+        self.count = count
+        nbytes = (size + 7) // 8
+        if bits is None:
+            self.bits = bytearray(nbytes)
+        else:
+            if len(bits) != nbytes:
+                raise ValueError("Bit array is {x} bytes, but a filter of {y} bits needs {z}".format(
+                    x=len(bits), y=size, z=nbytes))
+            self.bits = bytearray(bits)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """
+        Create an empty filter sized to hold the given number of keys with the given false positive rate
+
+        :param capacity: expected number of keys
+        :param error_rate: acceptable false positive rate, between 0 and 1
+        :return: BloomFilter
+        """
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Add a key to the filter.  The count only goes up for a key which was not already in the filter
+
+        :param key: the key
+        :return: True if the key was not already in the filter
+        """
+        added = False
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def encode(self):
+        """
+        Serialise the bit array
+
+        :return: base64 encoded string of the bit array
+        """
+        return base64.b64encode(bytes(self.bits)).decode("ascii")
+
+    @classmethod
+    def decode(cls, size, hashes, encoded, count=0):
+        """
+        Load a filter from a bit array serialised with encode()
+
+        :param size: number of bits in the filter
+        :param hashes: number of bit positions per key
+        :param encoded: base64 encoded bit array
+        :param count: number of keys in the filter
+        :return: BloomFilter
+        """
+        return cls(size, hashes, bits=base64.b64decode(encoded), count=count)
@@ -0,0 +1,100 @@
+"""
+Deadline and cooperative cancellation for a deposit pass.
+
+A CancellationToken is created at the start of each pass and handed down through process_account and
+process_notification.  The stages check it only at clean boundaries (between accounts, between notifications and
+between the chunks of a content download), so that when the pass deadline passes, or the pass is cancelled, the
+work in hand stops with the progress so far saved, and the remainder is picked up by the next pass.
+
+A token can also be drained (see service.lifecycle), which stops the pass at its next boundary between accounts or
+notifications in the same way, but lets the notification in hand run to the end.
+"""
+import threading, time
+from octopus.core import app
+
+
+class Cancelled(Exception):
+    """
+    Raised by CancellationToken.check once the pass has been cancelled or has passed its deadline
+    """
+    pass
+
+
+class CancellationToken(object):
+    """
+    Shared flag which tells the stages of a pass to stop at their next clean boundary
+    """
+
+    def __init__(self, seconds=None):
+        """
+        :param seconds: time allowed from now before the token is cancelled automatically; None or 0 for no deadline
+        """
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.reason = None
+        self._event = threading.Event()
+        self._draining = threading.Event()
+
+    @classmethod
+    def for_pass(cls):
+        """
+        Create the token for a deposit pass, with the PASS_DEADLINE from configuration
+
+        :return: CancellationToken
+        """
+        return cls(app.config.get("PASS_DEADLINE"))
+
+    def cancel(self, reason="cancelled"):
+        """
+        Cancel the token explicitly
+
+        :param reason: description of why, used in the log and in the Cancelled exception
+        """
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def drain(self, reason="draining"):
+        """
+        Stop the pass at its next boundary between accounts or notifications, but not part way through a
+        notification: check() does not raise for a drained token, unless it is also cancelled
+
+        :param reason: description of why, used in the log
+        """
+        if not self._event.is_set() and not self._draining.is_set():
+            self.reason = reason
+        self._draining.set()
+
+    @property
+    def draining(self):
+        return self._draining.is_set()
+
+    @property
+    def cancelled(self):
+        return self._draining.is_set() or self._expired()
+
+    def _expired(self):
+        if self._event.is_set():
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("pass deadline reached")
+            return True
+        return False
+
+    def remaining(self):
+        """
+        Time left before the deadline
+
+        :return: seconds remaining (0 once cancelled), or None if there is no deadline
+        """
+        if self._event.is_set():
+            return 0
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def check(self):
+        """
+        Raise Cancelled if the token has been cancelled or has passed its deadline
+        """
+        if self._expired():
+            raise Cancelled(self.reason)
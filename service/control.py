@@ -48,4 +48,33 @@ def deactivate_deposit(acc_id):
 
     # if there is, deactivate it
     rs.deactivate()
-    rs.save()
\ No newline at end of file
+    rs.save()
+
+def requeue_dead_letters(acc_id, notification_ids=None):
+    """
+    Take notifications out of the repository's dead letter store and queue them for deposit again.
+
+    Each one is queued as a request notification, which the next run deposits regardless of any previous
+    deposit attempts.
+
+    :param acc_id: account whose dead letters to requeue
+    :param notification_ids: the notifications to requeue; all of the account's dead letters if None
+    :return: the number of notifications requeued
+    """
+    if notification_ids is None:
+        dead_letters = list(models.DeadLetter.iterate_by_repository(acc_id))
+    else:
+        dead_letters = [models.DeadLetter.pull_by_ids(nid, acc_id) for nid in notification_ids]
+
+    count = 0
+    for dl in dead_letters:
+        if dl is None:
+            continue
+        rn = models.RequestNotification()
+        rn.account_id = acc_id
+        rn.notification_id = dl.notification
+        rn.status = "queued"
+        rn.save()
+        dl.delete()
+        count += 1
+    return count
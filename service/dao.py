@@ -8,16 +8,47 @@ query methods as required
 """
 
 from octopus.modules.es import dao
+from service import metrics
 
 
-class RepositoryStatusDAO(dao.ESDAO):
+class MeteredESDAO(dao.ESDAO):
+    """
+    ESDAO which counts the requests it makes to the index, as es_requests{op}, so that each pass can report them
+    (see models.PassSummary)
+    """
+
+    def save(self, *args, **kwargs):
+        metrics.incr("es_requests", op="save")
+        return super(MeteredESDAO, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        metrics.incr("es_requests", op="delete")
+        return super(MeteredESDAO, self).delete(*args, **kwargs)
+
+    @classmethod
+    def pull(cls, *args, **kwargs):
+        metrics.incr("es_requests", op="pull")
+        return super(MeteredESDAO, cls).pull(*args, **kwargs)
+
+    @classmethod
+    def query(cls, *args, **kwargs):
+        metrics.incr("es_requests", op="query")
+        return super(MeteredESDAO, cls).query(*args, **kwargs)
+
+    @classmethod
+    def scroll(cls, *args, **kwargs):
+        metrics.incr("es_requests", op="scroll")
+        return super(MeteredESDAO, cls).scroll(*args, **kwargs)
+
+
+class RepositoryStatusDAO(MeteredESDAO):
     """
     DAO for RepositoryStatus
     """
     __type__ = "sword_repository_status"
 
 
-class DepositRecordDAO(dao.ESDAO):
+class DepositRecordDAO(MeteredESDAO):
     """
     DAO for DepositRecord
     """
@@ -52,6 +83,20 @@ class DepositRecordDAO(dao.ESDAO):
         return total
 
 
+    @classmethod
+    def iterate_by_repository(cls, repository_id, since=None):
+        """
+        Iterate over all the deposit records for the repository_id, optionally only those updated since a given date
+
+        :param repository_id:
+        :param since: only records last updated on or after this date
+        :return: generator of deposit records
+        """
+        q = DepositRecordRepositoryQuery(repository_id, since)
+        for dr in cls.scroll(q=q.query()):
+            yield dr
+
+
 class DepositRecordQuery(object):
     """
     Query generator for retrieving deposit records by notification id and repository id
@@ -84,7 +129,165 @@ class DepositRecordQuery(object):
         }
 
 
-class AccountDAO(dao.ESDAO):
+class DeadLetterDAO(MeteredESDAO):
+    """
+    DAO for DeadLetter
+    """
+    __type__ = "sword_dead_letter"
+
+    @classmethod
+    def pull_by_ids(cls, notification_id, repository_id):
+        """
+        Get the dead letter entry for the notification_id and the repository_id, if there is one
+
+        :param notification_id:
+        :param repository_id:
+        :return:
+        """
+        return cls.pull(cls.make_id(notification_id, repository_id))
+
+    @classmethod
+    def make_id(cls, notification_id, repository_id):
+        """
+        The id of the dead letter entry for a notification and repository pair.  This is deterministic, so that a
+        pair can only be entered once
+
+        :param notification_id:
+        :param repository_id:
+        :return: the record id
+        """
+        return "{r}_{n}".format(r=repository_id, n=notification_id)
+
+    @classmethod
+    def iterate_by_repository(cls, repository_id):
+        """
+        Iterate over all the dead letter entries for a repository
+
+        :param repository_id:
+        :return: generator of the entries
+        """
+        q = DeadLetterQuery(repository_id)
+        for dl in cls.scroll(q=q.query()):
+            yield dl
+
+    @classmethod
+    def notification_ids_for(cls, repository_id):
+        """
+        Get the ids of all the notifications which are dead letters for the repository
+
+        :param repository_id:
+        :return: set of notification ids
+        """
+        return set([dl.notification for dl in cls.iterate_by_repository(repository_id)])
+
+
+class DeadLetterQuery(object):
+    """
+    Query generator for retrieving dead letter entries by repository id
+    """
+
+    def __init__(self, repository_id):
+        self.repository_id = repository_id
+
+    def query(self):
+        """
+        Return the query as a python dict suitable for json serialisation
+
+        :return: elasticsearch query
+        """
+        return {
+            "query": {
+                "bool": {
+                    "must": {
+                        "term": {"repo.exact": self.repository_id}
+                    }
+                }
+            }
+        }
+
+
+class DepositRecordRepositoryQuery(object):
+    """
+    Query generator for retrieving all the deposit records for a repository id, optionally since a given date
+    """
+
+    def __init__(self, repository_id, since=None):
+        self.repository_id = repository_id
+        self.since = since
+
+    def query(self):
+        """
+        Return the query as a python dict suitable for json serialisation
+
+        :return: elasticsearch query
+        """
+        q = {
+            "query": {
+                "bool": {
+                    "must": [
+                        {"term": {"repo.exact": self.repository_id}}
+                    ]
+                }
+            }
+        }
+        if self.since:
+            q["query"]["bool"]["must"].append({"range": {"last_updated": {"gte": self.since}}})
+        return q
+
+
+class DepositFilterDAO(MeteredESDAO):
+    """
+    DAO for DepositFilter
+    """
+    __type__ = "sword_deposit_filter"
+
+
+class PassSummaryDAO(MeteredESDAO):
+    """
+    DAO for PassSummary
+    """
+    __type__ = "sword_pass_summary"
+
+    @classmethod
+    def iterate_since(cls, since):
+        """
+        Iterate over the summaries of the passes started since a date, oldest first
+
+        :param since: date of the form YYYY-MM-DDTHH:MM:SSZ
+        :return: generator of the summaries
+        """
+        q = PassSummaryQuery(since)
+        for ps in cls.scroll(q=q.query()):
+            yield ps
+
+
+class PassSummaryQuery(object):
+    """
+    Query generator for retrieving the pass summaries since a given date
+    """
+
+    def __init__(self, since):
+        self.since = since
+
+    def query(self):
+        """
+        Return the query as a python dict suitable for json serialisation
+
+        :return: elasticsearch query
+        """
+        return {
+            "query": {
+                "bool": {
+                    "must": {
+                        "range": {"started": {"gte": self.since}}
+                    }
+                }
+            },
+            "sort": {"started": {"order": "asc"}}
+        }
+
+
+class AccountDAO(MeteredESDAO):
     """
     DAO for Account
     """
@@ -128,7 +331,7 @@ class SwordAccountQuery(object):
         }
 
 
-class RepositoryDepositLogDAO(dao.ESDAO):
+class RepositoryDepositLogDAO(MeteredESDAO):
     """
     DAO for RepositoryDepositLog
     """
@@ -175,7 +378,7 @@ class RepositoryDepositLogQuery(object):
         }
 
 
-class RequestNotification(dao.ESDAO):
+class RequestNotification(MeteredESDAO):
     """
     DAO for RequestNotification
     """
@@ -2,15 +2,21 @@
 Main workflow engine which carries out the mediation between JPER and the SWORD-enabled 
 repositories
 """
-import sword2, uuid
-from service import xwalk, models
+import sword2, uuid, time, os, hashlib, re, calendar, threading, contextlib
+from service import xwalk, models, metrics, scheduling, http_layer, tmpstore, deposit_plan, adapters, journal, logs, watchdog
+from service.cancellation import CancellationToken, Cancelled
+from service.deposit_filter import AccountDepositFilter
+from service.deposit_plan import DepositPlan
 from octopus.modules.store import store
 from octopus.modules.jper import client
 from octopus.modules.jper import models as jper_models
 from io import BytesIO, StringIO
-from octopus.modules.swordv2 import client_http
 from octopus.core import app
-from octopus.lib import dates
+from octopus.lib import dates, http
+
+
+CONTENT_CHUNK_SIZE = 8192
+"""size of the chunks in which resumed downloads are read"""
 
 
 class DepositException(Exception):
@@ -20,36 +26,258 @@ class DepositException(Exception):
     pass
 
 
-def run(fail_on_error=True):
+class MeteredJPER(client.JPER):
+    """
+    JPER client which counts the requests it makes, as jper_requests{op}, so that each pass can report them (see
+    models.PassSummary).  iterate_notifications makes its requests through list_notifications, so each page is counted
+    """
+
+    def list_notifications(self, *args, **kwargs):
+        metrics.incr("jper_requests", op="list")
+        return super(MeteredJPER, self).list_notifications(*args, **kwargs)
+
+    def get_notification(self, *args, **kwargs):
+        metrics.incr("jper_requests", op="notification")
+        return super(MeteredJPER, self).get_notification(*args, **kwargs)
+
+    def get_content(self, *args, **kwargs):
+        metrics.incr("jper_requests", op="content")
+        return super(MeteredJPER, self).get_content(*args, **kwargs)
+
+
+LINK_HEADER = re.compile(r'<([^>]*)>\s*;\s*rel="?([^";,]+)"?')
+"""a link in an HTTP Link header, as <iri>; rel="relation" """
+
+LINK_RELATIONS = {"edit-media": "edit_media", "http://purl.org/net/sword/terms/add": "se_iri", "edit": "edit"}
+"""deposit receipt fields which can be taken from the Link headers of the response to a create request"""
+
+
+class LazyReceipt(object):
+    """
+    The deposit receipt for a create request whose response did not include one.
+
+    It stands in for the sword client's Deposit_Receipt, taking what it can from the response's headers (the
+    Location, which is the Edit-IRI, and any Link headers), and only when a field is needed which they do not provide
+    is the receipt retrieved from the repository (GET on the Edit-IRI)
+    """
+    def __init__(self, receipt, conn, deposit_record):
+        """
+        :param receipt: the Deposit_Receipt the sword client made from the create response
+        :param conn: the connection to use to retrieve the full receipt
+        :param deposit_record: provenance object for recording actions during this deposit process
+        """
+        self._receipt = receipt
+        self._conn = conn
+        self._deposit_record = deposit_record
+        self._fetched = False
+        for h, v in (receipt.response_headers or {}).items():
+            if h.lower() != "link":
+                continue
+            for iri, rel in LINK_HEADER.findall(v):
+                field = LINK_RELATIONS.get(rel)
+                if field is not None and getattr(receipt, field, None) is None:
+                    setattr(receipt, field, iri)
+        # a receipt made from a response with no body has only the Location, which is the Edit-IRI
+        if receipt.edit is None:
+            receipt.edit = receipt.location
+
+    def require(self, *fields):
+        """
+        Make sure the receipt has the fields, retrieving the full receipt from the repository if not
+
+        :param fields: names of the Deposit_Receipt fields
+        :raises DepositException: if the receipt could not be retrieved
+        """
+        if self._fetched or all(getattr(self._receipt, f, None) is not None for f in fields):
+            return
+        self._fetched = True
+        try:
+            with metrics.stage("receipt"):
+                receipt = self._conn.get_deposit_receipt(self._receipt.edit)
+        except Exception as e:
+            msg = "There was an error attempting to retrieve deposit receipt in repository. {x}".format(x=str(e))
+            self._deposit_record.add_message('error', msg)
+            app.logger.error(msg)
+            raise DepositException(msg)
+        metrics.incr("deposit_receipts_fetched")
+        self._receipt = receipt
+
+    def known(self, field):
+        """
+        The value of a field as far as it is known, without retrieving the receipt
+
+        :param field: name of the Deposit_Receipt field
+        :return: the value, or None if it is not known
+        """
+        return getattr(self._receipt, field, None)
+
+    @property
+    def receipt(self):
+        """
+        The Deposit_Receipt as it stands, i.e. without retrieving any fields it does not have
+
+        :return: sword2.Deposit_Receipt
+        """
+        return self._receipt
+
+    def __getattr__(self, name):
+        # only called for the attributes not on the LazyReceipt itself, i.e. the receipt's fields
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if getattr(self._receipt, name, None) is None:
+            self.require(name)
+        return getattr(self._receipt, name)
+
+
+class _PassTally(object):
+    """
+    Collects the figures for the summary of a pass, from the process's counters and the time spent on each account,
+    and writes them to the index at the end of the pass as a single PassSummary
+    """
+
+    def __init__(self, accounts, partition=None):
+        self.accounts = accounts
+        self.partition = partition
+        self.cut_short = False
+        self.error = None
+        self.started = dates.now()
+        self._clock = time.monotonic()
+        self._counters = metrics.counters()
+        self._timings = []
+
+    @contextlib.contextmanager
+    def account(self, account_id):
+        """
+        Time the processing of an account, for the duration of the block
+        """
+        started = time.monotonic()
+        deposits = metrics.get("deposits")
+        try:
+            yield
+        finally:
+            self._timings.append((time.monotonic() - started, account_id, metrics.get("deposits") - deposits))
+
+    def summary(self):
+        """
+        The summary of the pass so far
+
+        :return: models.PassSummary
+        """
+        counts = metrics.delta(self._counters, metrics.counters())
+        slowest = sorted(self._timings, key=lambda t: t[0], reverse=True)
+        limit = app.config.get("PASS_SUMMARY_SLOWEST_ACCOUNTS", 5)
+        raw = {
+            "started": self.started,
+            "finished": dates.now(),
+            "duration": round(time.monotonic() - self._clock, 3),
+            "pid": os.getpid(),
+            "cut_short": self.cut_short,
+            "accounts": {
+                "total": self.accounts,
+                "visited": len(self._timings),
+                "skipped": counts.get("accounts_skipped", 0)
+            },
+            "notifications": {
+                "listed": counts.get("notifications_listed", 0),
+                "skipped": counts.get("notifications_skipped", 0),
+                "deposited": counts.get("deposits", 0),
+                "failed": counts.get("deposit_failures", 0)
+            },
+            "bytes": {
+                "downloaded": counts.get("content_bytes", 0),
+                "uploaded": counts.get("sword_bytes_sent", 0),
+                "received": counts.get("sword_bytes_received", 0)
+            },
+            "requests": {
+                "es": counts.get("es_requests", 0),
+                "jper": counts.get("jper_requests", 0),
+                "sword": counts.get("sword_requests", 0)
+            },
+            "slowest_accounts": [{"account": a, "seconds": round(s, 3), "deposits": d}
+                                 for s, a, d in slowest[:limit]]
+        }
+        if self.partition is not None:
+            raw["partition"] = str(self.partition)
+        if self.error is not None:
+            raw["error"] = self.error
+        return models.PassSummary(raw)
+
+    def save(self):
+        """
+        Write the summary of the pass to the index, if PASS_SUMMARY_ENABLE is set.  A failure to write it is logged,
+        but does not affect the pass
+        """
+        if not app.config.get("PASS_SUMMARY_ENABLE", True):
+            return
+        try:
+            self.summary().save()
+        except Exception as e:
+            app.logger.error("Unable to save the summary of the pass: {x}".format(x=str(e)))
+
+
+def run(fail_on_error=True, partition=None, token=None):
     """
     Execute a single pass on all the accounts that have sword activated and process all
     of their notifications since the last time their account was synchronised, until now
 
+    If the pass reaches its deadline (PASS_DEADLINE) or is cancelled, it stops at the next clean boundary, and
+    the next pass starts with the account it stopped at
+
     :param fail_on_error: cease execution if an exception is raised
+    :param partition: optional share of the account ids owned by this worker process (see service.supervisor);
+        accounts outside of it are left to the other workers
+    :param token: cancellation token for the pass; by default one with the configured PASS_DEADLINE
     """
     app.logger.info("Entering run")
+    if token is None:
+        token = CancellationToken.for_pass()
     # list all of the accounts that have sword activated
     accs = models.Account.with_sword_activated()
-
-    # process each account
-    for acc in accs:
-        try:
-            process_notification_requests(acc)
-        except client.JPERException as e:
-            app.logger.error(
-                "Problem while processing deposit requests for account for SWORD deposit: {x}".format(x=str(e)))
-            if fail_on_error:
-                raise e
-        try:
-            process_account(acc)
-        except client.JPERException as e:
-            app.logger.error("Problem while processing account for SWORD deposit: {x}".format(x=str(e)))
-            if fail_on_error:
-                raise e
+    if partition is not None:
+        accs = [acc for acc in accs if partition.owns(acc.id)]
+    accs = scheduling.rotate(accs)
+    deposit_plan.clear()
+    metrics.incr("passes")
+    metrics.incr("accounts", len(accs))
+    metrics.pass_progress(started=time.time(), finished=None, accounts=len(accs), accounts_done=0, account=None)
+    tally = _PassTally(len(accs), partition)
+
+    # process each account, from a read-only snapshot of its settings, with the journal listed once for the pass
+    try:
+        with journal.listing():
+            for done, acc in enumerate(accs):
+                acc = acc.view()
+                metrics.pass_progress(account=acc.id, accounts_done=done)
+                if token.cancelled:
+                    app.logger.info(logs.lazy("Stopping pass before Account:{x} - {y}", x=acc.id, y=token.reason))
+                    metrics.incr("passes_cut_short")
+                    scheduling.resume_at(acc.id)
+                    tally.cut_short = True
+                    break
+                with tally.account(acc.id):
+                    try:
+                        process_notification_requests(acc, token=token)
+                    except client.JPERException as e:
+                        app.logger.error("Problem while processing deposit requests for account for SWORD deposit: "
+                                         "{x}".format(x=str(e)))
+                        if fail_on_error:
+                            raise e
+                    try:
+                        process_account(acc, token=token)
+                    except client.JPERException as e:
+                        app.logger.error("Problem while processing account for SWORD deposit: {x}".format(x=str(e)))
+                        if fail_on_error:
+                            raise e
+    except Exception as e:
+        tally.error = str(e)
+        raise
+    finally:
+        tally.save()
+    metrics.pass_progress(finished=time.time(), account=None)
     app.logger.info("Leaving run")
 
 
-def process_account(acc):
+def process_account(acc, quota=None, token=None):
     """
     Retrieve the notifications in JPER associated with this account and relay them on 
     to their sword-enabled repository
@@ -59,10 +287,16 @@ def process_account(acc):
     If the account is in status "problem", and the retry delay has elapsed, it will 
     be re-tried, otherwise it will be skipped
 
+    If the account uses up its quota for this pass, or the pass is cancelled, the created date of the next
+    notification is recorded as the repository status' backlog_since, and the next pass resumes from there
+
     :param acc: the account whose notifications to process
+    :param quota: the account's share of this pass; by default taken from configuration
+    :param token: cancellation token for the pass, if any
     """
-    app.logger.info("Processing Account:{x}".format(x=acc.id))
-    j = client.JPER(api_key=acc.api_key)
+    app.logger.info(logs.lazy("Processing Account:{x}", x=acc.id))
+    acc = models.AccountView.of(acc)
+    j = MeteredJPER(api_key=acc.api_key)
     deposit_log = models.RepositoryDepositLog()
     deposit_log.repository = acc.id
 
@@ -72,23 +306,25 @@ def process_account(acc):
     # sword deposit, so we need to create one
     if repository_status is None:
         app.logger.debug(
-            "Account:{x} has not previously deposited - creating repository status record".format(x=acc.id))
+            logs.lazy("Account:{x} has not previously deposited - creating repository status record", x=acc.id))
         repository_status = create_repo_status(acc)
         deposit_log.add_message('debug', "First deposit for account {x}".format(x=acc.id), None, None)
-    app.logger.info("Status:{x}".format(x=repository_status.status))
+    app.logger.info(logs.lazy("Status:{x}", x=repository_status.status))
 
     # check to see if we should be continuing with this account (may be failing)
     if repository_status.status == "failing":
         app.logger.debug(
-            "Account:{x} is marked as failing - skipping.  You may need to manually reactivate this account".format(
+            logs.lazy("Account:{x} is marked as failing - skipping.  You may need to manually reactivate this account", 
                 x=acc.id))
+        metrics.incr("accounts_skipped", reason="failing")
         return
 
     # check to see if enough time has passed to warrant a re-try (if relevant)
     delay = app.config.get("LONG_CYCLE_RETRY_DELAY")
     if repository_status.status == "problem" and not repository_status.can_retry(delay):
         app.logger.debug(
-            "Account:{x} is experiencing problems, and retry delay has not yet elapsed - skipping".format(x=acc.id))
+            logs.lazy("Account:{x} is experiencing problems, and retry delay has not yet elapsed - skipping", x=acc.id))
+        metrics.incr("accounts_skipped", reason="retry_delay")
         return
 
     # Query JPER for the notifications for this account
@@ -102,9 +338,25 @@ def process_account(acc):
     delta_days = app.config.get("DEFAULT_SINCE_DELTA_DAYS")
     safe_since = dates.format(dates.parse(since) - dates.timedelta(days=delta_days))
 
+    # if the previous pass ran out of quota, carry on from where it stopped
+    if repository_status.backlog_since is not None:
+        safe_since = repository_status.backlog_since
+
+    if quota is None:
+        quota = scheduling.AccountQuota.for_account(acc.id)
+
+    # notifications which we have given up on are skipped before any further requests are made about them
+    dead_letters = models.DeadLetter.notification_ids_for(acc.id)
+
+    # filter of the notifications already deposited, to save asking the index about the ones which are not
+    deposit_filter = None
+    if app.config.get("DEPOSIT_FILTER_ENABLE", False):
+        deposit_filter = AccountDepositFilter.load(acc.id)
+
     # Find notifications for deposit
     deposit_log.add_message('info', "Finding updated notifications since {x}".format(x=safe_since), None, None)
     deposit_done_count = 0
+    deferred = False
     # The repository status is recorded after each notification.
     # If any one notification has an error, no further deposits are made,
     # if the notification fails due to a non-specific error, what should the status and last deposit date be?
@@ -114,15 +366,42 @@ def process_account(acc):
         for note in j.iterate_notifications(safe_since, repository_id=acc.id):
             if not note:
                 continue
+            metrics.incr("notifications_listed")
+            if note.id in dead_letters:
+                metrics.incr("dead_letter_skips")
+                metrics.incr("notifications_skipped", reason="dead_letter")
+                continue
+            if token is not None and token.cancelled:
+                _defer_backlog(acc, note, repository_status, deposit_log, token.reason)
+                deferred = True
+                break
+            if quota.exhausted():
+                # leave the rest of the backlog for the next pass, so that other accounts get their turn
+                _defer_backlog(acc, note, repository_status, deposit_log, "quota for this pass used up")
+                deferred = True
+                break
             check_deposit_record = True
-            status, repository_status, deposit_log, deposit_done_count = attempt_deposit(acc, note,
-                                                                                         check_deposit_record,
-                                                                                         repository_status,
-                                                                                         deposit_log,
-                                                                                         deposit_done_count)
+            done_before = deposit_done_count
+            try:
+                status, repository_status, deposit_log, deposit_done_count = attempt_deposit(acc, note,
+                                                                                             check_deposit_record,
+                                                                                             repository_status,
+                                                                                             deposit_log,
+                                                                                             deposit_done_count,
+                                                                                             deposit_filter=deposit_filter,
+                                                                                             token=token)
+            except Cancelled as e:
+                # stopped part way through this notification; whatever was sent to the repository is in the journal
+                _defer_backlog(acc, note, repository_status, deposit_log, str(e))
+                deferred = True
+                break
             if not status:
-                # the deposit log and repository status are saved at this point
+                # the deposit log and repository status are saved at this point; the repository is stuck at this
+                # notification until the failure is resolved
+                metrics.age("account_max_undelivered", _timestamp(note.data.get("created_date")), account=acc.id)
                 return
+            if deposit_done_count > done_before:
+                quota.record_deposit()
     except client.JPERException as e:
         # save the status where we currently got to, so we can pick up again later
         repository_status.save()
@@ -135,11 +414,20 @@ def process_account(acc):
         deposit_log.status = repository_status.status
         deposit_log.save()
         raise e
-
-    # if we get to here, all the notifications for this account have been deposited, 
-    # and we can update the status and finish up
+    finally:
+        if deposit_filter is not None:
+            deposit_filter.save()
+
+    # if we get to here, all the notifications for this account have been deposited (or deferred to
+    # the next pass), and we can update the status and finish up
+    if not deferred and repository_status.backlog_since is not None:
+        del repository_status.backlog_since
     repository_status.save()
-    if deposit_done_count > 0:
+    metrics.gauge("account_pass_deposits", deposit_done_count, account=acc.id)
+    # nothing is left undelivered, unless the rest of the backlog was deferred to the next pass
+    metrics.age("account_max_undelivered", _timestamp(repository_status.backlog_since) if deferred else 0,
+                account=acc.id)
+    if deposit_done_count > 0 or deferred:
         deposit_log.add_message('info', "Number of successful deposits: {x}".format(x=deposit_done_count), None, None)
         deposit_log.status = "succeeding"
         deposit_log.save()
@@ -147,18 +435,22 @@ def process_account(acc):
     return
 
 
-def process_notification_requests(acc):
+def process_notification_requests(acc, token=None):
     """
     Retrieve the notification requests in JPER associated with this account and deposit those notifications
     to the sword-enabled repository
 
     The account status will be ignored and a deposit will be attempted
 
+    If the pass is cancelled, the remaining requests are left queued for the next pass
+
     :param acc: the account whose request notifications to process
+    :param token: cancellation token for the pass, if any
     """
-    app.logger.info("Depositing requested notifications for Account:{x}".format(x=acc.id))
+    app.logger.info(logs.lazy("Depositing requested notifications for Account:{x}", x=acc.id))
+    acc = models.AccountView.of(acc)
 
-    j = client.JPER(api_key=acc.api_key)
+    j = MeteredJPER(api_key=acc.api_key)
     deposit_log = models.RepositoryDepositLog()
     deposit_log.repository = acc.id
     repository_status = models.RepositoryStatus.pull(acc.id)
@@ -166,7 +458,7 @@ def process_notification_requests(acc):
     # sword deposit, so we need to create one
     if repository_status is None:
         app.logger.debug(
-            "Account:{x} has not previously deposited - creating repository status record".format(x=acc.id))
+            logs.lazy("Account:{x} has not previously deposited - creating repository status record", x=acc.id))
         repository_status = create_repo_status(acc)
         deposit_log.add_message('debug', "First deposit for account {x}".format(x=acc.id), None, None)
 
@@ -178,18 +470,28 @@ def process_notification_requests(acc):
     try:
         # Get request notifications for this account
         for rn in models.RequestNotification.iterate_request_notification(acc.id):
+            if token is not None and token.cancelled:
+                deposit_log.add_message('info', "Leaving remaining requests to the next pass - {x}".format(
+                    x=token.reason), None, None)
+                break
             note = j.get_notification(rn.notification_id)
             if not note:
                 rn.status = 'failed'
                 rn.save()
                 continue
             check_deposit_record = False
-            status, repository_status, deposit_log, deposit_done_count = attempt_deposit(acc, note,
-                                                                                         check_deposit_record,
-                                                                                         repository_status,
-                                                                                         deposit_log,
-                                                                                         deposit_done_count,
-                                                                                         request_note=rn)
+            try:
+                status, repository_status, deposit_log, deposit_done_count = attempt_deposit(acc, note,
+                                                                                             check_deposit_record,
+                                                                                             repository_status,
+                                                                                             deposit_log,
+                                                                                             deposit_done_count,
+                                                                                             request_note=rn,
+                                                                                             token=token)
+            except Cancelled as e:
+                deposit_log.add_message('info', "Leaving remaining requests to the next pass - {x}".format(
+                    x=str(e)), note.id, None)
+                break
             if not status:
                 # the deposit log and repository status are saved at this point
                 return
@@ -218,21 +520,25 @@ def process_notification_requests(acc):
 
 
 def attempt_deposit(acc, note, check_deposit_record, repository_status, deposit_log, deposit_done_count,
-                    request_note=None):
+                    request_note=None, deposit_filter=None, token=None):
     status = True
     try:
         deposit_record_id = None
         # 2018-03-08 TD : introducing a return value 'deposit_done' ....
-        deposit_done, deposit_record_id = process_notification(acc, note, since=None,
-                                                               check_deposit_record=check_deposit_record)
+        with metrics.in_flight(acc.id, note.id):
+            deposit_done, deposit_record_id = process_notification(acc, note, since=None,
+                                                                   check_deposit_record=check_deposit_record,
+                                                                   deposit_filter=deposit_filter, token=token)
         if deposit_done is True:
             # FIX ME. Why is deposit date set to notification created date and not the current date?
             repository_status.last_deposit_date = note.data["created_date"]
             deposit_log.add_message('info', "Notification deposited", note.id, deposit_record_id)
             deposit_done_count += 1
             repository_status.status = "succeeding"
+            metrics.incr("deposits")
+            _record_lag(acc, note)
         else:
-            drec = models.DepositRecord.pull(deposit_record_id)
+            drec = models.DepositRecord.pull(deposit_record_id) if deposit_record_id is not None else None
             if drec and (drec.metadata_status == "invalidxml" or drec.metadata_status == "payloadtoolarge"):
                 deposit_log.add_message('warn',
                                         "Notification not deposited - {x}".format(x=drec.metadata_status),
@@ -245,6 +551,7 @@ def attempt_deposit(acc, note, check_deposit_record, repository_status, deposit_
             request_note.deposit_id = deposit_record_id
             request_note.save()
     except DepositException as e:
+        metrics.incr("deposit_failures")
         if request_note:
             request_note.status = 'failed'
             if deposit_record_id:
@@ -278,7 +585,7 @@ def create_repo_status(acc):
     return repository_status
 
 
-def process_notification(acc, note, since=None, check_deposit_record=True):
+def process_notification(acc, note, since=None, check_deposit_record=True, deposit_filter=None, token=None):
     """
     For the given account and notification, deliver the notification to 
     the sword-enabled repository.
@@ -292,13 +599,20 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
     :param note: notification to be deposited
     :param since: earliest date which the current set of requests is made from.
     :param check_deposit_record: Flag to deposit without checking for existing deposit
+    :param deposit_filter: filter of the notifications already deposited to (and attempted for) this account, if in
+        use; the deposit record is only checked for notifications which the filter says may have been attempted, and
+        the notification is added to the filter once its deposit record shows a successful deposit
+    :param token: cancellation token for the pass, if any; checked while the content is downloaded.  Cancelled
+        is raised before anything has been sent to the repository, or for an individual files deposit, after the
+        metadata has been sent, in which case the item is left in the journal for the next attempt to carry on with
     :return: flag (boolean) to indicated a successful deposit
     """
-    app.logger.debug("Processing Notification:{y} for Account:{x}".format(x=acc.id, y=note.id))
+    app.logger.debug(logs.lazy("Processing Notification:{y} for Account:{x}", x=acc.id, y=note.id))
 
     # for type inspection...
-    assert isinstance(acc, models.Account)
+    assert isinstance(acc, (models.Account, models.AccountView))
     assert isinstance(note, jper_models.OutgoingNotification)
+    acc = models.AccountView.of(acc)
 
     # 2018-03-08 TD : new return flag; initialised to 'False'
     deposit_done = False
@@ -314,21 +628,39 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
     #                 therefore, testing every call for possible doubles!
     # this gets the most recent deposit record for this id pair
     if check_deposit_record:
-        dr = models.DepositRecord.pull_by_ids(note.id, acc.id)
+        dr = None
+        if deposit_filter is not None and not deposit_filter.attempted_before(note.id):
+            # certainly never attempted, so there is no deposit record to ask the index for
+            metrics.incr("deposit_filter_negatives")
+        elif deposit_filter is not None and note.id in deposit_filter and \
+                app.config.get("DEPOSIT_FILTER_AUTHORITATIVE", False):
+            metrics.incr("deposit_filter_positives")
+            app.logger.debug(
+                logs.lazy("Notification:{y} for Account:{x} is in the deposit filter - skipping", x=acc.id, y=note.id))
+            metrics.incr("notifications_skipped", reason="deposited")
+            return deposit_done, None
+        else:
+            with metrics.stage("es"):
+                dr = models.DepositRecord.pull_by_ids(note.id, acc.id)
+            if dr is not None:
+                dr = dr.view()
         if dr:
             # was this a successful deposit?  if so, don't re-run
             if dr.was_successful():
                 app.logger.debug(
-                    "Notification:{y} for Account:{x} was previously deposited - skipping".format(x=acc.id, y=note.id))
+                    logs.lazy("Notification:{y} for Account:{x} was previously deposited - skipping", x=acc.id, y=note.id))
+                metrics.incr("notifications_skipped", reason="deposited")
                 # 2018-03-08 TD : return the new flag with 'False'
                 return deposit_done, dr.id
             else:
                 dr_count = models.DepositRecord.pull_count_by_ids(note.id, acc.id)
                 if dr_count >= app.config.get("MAX_DEPOSIT_ATTEMPTS", 10):
                     app.logger.debug(
-                        "Notification:{y} for Account:{x} has been attempted {z} times - skipping".format(x=acc.id,
+                        logs.lazy("Notification:{y} for Account:{x} has been attempted {z} times - skipping", x=acc.id,
                                                                                                           y=note.id,
                                                                                                           z=dr_count))
+                    _dead_letter(acc, note, "attempts", dr_count)
+                    metrics.incr("notifications_skipped", reason="attempts")
                     # 2018-03-08 TD : return the new flag with 'False'
                     return deposit_done, dr.id
 
@@ -337,8 +669,10 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
             # 2020-01-13 TD : ... and special case 'payloadtoolarge'
             if dr.metadata_status == "invalidxml" or dr.metadata_status == "payloadtoolarge":
                 app.logger.debug(
-                    "Notification:{y} for Account:{x} was not previously deposited - SPECIAL CASE ('{z}') - skipping".format(
+                    logs.lazy("Notification:{y} for Account:{x} was not previously deposited - SPECIAL CASE ('{z}') - skipping", 
                         x=acc.id, y=note.id, z=dr.metadata_status))
+                _dead_letter(acc, note, dr.metadata_status)
+                metrics.incr("notifications_skipped", reason=dr.metadata_status)
                 # 2020-01-09 TD : return also 'False' in this special case
                 return deposit_done, dr.id
 
@@ -351,15 +685,17 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
     # set the deposit date to current date and time
     dr.deposit_date = dates.now()
 
+    # whatever the outcome, the notification now has a deposit record to be consulted next time (unless the pass is
+    # cancelled before anything is sent, in which case the filter only costs a needless look at the index)
+    if deposit_filter is not None:
+        deposit_filter.add_attempt(note.id)
+
     # work out if there is a content object to be deposited
-    # which means asking the note if there's a content link with a package format supported
-    # by the repository
-    link = None
-    packaging = None
-    for p in acc.packaging:
-        link = note.get_package_link(p)
-        if link is not None:
-            packaging = p
+    # which means asking the note if there's a content link with the package format the
+    # account's deposit plan asks for
+    plan = DepositPlan.for_account(acc)
+    link = plan.link_for(note)
+    packaging = plan.packaging
 
     # pre-populate the content and completed bits of the deposit record, 
     # if there is no package to be deposited
@@ -370,9 +706,12 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
     # 2017-05-19 TD : major insert of different repository cases: OPUS4, Pubman(ESciDoc), DSpace, ???, ...
     # 2017-07-13 TD : just added MODS as further repository format option
     # 2019-08-14 TD : added the SimpleZip as another format option to the list...
-    deposit_method = 'single zip file'
-    if acc.sword_deposit_method == 'individual files':
-        deposit_method = acc.sword_deposit_method
+    deposit_method = plan.deposit_method
+
+    # if an earlier deposit of this notification was interrupted after the repository created the item, carry on
+    # with that item rather than creating another
+    resumed_stage, resumed_receipt = _reconcile(acc, note, dr)
+
     # if "opus4" in str(packaging).lower() or \
     #         "escidoc" in str(packaging).lower() or \
     #         "dspace" in str(packaging).lower() or \
@@ -389,10 +728,28 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
             # 2018-03-08 TD : return with the new flag (currently 'False' up to here, hopefully!
             return deposit_done, dr.id
 
-        # first, get a copy of the file from the API into the local tmp store
+        # the item was created from the package by the interrupted attempt, so once the repository shows that it has
+        # the package, there is nothing left to send
+        if resumed_stage is not None:
+            if not _verify_content(acc, resumed_receipt, dr):
+                msg = "The item created for Notification:{y} by an interrupted deposit ({z}) does not show the " \
+                      "package - leaving it for a later attempt".format(y=note.id, z=resumed_receipt.edit)
+                dr.add_message('error', msg)
+                dr.metadata_status = dr.content_status = dr.completed_status = "failed"
+                dr.save()
+                app.logger.error(msg)
+                raise DepositException(msg)
+            dr.metadata_status = dr.content_status = dr.completed_status = "deposited"
+            dr.save()
+            journal.finish(acc.id, note.id)
+            _filter_deposited(note, dr, deposit_filter)
+            deposit_done = True
+            return deposit_done, dr.id
+
+        # first, get a local copy of the content from the API
         # Not raising an exception, just recording it and returning deposit not done
         try:
-            local_id, path = _cache_content(link, note, acc)
+            content = _fetch_content(link, note, acc, token=token)
         except client.JPERException as e:
             msg = "Problem while retrieving content from store for SWORD deposit: {x}".format(x=str(e))
             dr.add_message('error', msg)
@@ -400,32 +757,23 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
             dr.save()
             return deposit_done, dr.id
 
-        # make a copy of the tmp store for removing the content later
-        tmp = store.StoreFactory.tmp()
-
-        # adjust some special case(s) for the packaging identification string.
-        # Some repositories are really picky about this...
-        # 2019-03-05 TD : it turned out that our DSpace test repo only accepts METSDSpaceSIP
-        #                 as packaging string, and sorts out the correct format by itself then 
-        # 2020-02-05 TD : someone seemed to have corrected for the packaging string... dumb.
-        #                 to work around just commenting out the workaround, sigh.
-        if "opus4" in str(packaging).lower():
-            packaging = None
-        elif "escidoc" in str(packaging).lower():
-            packaging = "http://purl.org/escidoc/metadata/schemas/0.1/publication"
-        # elif "metsmods" in str(packaging).lower():
-        #    packaging = "http://purl.org/net/sword/package/METSDSpaceSIP"
-
-        # now we can do the deposit from the locally stored file 
+        # use the packaging identification string adjusted for the repository's special case(s), if any
+        # (see DepositPlan)
+        packaging = plan.zip_packaging
+
+        # now we can do the deposit from the local copy, which is removed when it is closed
         # (which we need because we're going to use seek() on it 
         #                  which we can't do with the http stream)
-        with open(path, "rb") as f:
+        with content as f:
+            journal.begin(acc.id, note.id, dr.id, deposit_method)
             try:
-                deepgreen_deposit(packaging, f, acc, dr)
+                ur = deepgreen_deposit(packaging, f, acc, dr)
+                journal.advance(acc.id, note.id, journal.CREATED, edit=getattr(ur, "edit", None))
                 # ensure the content status is set as we expect it
                 dr.metadata_status = dr.content_status = dr.completed_status = "deposited"
                 # 2018-03-08 TD : And we had a lift off...
                 dr.save()
+                journal.finish(acc.id, note.id)
                 deposit_done = True
             except DepositException as e:
                 # save the actual deposit record, ensuring the content_status is set the way
@@ -437,13 +785,12 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
                 if not (dr.metadata_status == "invalidxml" or dr.metadata_status == "payloadtoolarge"):
                     dr.metadata_status = "failed"
                 dr.save()
-
-                # delete the locally stored content
-                tmp.delete(local_id)
+                journal.finish(acc.id, note.id)
 
                 # 2020-01-09 TD : do not kick the exception upstairs but simply return Flag!
                 if dr.metadata_status == "invalidxml" or dr.metadata_status == "payloadtoolarge":
-                    # app.logger.info("Leaving processing notifs (with '{z}')".format(z=dr.metadata_status))
+                    # app.logger.info(logs.lazy("Leaving processing notifs (with '{z}')", z=dr.metadata_status))
+                    _dead_letter(acc, note, dr.metadata_status)
                     return deposit_done, dr.id
 
                 msg1 = "Received package deposit exception for Notification:{y} on Account:{x}.".format(
@@ -453,14 +800,25 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
                 # kick the exception upstairs for continued handling
                 raise e
 
-        # now we can get rid of the locally stored content
-        tmp.delete(local_id)
-
     else:
         # make the metadata deposit, determining whether to immediately
         # complete the deposit if there is no link for content
+        # (unless the item was created by an interrupted attempt, in which case use that, and replay the steps of the
+        # deposit plan which the interrupted attempt did not record)
+        steps = plan.sequence(has_content=link is not None)
+        created = resumed_stage is not None
         try:
-            receipt = metadata_deposit(note, acc, dr, complete=link is None)
+            if resumed_stage is not None:
+                receipt = resumed_receipt
+            else:
+                journal.begin(acc.id, note.id, dr.id, deposit_method)
+                receipt = metadata_deposit(note, acc, dr, complete=link is None)
+                journal.advance(acc.id, note.id, journal.CREATED, edit=receipt.edit)
+                created = True
+            # if this is an eprints repository, also send the XML as a file
+            if adapters.XML_FILE in steps and resumed_stage not in (journal.XML_FILE, journal.CONTENT):
+                xml_file_deposit(receipt, note, acc, dr)
+                journal.advance(acc.id, note.id, journal.XML_FILE)
             # ensure the metadata status is set as we expect it
             dr.metadata_status = "deposited"
             # 2018-03-08 TD : depositing metadata counts as well!
@@ -473,10 +831,14 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
             if not dr.metadata_status == "invalidxml" and not dr.metadata_status == "payloadtoolarge":
                 dr.metadata_status = "failed"
             dr.save()
+            # once the item has been created, it stays in the journal, so that the next attempt carries on with it
+            if not created:
+                journal.finish(acc.id, note.id)
 
             # 2020-01-09 TD : do not kick the exception upstairs but simply return Flag!
             if dr.metadata_status == "invalidxml" or dr.metadata_status == "payloadtoolarge":
-                app.logger.info("Leaving processing notifs (with '{z}')".format(z=dr.metadata_status))
+                app.logger.info(logs.lazy("Leaving processing notifs (with '{z}')", z=dr.metadata_status))
+                _dead_letter(acc, note, dr.metadata_status)
                 return deposit_done, dr.id
 
             msg1 = "Received metadata deposit exception for Notification:{y} on Account:{x}.".format(
@@ -493,50 +855,57 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
             dr.add_message('debug', msg)
             app.logger.debug(msg)
             dr.save()
+            journal.finish(acc.id, note.id)
+            _filter_deposited(note, dr, deposit_filter)
             # 2018-03-08 TD : return with flag
             return deposit_done, dr.id
 
-        # if we get to here, we have to deal with the content deposit
-
-        # first, get a copy of the file from the API into the local tmp store
-        try:
-            local_id, path = _cache_content(link, note, acc)
-        except client.JPERException as e:
-            msg = "Problem while retrieving content from store for SWORD deposit: {x}".format(x=str(e))
-            dr.add_message('error', msg)
-            app.logger.error(msg)
-            dr.save()
-            return deposit_done, dr.id
-
-        # make a copy of the tmp store for removing the content later
-        tmp = store.StoreFactory.tmp()
-
-        # now we can do the deposit from the locally stored file (which we need because we're going to use seek() on it
-        # which we can't do with the http stream)
-        with open(path, "rb") as f:
+        # if we get to here, we have to deal with the content deposit (unless the interrupted attempt got as far
+        # as depositing it, and the repository shows that it has it)
+        # (the item stays in the journal if this fails, so that the next attempt deposits the content to it)
+        if resumed_stage == journal.CONTENT and _verify_content(acc, receipt, dr):
+            dr.content_status = "deposited"
+        else:
+            # first, get a local copy of the content from the API
             try:
-                package_deposit(receipt, f, packaging, acc, dr)
-                # ensure the content status is set as we expect it
-                dr.content_status = "deposited"
-                # 2018-03-08 TD : ... and a successful deposit, again!
-                deposit_done = True
-            except DepositException as e:
-                msg1 = "Received package deposit exception for Notification:{y} on Account:{x}.".format(
-                    x=acc.id, y=note.id)
-                msg2 = "Recording a failed deposit and ceasing processing on this notification"
-                app.logger.error("{x} {y}".format(x=msg1, y=msg2))
-                # save the actual deposit record, ensuring the content_status is set the way we expect
+                content = _fetch_content(link, note, acc, token=token)
+            except Cancelled as e:
+                # the metadata is already in the repository, so the attempt is recorded as failed, and the notification
+                # is deferred to the next pass, which carries on with the item in the journal
+                msg = "Retrieving content from store for SWORD deposit was cancelled: {x}".format(x=str(e))
+                dr.add_message('error', msg)
+                app.logger.error(msg)
                 dr.content_status = "failed"
                 dr.save()
+                raise
+            except client.JPERException as e:
+                msg = "Problem while retrieving content from store for SWORD deposit: {x}".format(x=str(e))
+                dr.add_message('error', msg)
+                app.logger.error(msg)
+                dr.save()
+                return deposit_done, dr.id
 
-                # delete the locally stored content
-                tmp.delete(local_id)
-
-                # kick the exception upstairs for continued handling
-                raise e
-
-        # now we can get rid of the locally stored content
-        tmp.delete(local_id)
+            # now we can do the deposit from the local copy, which is removed when it is closed (which we need because
+            # we're going to use seek() on it which we can't do with the http stream)
+            with content as f:
+                try:
+                    package_deposit(receipt, f, packaging, acc, dr)
+                    journal.advance(acc.id, note.id, journal.CONTENT)
+                    # ensure the content status is set as we expect it
+                    dr.content_status = "deposited"
+                    # 2018-03-08 TD : ... and a successful deposit, again!
+                    deposit_done = True
+                except DepositException as e:
+                    msg1 = "Received package deposit exception for Notification:{y} on Account:{x}.".format(
+                        x=acc.id, y=note.id)
+                    msg2 = "Recording a failed deposit and ceasing processing on this notification"
+                    app.logger.error("{x} {y}".format(x=msg1, y=msg2))
+                    # save the actual deposit record, ensuring the content_status is set the way we expect
+                    dr.content_status = "failed"
+                    dr.save()
+
+                    # kick the exception upstairs for continued handling
+                    raise e
 
         # finally, complete the request
         try:
@@ -563,23 +932,197 @@ def process_notification(acc, note, since=None, check_deposit_record=True):
 
     # that's it, we've successfully deposited this notification to the repository along with all its content
     dr.save()
+    journal.finish(acc.id, note.id)
+    _filter_deposited(note, dr, deposit_filter)
     app.logger.debug("Leaving processing notification")
     # 2018-03-08 TD : return with (new) flag
     return deposit_done, dr.id
 
 
-def _cache_content(link, note, acc):
+def _filter_deposited(note, deposit_record, deposit_filter):
+    """
+    Add the notification to the deposit filter if its deposit record, as saved, is of a successful deposit.  A
+    deposit which got as far as the metadata but not the content is left out, so that it is attempted again
+
+    :param note: the notification
+    :param deposit_record: the saved deposit record
+    :param deposit_filter: the account's deposit filter, if in use
+    """
+    if deposit_filter is not None and deposit_record.was_successful():
+        deposit_filter.add(note.id)
+
+
+def _dead_letter(acc, note, reason, attempts=None):
+    """
+    Record the notification in the dead letter store, so that subsequent passes skip it without
+    any further requests to JPER or the index
+
+    :param acc: user account of repository
+    :param note: notification which will no longer be deposited
+    :param reason: attempts, invalidxml or payloadtoolarge
+    :param attempts: the number of deposit attempts made
+    """
+    app.logger.info(logs.lazy("Notification:{y} for Account:{x} moved to dead letters ({z})", x=acc.id, y=note.id,
+                                                                                        z=reason))
+    models.DeadLetter.record(acc.id, note.id, reason, attempts)
+
+
+def _reconcile(acc, note, deposit_record):
+    """
+    Check the deposit journal for an interrupted deposit of the notification, and if the repository created an item
+    for it, whether the item is still there
+
+    :param acc: user account of repository
+    :param note: the notification being deposited
+    :param deposit_record: provenance object for recording actions during this deposit process
+    :return: tuple of the journal stage the interrupted deposit reached and the item's deposit receipt, or
+        (None, None) if the deposit is to be made afresh
+    :raises DepositException: if the repository could not say whether it has the item
+    """
+    entry = journal.get(acc.id, note.id)
+    if entry is None:
+        return None, None
+
+    edit = entry.get("edit")
+    if entry.get("stage") == journal.INTENT or edit is None:
+        msg = "An earlier deposit of Notification:{y} to Account:{x} was interrupted before the repository " \
+              "created an item - depositing again".format(x=acc.id, y=note.id)
+        deposit_record.add_message('info', msg)
+        app.logger.warning(msg)
+        metrics.incr("journal_redeposits")
+        return None, None
+
+    try:
+        receipt = _connection(acc).get_deposit_receipt(edit)
+    except Exception as e:
+        receipt = e
+    if receipt is None or isinstance(receipt, Exception) or isinstance(receipt, sword2.Error_Document):
+        msg = "Unable to find out whether the repository has the item created for Notification:{y} by an " \
+              "interrupted deposit ({z}) - leaving it for a later attempt".format(y=note.id, z=edit)
+        deposit_record.add_message('error', msg)
+        deposit_record.metadata_status = "failed"
+        deposit_record.save()
+        app.logger.error(msg)
+        raise DepositException(msg)
+
+    if receipt.code == 404:
+        msg = "The item created for Notification:{y} by an interrupted deposit ({z}) is no longer in the " \
+              "repository - depositing again".format(y=note.id, z=edit)
+        deposit_record.add_message('info', msg)
+        app.logger.warning(msg)
+        journal.finish(acc.id, note.id)
+        metrics.incr("journal_redeposits")
+        return None, None
+
+    msg = "Resuming the interrupted deposit of Notification:{y} to Account:{x} with the item at {z} " \
+          "(stage '{w}')".format(x=acc.id, y=note.id, z=edit, w=entry["stage"])
+    deposit_record.add_message('info', msg)
+    app.logger.info(msg)
+    metrics.incr("journal_reconciled")
+    return entry["stage"], receipt
+
+
+def _verify_content(acc, receipt, deposit_record):
+    """
+    Check that the item created by an interrupted deposit has the package, from the content listed in its deposit
+    receipt or, if the receipt lists none, from the original deposits listed in its statement
+
+    :param acc: user account of repository
+    :param receipt: the item's deposit receipt, as retrieved by _reconcile
+    :param deposit_record: provenance object for recording actions during this deposit process
+    :return: True if the repository shows that the item has the package
+    """
+    if getattr(receipt, "content", None):
+        return True
+    statement_iri = getattr(receipt, "atom_statement_iri", None)
+    if statement_iri is not None:
+        try:
+            with metrics.stage("receipt"):
+                statement = _connection(acc).get_atom_sword_statement(statement_iri)
+        except Exception as e:
+            app.logger.error("Unable to retrieve the statement of the item at {x}: {y}".format(x=receipt.edit,
+                                                                                                y=str(e)))
+            statement = None
+        if statement is not None and getattr(statement, "original_deposits", None):
+            return True
+    msg = "The repository does not show the package in the item at {x}".format(x=receipt.edit)
+    deposit_record.add_message('info', msg)
+    app.logger.warning(msg)
+    return False
+
+
+def _defer_backlog(acc, note, repository_status, deposit_log, reason):
+    """
+    Leave the account's notifications from this one onwards for the next pass
+
+    :param acc: user account of repository
+    :param note: the first notification not processed in this pass
+    :param repository_status: the repository status, on which the point to resume from is recorded
+    :param deposit_log: the deposit log for this pass
+    :param reason: why the notifications are being deferred
+    """
+    repository_status.backlog_since = note.data["created_date"]
+    msg = "Deferring notifications from {x} to the next pass - {y}".format(x=repository_status.backlog_since,
+                                                                          y=reason)
+    app.logger.info(logs.lazy("Account:{x} {y}", x=acc.id, y=msg))
+    deposit_log.add_message('info', msg, None, None)
+
+
+def _record_lag(acc, note):
+    """
+    Record the time between the creation of a notification and its delivery to the repository, in the global and
+    per-account deposit lag histograms
+
+    :param acc: user account of repository
+    :param note: the notification which has just been deposited
+    """
+    created = _timestamp(note.data.get("created_date"))
+    if not created:
+        return
+    lag = max(0, time.time() - created)
+    buckets = app.config.get("DEPOSIT_LAG_BUCKETS")
+    metrics.histogram("deposit_lag_seconds", lag, buckets)
+    metrics.histogram("account_deposit_lag_seconds", lag, buckets, account=acc.id)
+
+
+def _timestamp(date):
+    """
+    Seconds since the epoch of a date in the format used by JPER, for the metrics
+
+    :param date: the date string
+    :return: the timestamp, or 0 if there is no date
+    """
+    if date is None:
+        return 0
+    return calendar.timegm(dates.parse(date).utctimetuple())
+
+
+def _connection(acc):
+    """
+    Create a sword2 connection to the account's repository
+
+    :param acc: user account of repository
+    :return: sword2.Connection, whose requests are each limited to SWORD_TIMEOUT
+    """
+    return sword2.Connection(user_name=acc.sword_username, user_pass=acc.sword_password,
+                             error_response_raises_exceptions=False, http_impl=http_layer.SwordHttpLayer())
+
+
+def _cache_content(link, note, acc, token=None):
     """
     Make a local copy of the content referenced by the link
 
-    This will copy the content retrieved via the link into the temp store for use in the onward relay
+    This will copy the content retrieved via the link into the temp store for use in the onward relay.
+    The download is abandoned with a JPERException if it takes longer than DOWNLOAD_TIMEOUT, or with Cancelled
+    if the pass is cancelled while it is in progress
 
     :param link: url to content
     :param note: notification we are working on
     :param acc: user account we are working as
+    :param token: cancellation token for the pass, if any
     """
     app.logger.debug("Entering _cache_content")
-    j = client.JPER(api_key=acc.api_key)
+    j = MeteredJPER(api_key=acc.api_key)
     try:
         gen, headers = j.get_content(link.get("url"))
     except client.JPERException as e:
@@ -591,20 +1134,268 @@ def _cache_content(link, note, acc):
     fn = link.get("url").split("/")[-1]
     out = tmp.path(local_id, fn, must_exist=False)
 
-    with open(out, "wb") as f:
-        for chunk in gen:
-            if chunk:
-                f.write(chunk)
-            else:
-                break
+    try:
+        with open(out, "wb") as f:
+            _write_content(gen, f, link.get("url"), token)
+    except (client.JPERException, Cancelled):
+        tmp.delete(local_id)
+        raise
 
     app.logger.debug("Leaving _cache_content")
     return local_id, out
 
 
+@metrics.timed("download")
+def _fetch_content(link, note, acc, token=None):
+    """
+    Fetch the content referenced by the link into memory or a local file, for use in the onward relay
+
+    Content of up to SPOOL_CONTENT_THRESHOLD bytes is held in memory.  Anything larger (or everything, if the
+    threshold is 0) is downloaded to a partial file in STORE_TMP_DIR, keyed by the account and the content url.  If
+    the download fails part way, the partial file is kept, and the next attempt asks JPER for only the remaining
+    bytes, provided the content has not changed since (by the ETag or Last-Modified date JPER gave for it).  Once
+    complete, its length is checked, and it is handed over as a file which is removed when closed.
+    The download is abandoned in the same way as by _cache_content
+
+    :param link: url to content
+    :param note: notification we are working on
+    :param acc: user account we are working as
+    :param token: cancellation token for the pass, if any
+    :return: seekable binary file, positioned at the start of the content
+    """
+    app.logger.debug(logs.lazy("Fetching content for Notification:{x}", x=note.id))
+    url = link.get("url")
+    j = MeteredJPER(api_key=acc.api_key)
+
+    part = _partial_path(acc, url)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    gen = None
+    if offset > 0:
+        gen, headers, offset = _get_content_from(j, url, offset, _read_validator(part))
+        if gen is None:
+            # the partial file is of no further use
+            _remove_partial(part)
+    if gen is None:
+        gen, headers = j.get_content(url)
+
+    length = _header_int(headers, "content-length")
+    threshold = app.config.get("SPOOL_CONTENT_THRESHOLD", 0)
+    if offset == 0 and threshold and (length is None or length <= threshold):
+        _remove_partial(part)
+        # if the content turns out to be larger than the threshold, room is reserved in the temp store before it
+        # rolls over to disk
+        f = tmpstore.SpooledFile(threshold, expected=length, token=token)
+        try:
+            _write_content(gen, f, url, token)
+        except (client.JPERException, Cancelled):
+            f.close()
+            raise
+        metrics.incr("content_fetched", storage="memory" if tmpstore.in_memory(f) else "disk")
+        f.seek(0)
+        return f
+
+    # the full length of the content, from the Content-Range of a partial response if there is one
+    expected = _content_range_total(headers)
+    if expected is None and length is not None:
+        expected = offset + length
+
+    # wait for room in the temp store, rather than filling the disk
+    tmpstore.reserve(expected - offset if expected is not None else 0, token)
+
+    # if this fails part way, the partial file is left for the next attempt to carry on from, along with the
+    # validator which tells JPER to send the rest of it only if the content has not changed in the meantime
+    if offset == 0:
+        _write_validator(part, headers)
+    with open(part, "ab" if offset > 0 else "wb") as out:
+        _write_content(gen, out, url, token)
+
+    size = os.path.getsize(part)
+    if expected is not None and size != expected:
+        _remove_partial(part)
+        raise client.JPERException("Download of {x} is {y} bytes, but {z} were expected".format(
+            x=url, y=size, z=expected))
+
+    # unlink the completed file straight away, so that it is removed when it is closed
+    f = open(part, "rb")
+    _remove_partial(part)
+    metrics.incr("content_fetched", storage="disk")
+    if offset > 0:
+        metrics.incr("content_resumed")
+        metrics.incr("content_resumed_bytes", offset)
+    return f
+
+
+def _partial_path(acc, url):
+    """
+    Path of the partial file for a download
+
+    :param acc: user account we are working as
+    :param url: url of the content
+    :return: the path, in STORE_TMP_DIR
+    """
+    tmpdir = os.path.join(app.config.get("STORE_TMP_DIR"), "partial")
+    os.makedirs(tmpdir, exist_ok=True)
+    key = hashlib.sha1("{x} {y}".format(x=acc.id, y=url).encode("utf-8")).hexdigest()
+    return os.path.join(tmpdir, key + ".part")
+
+
+def _validator_path(part):
+    return part + ".validator"
+
+
+def _read_validator(part):
+    """
+    The validator (ETag or Last-Modified) JPER gave for the content in a partial file, if any
+
+    :param part: path of the partial file
+    :return: the validator, or None
+    """
+    try:
+        with open(_validator_path(part), "r") as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _write_validator(part, headers):
+    """
+    Keep the validator JPER gave for the content alongside the partial file it is downloaded to.  Weak ETags cannot be
+    used in an If-Range, so the Last-Modified date is used instead
+
+    :param part: path of the partial file
+    :param headers: headers of the response the content is read from
+    """
+    validator = None
+    if headers is not None:
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            validator = etag
+        else:
+            validator = headers.get("last-modified")
+    path = _validator_path(part)
+    if validator:
+        with open(path, "w") as f:
+            f.write(validator)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _remove_partial(part):
+    """
+    Remove a partial file and its validator
+
+    :param part: path of the partial file
+    """
+    for path in [part, _validator_path(part)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _get_content_from(j, url, offset, validator=None):
+    """
+    Ask JPER for the content from the given byte offset onwards
+
+    If there is a validator, the request is made with If-Range, so that JPER sends the whole content (rather than
+    a range of something other than what the partial file holds) if it has changed since the partial file was written.
+    A partial response which does not start at the offset cannot be appended to the partial file, so the download is
+    started again
+
+    :param j: JPER client
+    :param url: url of the content
+    :param offset: number of bytes already downloaded
+    :param validator: ETag or Last-Modified date of the content in the partial file, if known
+    :return: tuple of the generator of chunks (None if the partial download cannot be resumed), the response
+        headers and the offset the generator starts from (0 if JPER sent the whole content)
+    """
+    metrics.incr("jper_requests", op="content")
+    req_headers = {"Range": "bytes={x}-".format(x=offset)}
+    if validator is not None:
+        req_headers["If-Range"] = validator
+    resp, content, size = http.get_stream(j._url(url=url), read_stream=False, headers=req_headers)
+    if resp is None:
+        raise client.JPERException("There was an error retrieving the content from {x}".format(x=url))
+    if resp.status_code == 416:
+        # the partial file is not a prefix of the content (e.g. it is already complete), so start again
+        app.logger.info(logs.lazy("Unable to resume download of {x} from byte {y} - starting again", x=url, y=offset))
+        return None, None, 0
+    if resp.status_code >= 400:
+        raise client.JPERException("Error {x} retrieving the content from {y}".format(x=resp.status_code, y=url))
+    headers = getattr(resp, "headers", None)
+    if resp.status_code != 206:
+        # the range was ignored (or the content has changed) and the whole content sent
+        offset = 0
+    else:
+        start = _content_range_start(headers)
+        if start != offset:
+            app.logger.info(logs.lazy("JPER sent {x} from byte {y} rather than {z} - starting again",
+                                      x=url, y=start, z=offset))
+            return None, None, 0
+    app.logger.info(logs.lazy("Resuming download of {x} from byte {y}", x=url, y=offset))
+    return resp.iter_content(chunk_size=CONTENT_CHUNK_SIZE), headers, offset
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _content_range_start(headers):
+    try:
+        start = headers.get("content-range").split(" ", 1)[1].split("-", 1)[0]
+        return int(start)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+
+def _content_range_total(headers):
+    try:
+        total = headers.get("content-range").rsplit("/", 1)[1]
+        return int(total)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+
+def _write_content(gen, f, url, token=None):
+    """
+    Write a content stream from JPER to a local file
+
+    :param gen: generator of the chunks of content
+    :param f: file to write to
+    :param url: url of the content, for error messages
+    :param token: cancellation token for the pass, if any
+    """
+    timeout = app.config.get("DOWNLOAD_TIMEOUT")
+    started = time.monotonic()
+    aborted = threading.Event()
+    size = 0
+    try:
+        with watchdog.on_abort(aborted.set):
+            for chunk in gen:
+                if token is not None:
+                    token.check()
+                if aborted.is_set():
+                    raise client.JPERException("Download of {x} was aborted by the watchdog".format(x=url))
+                if timeout and time.monotonic() - started > timeout:
+                    raise client.JPERException("Download of {x} did not complete within {y}s".format(
+                        x=url, y=timeout))
+                if chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+                else:
+                    break
+    except IOError as e:
+        # the connection to JPER dropped part way through
+        raise client.JPERException("Download of {x} failed: {y}".format(x=url, y=str(e)))
+    finally:
+        metrics.incr("content_bytes", size)
+
+
 #
 # 2017-05-19 TD : For the time being, DeepGreen wants to deposit all in once.
 #
+@metrics.timed("create")
 def deepgreen_deposit(packaging, file_handle, acc, deposit_record):
     """
     Deposit the binary package content to the target repository
@@ -613,14 +1404,14 @@ def deepgreen_deposit(packaging, file_handle, acc, deposit_record):
     :param file_handle: the file handle on the binary content to deliver
     :param acc: the account we are working as
     :param deposit_record: provenance object for recording actions during this deposit process
+    :return: the deposit receipt from the sword client
     """
     msg = "Depositing DeepGreen Package Format:{y} for Account:{x}".format(x=acc.id, y=packaging)
     deposit_record.add_message('info', msg)
     app.logger.info(msg)
 
     # create a connection object
-    conn = sword2.Connection(user_name=acc.sword_username, user_pass=acc.sword_password,
-                             error_response_raises_exceptions=False, http_impl=client_http.OctopusHttpLayer())
+    conn = _connection(acc)
 
     #
     # this one would create an collection item as the package's file(s)
@@ -645,11 +1436,10 @@ def deepgreen_deposit(packaging, file_handle, acc, deposit_record):
         deposit_record.content_status = "failed"
         deposit_record.metadata_status = "failed"
         deposit_record.completed_status = "failed"
-        if not ur.error_href is None:
-            if "opus-repository" in ur.error_href and "InvalidXml" in ur.error_href:
-                deposit_record.metadata_status = "invalidxml"
-            if "opus-repository" in ur.error_href and "PayloadToLarge" in ur.error_href:
-                deposit_record.metadata_status = "payloadtoolarge"
+        # special cases which retrying cannot fix (e.g. OPUS4's 'InvalidXml' and 'PayloadToLarge')
+        special = DepositPlan.for_account(acc).adapter.classify_error(ur)
+        if special is not None:
+            deposit_record.metadata_status = special
 
         msg1 = "Received error document depositing the package to the repository."
         msg2 = "Content deposit failed with status {x} (error_href={y})".format(x=ur.code, y=ur.error_href)
@@ -670,9 +1460,10 @@ def deepgreen_deposit(packaging, file_handle, acc, deposit_record):
         app.logger.info(msg)
 
     app.logger.debug("DeepGreen Package deposit")
-    return
+    return ur
 
 
+@metrics.timed("create")
 def metadata_deposit(note, acc, deposit_record, complete=False):
     """
     Deposit the metadata from the notification in the target repository
@@ -688,19 +1479,19 @@ def metadata_deposit(note, acc, deposit_record, complete=False):
     app.logger.info(msg)
 
     # create a connection object
-    conn = sword2.Connection(user_name=acc.sword_username, user_pass=acc.sword_password,
-                             error_response_raises_exceptions=False, http_impl=client_http.OctopusHttpLayer())
+    conn = _connection(acc)
 
     # storage manager instance for use later
     sm = store.StoreFactory.get()
 
-    # assemble the atom entry for deposit
-    entry = sword2.Entry()
-    xwalk.to_dc_rioxx(note, entry)
+    # assemble the atom entry for deposit (or reuse the one made for another repository)
+    entry = xwalk.entry_for(note)
 
     # do the deposit
+    plan = DepositPlan.for_account(acc)
+    steps = plan.sequence(has_content=not complete)
     ip = not complete
-    if acc.repository_software in ["eprints"]:
+    if plan.adapter.in_progress_only:
         # EPrints doesn't allow "complete" requests, so we leave everything in_progress for the purposes of consistency
         ip = True
 
@@ -722,16 +1513,10 @@ def metadata_deposit(note, acc, deposit_record, complete=False):
     if isinstance(receipt, sword2.Error_Document):
         deposit_record.metadata_status = "failed"
         # 2020-01-09 TD : check for special cases for 'InvalidXml' in the error document
-        # ehref = receipt.error_href
-        # 2020-01-13 TD : safety check, e.g. if receipt.code == 500 (INTERNAL SERVER ERROR),
-        #                                    then receipt.error_href is None
-        if not receipt.error_href is None:
-            if "opus-repository" in receipt.error_href and "InvalidXml" in receipt.error_href:
-                deposit_record.metadata_status = "invalidxml"
-            # 2020-01-13 TD : check for special cases for 'PayloadToLarge' in the error document
-            #                 (note the typo here in OPUS4 ...)
-            if "opus-repository" in receipt.error_href and "PayloadToLarge" in receipt.error_href:
-                deposit_record.metadata_status = "payloadtoolarge"
+        # 2020-01-13 TD : ... and for 'PayloadToLarge' (see adapters.OPUS4Adapter)
+        special = plan.adapter.classify_error(receipt)
+        if special is not None:
+            deposit_record.metadata_status = special
 
         msg1 = "Received error document depositing metadata to the repository."
         msg2 = "Metadata deposit failed with status {x} (error_href={y})".format(x=receipt.code, y=receipt.error_href)
@@ -749,36 +1534,47 @@ def metadata_deposit(note, acc, deposit_record, complete=False):
         deposit_record.add_message('info', msg)
         app.logger.info(msg)
 
-    # if this wasn't an error document, then we have a legitimate response, but we need the deposit receipt
-    # so get it explicitly, and store it
-    if receipt.dom is None:
-        try:
-            receipt = conn.get_deposit_receipt(receipt.edit)
-        except Exception as e:
-            msg = "There was an error attempting to retrieve deposit receipt in repository. {x}".format(x=str(e))
-            deposit_record.add_message('error', msg)
-            app.logger.error(msg)
-            raise DepositException(msg)
+    # if this wasn't an error document, then we have a legitimate response, but if the response didn't include the
+    # deposit receipt, the steps which follow may need it.  It is only retrieved when one of them needs a field which
+    # the response's headers don't give, unless the response data is being stored, in which case get it explicitly,
+    # and store it
+    if receipt.dom is None and adapters.RECEIPT in steps:
+        receipt = LazyReceipt(receipt, conn, deposit_record)
         if app.config.get("STORE_RESPONSE_DATA", False):
+            receipt.require("dom")
             content = receipt.to_xml()
             sm.store(deposit_record.id, "metadata_deposit_response.xml", source_stream=StringIO(content))
 
-    # if this is an eprints repository, also send the XML as a file
-    if acc.repository_software in ["eprints"]:
-        xmlhandle = StringIO(str(entry))
-        try:
-            conn.add_file_to_resource(receipt.edit_media, xmlhandle, "sword.xml", "text/xml")
-        except Exception as e:
-            msg = "There was an error attempting to deposit atom entry as file in Eprints repository. {x}".format(
-                x=str(e))
-            deposit_record.add_message('error', msg)
-            app.logger.error(msg)
-            raise DepositException(msg)
-
     app.logger.info("Leaving metadata deposit")
     return receipt
 
 
+@metrics.timed("update")
+def xml_file_deposit(receipt, note, acc, deposit_record):
+    """
+    Add the atom entry for the notification to the item as a file, for the repositories whose deposit plan includes
+    it (EPrints)
+
+    :param receipt: deposit receipt from the metadata deposit
+    :param note: the notification being deposited
+    :param acc: the account we are working as
+    :param deposit_record: provenance object for recording actions during this deposit process
+    """
+    conn = _connection(acc)
+    xmlhandle = StringIO(str(xwalk.entry_for(note)))
+    if isinstance(receipt, LazyReceipt):
+        receipt.require("edit_media")
+    try:
+        conn.add_file_to_resource(receipt.edit_media, xmlhandle, "sword.xml", "text/xml")
+    except Exception as e:
+        msg = "There was an error attempting to deposit atom entry as file in Eprints repository. {x}".format(
+            x=str(e))
+        deposit_record.add_message('error', msg)
+        app.logger.error(msg)
+        raise DepositException(msg)
+
+
+@metrics.timed("update")
 def package_deposit(receipt, file_handle, packaging, acc, deposit_record):
     """
     Deposit the binary package content to the target repository
@@ -794,12 +1590,13 @@ def package_deposit(receipt, file_handle, packaging, acc, deposit_record):
     app.logger.info(msg)
 
     # create a connection object
-    conn = sword2.Connection(user_name=acc.sword_username, user_pass=acc.sword_password,
-                             error_response_raises_exceptions=False, http_impl=client_http.OctopusHttpLayer())
+    conn = _connection(acc)
 
     # FIXME: not that neat, but eprints has special behaviours that we need to accommodate.  So, in the eprints
     # case we add the package as a file to the resource, but in all other cases we append the files to the item
-    if acc.repository_software in ["eprints"]:
+    if isinstance(receipt, LazyReceipt):
+        receipt.require("edit_media")
+    if DepositPlan.for_account(acc).adapter.add_package_as_file:
         # this one adds the package as a new file to the item
         try:
             ur = conn.add_file_to_resource(receipt.edit_media, file_handle, "deposit.zip", "application/zip", packaging)
@@ -850,6 +1647,7 @@ def package_deposit(receipt, file_handle, packaging, acc, deposit_record):
     return
 
 
+@metrics.timed("complete")
 def complete_deposit(receipt, acc, deposit_record):
     """
     Issue a "complete" request against the repository, to indicate that no further files are coming
@@ -864,12 +1662,16 @@ def complete_deposit(receipt, acc, deposit_record):
 
     # EPrints repositories can't handle the "complete" request
     cr = None
-    if acc.repository_software not in ["eprints"]:
+    if adapters.COMPLETE in DepositPlan.for_account(acc).sequence(has_content=True):
         # create a connection object
-        conn = sword2.Connection(user_name=acc.sword_username, user_pass=acc.sword_password,
-                                 error_response_raises_exceptions=False, http_impl=client_http.OctopusHttpLayer())
-
-        # send the complete request to the repository
+        conn = _connection(acc)
+
+        # send the complete request to the repository.  The client falls back to the Edit-IRI if there is no SE-IRI,
+        # so the receipt is only retrieved if neither is known
+        if isinstance(receipt, LazyReceipt):
+            if receipt.known("se_iri") is None and receipt.known("edit") is None:
+                receipt.require("se_iri")
+            receipt = receipt.receipt
         try:
             cr = conn.complete_deposit(dr=receipt)
         except Exception as e:
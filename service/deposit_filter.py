@@ -0,0 +1,152 @@
+"""
+Per-account filters of the notifications which have already been successfully deposited, and of those which have
+been attempted at all (i.e. have any deposit record).
+
+The filter of attempted notifications lets process_notification skip the index lookup for a notification which has
+certainly never been attempted, and so has no deposit record to consult.  For any other notification the deposit
+record is consulted, so that the limit on deposit attempts and the special failure states still apply to one which
+keeps failing - unless the filter of deposited notifications says it may have been deposited and
+DEPOSIT_FILTER_AUTHORITATIVE is set, in which case that answer is taken as final.
+
+The filter is persisted as a DepositFilter record alongside the repository's RepositoryStatus.  Each time it is
+loaded, any deposit records saved since the filter itself was last saved are added to it, so deposits made by
+other means (request notifications, scripts, or a run which stopped before saving the filter) are never missed.
+"""
+from octopus.core import app
+from octopus.lib import dates
+from service import bloom, models
+
+CATCH_UP_MARGIN = 300
+"""seconds to overlap the catch-up query with the filter's last save, to allow for index refresh delays"""
+
+
+class AccountDepositFilter(object):
+    """
+    The filters of successfully deposited and of attempted notification ids for one account
+    """
+
+    def __init__(self, account_id, bf, attempted, capacity, record=None):
+        self.account_id = account_id
+        self.filter = bf
+        self.attempted = attempted
+        self.capacity = capacity
+        self.record = record
+        self.dirty = False
+
+    @classmethod
+    def load(cls, account_id):
+        """
+        Load the filters for the account, rebuilding them from the deposit records if there are none (or only the
+        filter of deposited notifications, saved before attempts were filtered too) or they have been filled beyond
+        their capacity
+
+        :param account_id: the account id
+        :return: AccountDepositFilter
+        """
+        record = models.DepositFilter.pull(account_id)
+        attempted = record.get_attempted_filter() if record is not None else None
+        if attempted is None or record.count > record.capacity or attempted.count > record.capacity:
+            return cls.rebuild(account_id)
+
+        adf = cls(account_id, record.get_filter(), attempted, record.capacity, record)
+        since = record.last_updated
+        if since is not None:
+            since = dates.format(dates.parse(since) - dates.timedelta(seconds=CATCH_UP_MARGIN))
+        for dr in models.DepositRecord.iterate_by_repository(account_id, since=since):
+            if not adf.attempted_before(dr.notification):
+                adf.add_attempt(dr.notification)
+            if dr.was_successful() and dr.notification not in adf:
+                adf.add(dr.notification)
+        return adf
+
+    @classmethod
+    def rebuild(cls, account_id):
+        """
+        Build the filters for the account from all of its deposit records, and save them.
+
+        Notifications which have never been deposited but which have used up their deposit attempts, or ended in
+        one of the special failure states, are entered into the dead letter store at the same time, so that they are
+        skipped without a further look at their deposit records
+
+        :param account_id: the account id
+        :return: AccountDepositFilter
+        """
+        app.logger.info("Rebuilding deposit filter for Account:{x}".format(x=account_id))
+        succeeded = set()
+        attempts = {}
+        special = {}
+        for dr in models.DepositRecord.iterate_by_repository(account_id):
+            if dr.was_successful():
+                succeeded.add(dr.notification)
+            else:
+                attempts[dr.notification] = attempts.get(dr.notification, 0) + 1
+                if dr.metadata_status in ["invalidxml", "payloadtoolarge"]:
+                    special[dr.notification] = dr.metadata_status
+
+        capacity = max(app.config.get("DEPOSIT_FILTER_CAPACITY", 50000), 2 * len(succeeded | set(attempts.keys())))
+        error_rate = app.config.get("DEPOSIT_FILTER_ERROR_RATE", 0.01)
+        bf = bloom.BloomFilter.for_capacity(capacity, error_rate)
+        for note_id in succeeded:
+            bf.add(note_id)
+        attempted = bloom.BloomFilter.for_capacity(capacity, error_rate)
+        for note_id in succeeded | set(attempts.keys()):
+            attempted.add(note_id)
+
+        limit = app.config.get("MAX_DEPOSIT_ATTEMPTS", 10)
+        for note_id, count in attempts.items():
+            if note_id in succeeded:
+                continue
+            if note_id in special:
+                models.DeadLetter.record(account_id, note_id, special[note_id], count)
+            elif count >= limit:
+                models.DeadLetter.record(account_id, note_id, "attempts", count)
+
+        adf = cls(account_id, bf, attempted, capacity)
+        adf.dirty = True
+        adf.save()
+        return adf
+
+    def __contains__(self, note_id):
+        return note_id in self.filter
+
+    def add(self, note_id):
+        """
+        Record a successfully deposited notification
+
+        :param note_id: the notification id
+        """
+        if self.filter.add(note_id):
+            self.dirty = True
+
+    def attempted_before(self, note_id):
+        """
+        Might the notification have a deposit record (of a successful or a failed attempt)
+
+        :param note_id: the notification id
+        :return: False if the notification has certainly never been attempted
+        """
+        return note_id in self.attempted
+
+    def add_attempt(self, note_id):
+        """
+        Record that a notification has been attempted, i.e. that it may now have a deposit record
+
+        :param note_id: the notification id
+        """
+        if self.attempted.add(note_id):
+            self.dirty = True
+
+    def save(self):
+        """
+        Persist the filter, if it has changed since it was loaded
+        """
+        if not self.dirty:
+            return
+        record = self.record if self.record is not None else models.DepositFilter()
+        record.id = self.account_id
+        record.capacity = self.capacity
+        record.set_filter(self.filter)
+        record.set_attempted_filter(self.attempted)
+        record.save()
+        self.record = record
+        self.dirty = False
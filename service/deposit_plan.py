@@ -0,0 +1,84 @@
+"""
+Per-account deposit plan: the decisions about how to deposit to a repository which depend only on the account.
+
+process_notification used to work these out again for every notification (which package format to ask for, how to
+identify it to the repository, which deposit method to use, and how the repository software needs to be treated).
+A DepositPlan makes them once, when it is first needed for an account in a pass, and the engine then reads them
+from the plan.  The repository specific behaviour comes from the account's adapter (see service.adapters).
+
+Plans are cached against the account view (see service.models.views), so a change to the account's settings
+yields a new plan, and the cache is cleared at the start of each pass.
+"""
+from service import models, adapters
+
+_plans = {}
+
+
+class DepositPlan(object):
+    """
+    How to deposit notifications to one account's repository
+    """
+    __slots__ = ("account_id", "formats", "packaging", "zip_packaging", "deposit_method", "adapter")
+
+    def __init__(self, acc):
+        """
+        :param acc: the account (or a view of it)
+        """
+        self.account_id = acc.id
+        self.formats = tuple(acc.packaging or [])
+
+        # the package is looked up in the last of the account's formats; this is the format any content is deposited
+        # in, and if the notification has no package in it, only the metadata is deposited
+        self.packaging = self.formats[-1] if self.formats else None
+
+        self.adapter = adapters.for_account(acc)
+
+        # some repositories are really picky about the packaging identifier for a single zip deposit
+        # (2019-03-05 TD : our DSpace test repo only accepts METSDSpaceSIP, which it now gets as-is)
+        self.zip_packaging = self.adapter.map_packaging(self.packaging)
+
+        self.deposit_method = "single zip file"
+        if acc.sword_deposit_method == "individual files":
+            self.deposit_method = acc.sword_deposit_method
+
+    @classmethod
+    def for_account(cls, acc):
+        """
+        Get the plan for the account, making it if this is the first time it is needed
+
+        :param acc: the account (or a view of it)
+        :return: DepositPlan
+        """
+        view = models.AccountView.of(acc)
+        plan = _plans.get(view)
+        if plan is None:
+            plan = cls(view)
+            _plans[view] = plan
+        return plan
+
+    def link_for(self, note):
+        """
+        The link to the package to deposit for the notification, if there is one
+
+        :param note: the notification
+        :return: the link, or None if there is no content to deposit
+        """
+        if self.packaging is None:
+            return None
+        return note.get_package_link(self.packaging)
+
+    def sequence(self, has_content):
+        """
+        The round trips to the repository for a deposit to this account
+
+        :param has_content: whether there is a package to deposit
+        :return: tuple of steps (see service.adapters)
+        """
+        return self.adapter.sequence(self.deposit_method, has_content)
+
+
+def clear():
+    """
+    Forget the plans made so far, so that each is made afresh for the next pass
+    """
+    _plans.clear()
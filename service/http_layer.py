@@ -0,0 +1,268 @@
+"""
+HTTP layer for the sword2 client, which puts a timeout on every request made to a repository.
+
+Package files are uploaded straight from the file to the socket (with sendfile where the platform allows it), so
+the memory used by a deposit does not grow with the size of the package.
+
+Every request can be aborted by the watchdog (see service.watchdog), which shuts down its sockets from another
+thread if the request has overrun the budget for its stage, e.g. because the repository stopped responding part way
+through.  The request then raises watchdog.Aborted.
+"""
+import base64, http.client, io, os, socket, threading, urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from sword2 import HttpLayer, HttpResponse
+from octopus.core import app
+from service import metrics, tmpstore, watchdog
+
+CHUNK_SIZE = 1024 * 1024
+"""size of the chunks in which a file is sent when sendfile cannot be used"""
+
+
+def _is_file(payload):
+    """
+    Is the payload a real file on disk, which can be streamed from its file descriptor
+
+    :param payload: request body
+    :return: True if it is
+    """
+    if not hasattr(payload, "read") or not hasattr(payload, "fileno"):
+        return False
+    try:
+        os.fstat(payload.fileno())
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def _in_memory(payload):
+    """
+    Is the payload a SpooledTemporaryFile which is still held in memory.  Anything which asks for the fileno()
+    of such a file would make it roll over to disk, so it is sent from its buffer instead
+
+    :param payload: request body
+    :return: True if it is
+    """
+    return tmpstore.in_memory(payload)
+
+
+def send_file(sock, f, length):
+    """
+    Send length bytes of the file from its current position to the socket.
+
+    socket.sendfile uses the kernel's sendfile for plain sockets, and falls back to sending from a fixed size
+    buffer (e.g. for TLS); either way the file is never read into memory as a whole
+
+    :param sock: connected socket
+    :param f: file opened in binary mode
+    :param length: number of bytes to send
+    """
+    offset = f.tell()
+    if hasattr(sock, "sendfile"):
+        sock.sendfile(f, offset, length)
+        return
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        sock.sendall(chunk)
+        remaining -= len(chunk)
+
+
+def _body_size(headers, payload):
+    """
+    Size of a request body, as far as it can be told without reading it
+
+    :param headers: request headers
+    :param payload: request body
+    :return: number of bytes, 0 if unknown
+    """
+    try:
+        return int(CaseInsensitiveDict(headers or {}).get("Content-Length"))
+    except (TypeError, ValueError):
+        pass
+    if isinstance(payload, (bytes, str)):
+        return len(payload)
+    return 0
+
+
+def _meter(method, sent, received):
+    """
+    Count a completed request to a repository, and the bytes of its body and of the response's, as sword_requests,
+    sword_bytes_sent and sword_bytes_received
+    """
+    metrics.incr("sword_requests", op=method)
+    metrics.incr("sword_bytes_sent", sent)
+    metrics.incr("sword_bytes_received", received)
+
+
+class _Abort(object):
+    """
+    Aborts a request in progress, by shutting down the sockets of the connections it has made
+    """
+
+    def __init__(self):
+        self.connections = []
+        self.aborted = False
+
+    def __call__(self):
+        self.aborted = True
+        for conn in list(self.connections):
+            sock = conn.sock
+            if sock is None:
+                continue
+            try:
+                # on the plain socket, even for TLS, so as not to disturb the SSL object the request is using
+                socket.socket.shutdown(sock, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+_local = threading.local()
+
+
+class _Tracked(object):
+    """
+    Mixin for the urllib3 connections which requests makes, which adds each to the _Abort of the request being made
+    in the current thread
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_Tracked, self).__init__(*args, **kwargs)
+        abort = getattr(_local, "abort", None)
+        if abort is not None:
+            abort.connections.append(self)
+
+
+class _TrackedHTTPConnection(_Tracked, HTTPConnection):
+    pass
+
+
+class _TrackedHTTPSConnection(_Tracked, HTTPSConnection):
+    pass
+
+
+class _TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+
+class _TrackedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TrackedAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TrackedHTTPConnectionPool,
+                                                   "https": _TrackedHTTPSConnectionPool}
+
+
+class SwordHttpResponse(HttpResponse):
+    def __init__(self, status, headers):
+        self._status = status
+        self.headers = headers
+
+    def __getitem__(self, att):
+        if att == "status":
+            return self.status
+        return self.headers.get(att)
+
+    def __repr__(self):
+        return "<SwordHttpResponse [{x}]>".format(x=self.status)
+
+    @property
+    def status(self):
+        return self._status
+
+    def get(self, att, default=None):
+        if att == "status":
+            return self.status
+        return self.headers.get(att, default)
+
+    def keys(self):
+        return list(self.headers.keys())
+
+
+class SwordHttpLayer(HttpLayer):
+    def __init__(self, timeout=None):
+        """
+        :param timeout: seconds to wait to connect, and for each read; by default SWORD_TIMEOUT from configuration
+        """
+        self.username = None
+        self.password = None
+        self.auth = None
+        self.timeout = timeout if timeout is not None else app.config.get("SWORD_TIMEOUT")
+
+    def add_credentials(self, username, password):
+        self.username = username
+        self.password = password
+        self.auth = HTTPBasicAuth(username, password)
+
+    def request(self, uri, method, headers=None, payload=None):    # Note that body can be file-like
+        if _in_memory(payload):
+            payload = payload.read()
+        elif _is_file(payload):
+            return self._stream_file(uri, method, headers, payload)
+        abort = _Abort()
+        _local.abort = abort
+        try:
+            with requests.Session() as session, watchdog.on_abort(abort):
+                session.mount("http://", _TrackedAdapter())
+                session.mount("https://", _TrackedAdapter())
+                resp = session.request(method, uri, headers=headers, data=payload, auth=self.auth,
+                                       timeout=self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            if abort.aborted:
+                raise watchdog.Aborted("{x} {y} was aborted by the watchdog".format(x=method, y=uri)) from e
+            raise
+        finally:
+            _local.abort = None
+        _meter(method, _body_size(headers, payload), len(resp.content))
+        return SwordHttpResponse(resp.status_code, resp.headers), resp.content
+
+    def _stream_file(self, uri, method, headers, f):
+        url = urllib.parse.urlsplit(uri)
+        if url.scheme == "https":
+            conn = http.client.HTTPSConnection(url.hostname, url.port, timeout=self.timeout)
+        elif url.scheme == "http":
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+        else:
+            raise ValueError("Unable to upload to {x}: unsupported scheme".format(x=uri))
+
+        headers = CaseInsensitiveDict(headers or {})
+        if "Content-Length" in headers:
+            length = int(headers["Content-Length"])
+        else:
+            length = os.fstat(f.fileno()).st_size - f.tell()
+            headers["Content-Length"] = str(length)
+        if self.username is not None:
+            creds = "{x}:{y}".format(x=self.username, y=self.password).encode("utf-8")
+            headers["Authorization"] = "Basic " + base64.b64encode(creds).decode("ascii")
+
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        abort = _Abort()
+        abort.connections.append(conn)
+        try:
+            with watchdog.on_abort(abort):
+                conn.putrequest(method, path)
+                for k, v in headers.items():
+                    conn.putheader(k, v)
+                conn.endheaders()
+                send_file(conn.sock, f, length)
+                resp = conn.getresponse()
+                content = resp.read()
+            _meter(method, length, len(content))
+            return SwordHttpResponse(resp.status, CaseInsensitiveDict(resp.getheaders())), content
+        except (OSError, http.client.HTTPException) as e:
+            if abort.aborted:
+                raise watchdog.Aborted("{x} {y} was aborted by the watchdog".format(x=method, y=uri)) from e
+            raise
+        finally:
+            conn.close()
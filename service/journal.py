@@ -0,0 +1,232 @@
+"""
+Write-ahead journal of the deposits in flight, so that a deposit interrupted by a crash or restart is reconciled with
+the repository rather than made again.
+
+Before the first request to the repository for a notification, an entry is written to the journal recording the
+intent to deposit.  When the repository has created the item, its Edit-IRI is added to the entry, and as the atom
+entry is sent as a file (EPrints) and the package is deposited, those stages are recorded too.  Once the deposit record has been saved, the entry is removed.
+
+Each entry is a small JSON file in DEPOSIT_JOURNAL_DIR, one per account and notification, which is replaced
+atomically (and synced to disk) at each stage, so that it survives the process being killed at any point, and so
+that any number of worker processes can share the journal without coordinating.
+
+When a notification with an entry in the journal is processed again, the deposit engine asks the repository for the
+item at the recorded Edit-IRI, and if it is there, replays the steps of the deposit plan after the last stage which
+was recorded, rather than creating a second item and uploading the package again (see deposit.process_notification).
+An entry which stopped before the item was created cannot be reconciled, as there is nothing to look the item up by,
+and the deposit is made again as before.
+
+Most notifications have no entry, so during a pass (see listing()) the journal directory is listed once, and get()
+only opens the entries which the listing shows to be there.
+"""
+import hashlib, json, os, tempfile
+from contextlib import contextmanager
+from octopus.core import app
+from octopus.lib import dates
+from service import metrics
+
+INTENT = "intent"
+"""about to make the first request to the repository"""
+
+CREATED = "created"
+"""the repository has created the item (for a single zip file deposit, from the package)"""
+
+XML_FILE = "xml_file"
+"""the atom entry has been added to the item as a file (for repositories whose deposit plan includes it)"""
+
+CONTENT = "content"
+"""the package has been deposited to the item"""
+
+_listing = None
+
+
+def _dir():
+    return app.config.get("DEPOSIT_JOURNAL_DIR")
+
+
+def enabled():
+    """
+    Is the journal configured
+
+    :return: True if DEPOSIT_JOURNAL_DIR is set
+    """
+    return bool(_dir())
+
+
+def _name(account_id, notification_id):
+    key = hashlib.sha1("{a} {n}".format(a=account_id, n=notification_id).encode("utf-8")).hexdigest()
+    return key + ".json"
+
+
+def _path(account_id, notification_id):
+    return os.path.join(_dir(), _name(account_id, notification_id))
+
+
+@contextmanager
+def listing():
+    """
+    Context manager around a pass, for the duration of which get() answers from a single listing of the journal
+    directory taken at the start, rather than trying to open an entry for each notification.  The entries written
+    and removed during the pass are kept in the listing; entries written by other processes are not seen, which is
+    safe as long as each account is only deposited to by one process at a time (see service.supervisor)
+    """
+    global _listing
+    directory = _dir()
+    try:
+        names = set(os.listdir(directory)) if directory else set()
+    except FileNotFoundError:
+        names = set()
+    _listing = names
+    try:
+        yield
+    finally:
+        _listing = None
+
+
+def _write(entry):
+    directory = _dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, _path(entry["account"], entry["notification"]))
+        if _listing is not None:
+            _listing.add(_name(entry["account"], entry["notification"]))
+    finally:
+        # only still there if the entry could not be written
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def begin(account_id, notification_id, deposit_record_id, deposit_method):
+    """
+    Record the intent to deposit a notification, before anything is sent to the repository.  Whatever has been
+    recorded of an earlier attempt is replaced
+
+    :param account_id: the account id
+    :param notification_id: the notification id
+    :param deposit_record_id: id of the deposit record of this attempt
+    :param deposit_method: "single zip file" or "individual files"
+    """
+    if not enabled():
+        return
+    now = dates.now()
+    _write({
+        "account": account_id,
+        "notification": notification_id,
+        "deposit_record": deposit_record_id,
+        "deposit_method": deposit_method,
+        "stage": INTENT,
+        "created_date": now,
+        "last_updated": now
+    })
+
+
+def advance(account_id, notification_id, stage, edit=None):
+    """
+    Record that the deposit of a notification has reached a stage
+
+    :param account_id: the account id
+    :param notification_id: the notification id
+    :param stage: CREATED, XML_FILE or CONTENT
+    :param edit: the Edit-IRI of the item in the repository, when it has been created
+    """
+    if not enabled():
+        return
+    entry = get(account_id, notification_id)
+    if entry is None:
+        return
+    entry["stage"] = stage
+    if edit is not None:
+        entry["edit"] = edit
+    entry["last_updated"] = dates.now()
+    _write(entry)
+
+
+def finish(account_id, notification_id):
+    """
+    Remove the entry for a notification, once its deposit record has been saved
+
+    :param account_id: the account id
+    :param notification_id: the notification id
+    """
+    if not enabled():
+        return
+    if _listing is not None:
+        _listing.discard(_name(account_id, notification_id))
+    try:
+        os.remove(_path(account_id, notification_id))
+    except FileNotFoundError:
+        pass
+
+
+def get(account_id, notification_id):
+    """
+    Get the entry for a notification, if its deposit was interrupted
+
+    :param account_id: the account id
+    :param notification_id: the notification id
+    :return: dict of the entry, or None if there is none
+    """
+    if not enabled():
+        return None
+    if _listing is not None and _name(account_id, notification_id) not in _listing:
+        return None
+    try:
+        with open(_path(account_id, notification_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # written atomically, so this should not happen, but an unreadable entry is no use to anyone
+        app.logger.warning("Discarding unreadable deposit journal entry for Notification:{y} on Account:{x}".format(
+            x=account_id, y=notification_id))
+        finish(account_id, notification_id)
+        return None
+
+
+def entries():
+    """
+    Iterate over all the entries in the journal
+
+    :return: generator of dicts
+    """
+    directory = _dir()
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def recover():
+    """
+    Review the journal at startup.  Entries whose deposit record was saved after all (the process stopped between
+    saving it and removing the entry) are removed; the rest are reported, and will be reconciled with the repository
+    when their notification is next processed
+
+    :return: the number of deposits left in flight
+    """
+    from service import models
+    pending = 0
+    for entry in entries():
+        dr = models.DepositRecord.pull_by_ids(entry["notification"], entry["account"])
+        if dr is not None and dr.was_successful():
+            finish(entry["account"], entry["notification"])
+            continue
+        pending += 1
+        app.logger.info("Deposit of Notification:{y} on Account:{x} was interrupted at stage '{z}'{w}".format(
+            x=entry["account"], y=entry["notification"], z=entry["stage"],
+            w=" (item at {e})".format(e=entry["edit"]) if entry.get("edit") else ""))
+    if pending > 0:
+        metrics.incr("journal_in_flight", pending)
+    return pending
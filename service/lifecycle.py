@@ -0,0 +1,155 @@
+"""
+Signal handling for the runner, the supervisor and its workers, so that the process can be stopped or reconfigured
+without losing the deposit in hand.
+
+On SIGTERM or SIGINT, the process stops scheduling new work: the pass in hand is drained (see
+CancellationToken.drain), so that it stops at its next boundary between accounts or notifications with its progress
+saved, and the notification being deposited is allowed to finish.  If that takes longer than SHUTDOWN_GRACE_PERIOD
+seconds, the pass is cancelled, which abandons a content download at its next chunk (a request already made to the
+repository still runs to its SWORD_TIMEOUT).  The process then flushes its logs, sweeps the temp store and exits.
+A second SIGINT (e.g. Ctrl-C pressed twice) exits straight away; anything interrupted is reconciled from the deposit
+journal by the next run.
+
+On SIGHUP, the configuration files are read again before the next pass, without restarting the process (see
+service.settings, which also picks up changes to the files between passes without a signal).
+"""
+import logging, signal, sys, threading
+from octopus.core import app
+from service import metrics, tmpstore, settings, logs, watchdog
+from service.cancellation import CancellationToken
+
+_stopping = threading.Event()
+_reload = threading.Event()
+_token = None
+_timer = None
+
+
+def install(config=None):
+    """
+    Install the signal handlers in this process, and reset the state left by any previous ones (e.g. in a worker
+    process forked from the supervisor)
+
+    :param config: path of the additional configuration file given on the command line, which is watched along
+        with the standard ones
+    """
+    # a forked worker carries on watching from where its supervisor had got to
+    if config is not None or not settings.watching():
+        settings.init(config)
+    _stopping.clear()
+    _reload.clear()
+    _cancel_timer()
+    signal.signal(signal.SIGTERM, _on_stop)
+    signal.signal(signal.SIGINT, _on_stop)
+    signal.signal(signal.SIGHUP, _on_reload)
+
+
+def _on_stop(signum, frame):
+    name = signal.Signals(signum).name
+    if _stopping.is_set():
+        if signum == signal.SIGINT:
+            app.logger.warning("Received {x} again - exiting without waiting for the deposit in hand".format(x=name))
+            raise SystemExit(1)
+        return
+    request_stop("received {x}".format(x=name))
+
+
+def _on_reload(signum, frame):
+    _reload.set()
+
+
+def request_stop(reason):
+    """
+    Stop scheduling new work, and give the pass in hand SHUTDOWN_GRACE_PERIOD seconds to finish
+
+    :param reason: description of why, used in the log
+    """
+    global _timer
+    if _stopping.is_set():
+        return
+    _stopping.set()
+    grace = app.config.get("SHUTDOWN_GRACE_PERIOD", 300)
+    app.logger.info("Shutting down ({x}) - allowing up to {y}s for the deposit in hand to finish".format(
+        x=reason, y=grace))
+    token = _token
+    if token is not None:
+        token.drain("shutting down")
+    if grace is not None:
+        _timer = threading.Timer(grace, _grace_expired)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _grace_expired():
+    token = _token
+    if token is not None:
+        app.logger.warning("Shutdown grace period expired - cancelling the pass in hand")
+        metrics.incr("shutdown_grace_expired")
+        token.cancel("shutdown grace period expired")
+
+
+def _cancel_timer():
+    global _timer
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+
+
+def stopping():
+    """
+    Has the process been asked to stop
+
+    :return: True if it has
+    """
+    return _stopping.is_set()
+
+
+def pass_token():
+    """
+    Create the cancellation token for the next pass, which is drained if the process is asked to stop
+
+    :return: CancellationToken
+    """
+    global _token
+    token = CancellationToken.for_pass()
+    _token = token
+    if _stopping.is_set():
+        token.drain("shutting down")
+    return token
+
+
+def sleep(seconds):
+    """
+    Wait between passes, waking early if the process is asked to stop
+
+    :param seconds: time to wait
+    """
+    _stopping.wait(seconds)
+
+
+def maybe_reload():
+    """
+    Apply any changes to the configuration files, if they have been modified or the process has received SIGHUP
+    since the last time (see service.settings)
+
+    :return: True if the configuration was changed, False if not
+    """
+    force = _reload.is_set()
+    _reload.clear()
+    return settings.maybe_reload(force=force)
+
+
+def shutdown(sweep=True):
+    """
+    Tidy up once the last pass has finished: sweep the temp store and write out the logs
+
+    :param sweep: whether to sweep the temp store (a worker leaves this to its supervisor)
+    """
+    _cancel_timer()
+    watchdog.stop()
+    if sweep:
+        tmpstore.sweep()
+    app.logger.info("Shut down cleanly")
+    logs.stop()
+    for handler in app.logger.handlers + logging.getLogger().handlers:
+        handler.flush()
+    sys.stdout.flush()
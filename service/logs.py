@@ -0,0 +1,184 @@
+"""
+Non-blocking, structured logging for the runner.
+
+The log used to be written by a RotatingFileHandler attached directly to app.logger, so that every message was
+formatted and written (and, once a gigabyte had been written, the file rotated) in the middle of the deposit loop.
+Instead, start() attaches a QueueHandler, which only puts each record on a queue, and a listener thread takes them
+off the queue, formats them and writes them to the real handlers.  With several worker processes the queue is
+shared (see share()), so that only the supervisor writes to the log file.
+
+Records are written as one JSON object per line (unless LOG_FORMAT is "text"), carrying the account, notification
+and stage of the deposit in flight in the thread which logged them (see metrics.in_flight), as well as any fields
+given in the extra argument of the logging call.
+
+Messages which are built with lazy() are only formatted if the record is written, so that debug messages cost next
+to nothing when the level is above DEBUG:
+
+    app.logger.debug(logs.lazy("Processing Notification:{y} for Account:{x}", x=acc.id, y=note.id))
+"""
+import json, logging, logging.handlers, queue, time
+from octopus.core import app
+from service import metrics
+
+FIELDS = ("account", "notification", "stage")
+"""the structured fields which each record carries, when they are known"""
+
+_handler = None
+_listener = None
+_targets = []
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d %(module)s %(funcName)s]'
+
+
+class lazy(object):
+    """
+    A log message which is formatted (with str.format) only when it is written
+    """
+    __slots__ = ("fmt", "kwargs")
+
+    def __init__(self, fmt, **kwargs):
+        self.fmt = fmt
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fmt.format(**self.kwargs)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a single line JSON object
+    """
+
+    def format(self, record):
+        doc = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".{x:03d}Z".format(
+                x=int(record.msecs)),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "pid": record.process
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                doc[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            doc["exception"] = record.exc_text
+        return json.dumps(doc, default=str)
+
+
+def formatter():
+    """
+    The formatter for the log, as set by LOG_FORMAT
+
+    :return: logging.Formatter
+    """
+    if app.config.get("LOG_FORMAT", "json") == "text":
+        return logging.Formatter(TEXT_FORMAT)
+    return JSONFormatter()
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which adds the structured fields of the deposit in flight to each record, and otherwise leaves the
+    formatting to the listener.  On a queue shared between processes, the message is rendered before the record is
+    sent, as its arguments may not survive the trip
+    """
+    shared = False
+
+    def prepare(self, record):
+        work = metrics.current_work()
+        if work is not None:
+            for field in FIELDS:
+                if getattr(record, field, None) is None:
+                    setattr(record, field, work.get(field))
+        if not self.shared:
+            return record
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        record = super(_Listener, self).dequeue(block)
+        try:
+            metrics.gauge("log_queue_depth", self.queue.qsize())
+        except NotImplementedError:
+            pass
+        return record
+
+
+def start(*handlers):
+    """
+    Send app.logger's records to the handlers through a queue, which a listener thread empties.  The handlers are
+    given the formatter set by LOG_FORMAT, and app.logger the level set by LOG_LEVEL
+
+    :param handlers: the handlers to write the log with, e.g. a RotatingFileHandler
+    """
+    global _handler, _listener, _targets
+    stop()
+    level = logging.getLevelName(app.config.get("LOG_LEVEL", "INFO"))
+    app.logger.setLevel(level)
+    for h in handlers:
+        h.setFormatter(formatter())
+    _targets = list(handlers)
+    _handler = ContextQueueHandler(queue.SimpleQueue())
+    app.logger.addHandler(_handler)
+    _listener = _Listener(_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def share(ctx):
+    """
+    Switch to a queue which processes forked from this one (with the multiprocessing context) can log to, so that
+    this process writes the log for all of them.  Does nothing if start() has not been called
+
+    :param ctx: the multiprocessing context the processes are started with
+    """
+    global _listener
+    if _handler is None or _handler.shared:
+        return
+    _listener.stop()
+    _handler.queue = ctx.Queue()
+    _handler.shared = True
+    _listener = _Listener(_handler.queue, *_targets, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """
+    Write out everything still on the queue, stop the listener, and attach the handlers to app.logger directly
+    again, so that anything logged from here on is written straight away.  In a process which is logging to a queue
+    shared with its parent, this just leaves the records to be written by the parent
+    """
+    global _handler, _listener, _targets
+    if _handler is None:
+        return
+    if _listener is not None:
+        _listener.stop()
+        app.logger.removeHandler(_handler)
+        for h in _targets:
+            app.logger.addHandler(h)
+            h.flush()
+    _handler = _listener = None
+    _targets = []
+
+
+def forked():
+    """
+    Called in a process forked from the one which started the logging: the listener thread was not carried over,
+    so the records are left for the parent to write from the shared queue
+    """
+    global _listener
+    if _handler is not None and _handler.shared:
+        _listener = None
@@ -0,0 +1,472 @@
+"""
+In-memory metrics for the deposit run cycle.
+
+Counters and gauges are held in the memory of the current process only, keyed by a name and an optional set of
+labels.  When the runner is operating with several worker processes each worker periodically reports a
+snapshot of its metrics to the supervisor, which aggregates them with merge()
+
+Histograms count observations (e.g. the lag of each deposit) into fixed buckets, so that they can be summed across
+processes, and "age" gauges hold the time since which something has been the case (e.g. the created date of the
+oldest notification not yet delivered), so that the age keeps growing in the reports between updates.
+
+Alongside them, each process keeps the live state of its work, for the status server (see service.status): the
+deposits in flight and the stage each has reached, the most recent durations of each stage, and the progress of
+the current pass.
+"""
+import collections, contextlib, functools, math, os, threading, time
+
+RECENT_SAMPLES = 100
+"""number of recent observations kept of each series, for the stage latencies"""
+
+PROMETHEUS_PREFIX = "sword_out_"
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_recent = {}
+_histograms = {}
+_ages = {}
+_work = {}
+_pass = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """
+    Increment a counter
+
+    :param name: name of the counter
+    :param value: amount to increment by
+    :param labels: optional labels which distinguish this series of the counter (e.g. account="...")
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """
+    Set a gauge
+
+    :param name: name of the gauge
+    :param value: its current value
+    :param labels: optional labels which distinguish this series of the gauge
+    """
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record an observation (e.g. a duration), of which the most recent RECENT_SAMPLES are kept
+
+    :param name: name of the series
+    :param value: the observed value
+    :param labels: optional labels which distinguish this series
+    """
+    key = _key(name, labels)
+    with _lock:
+        samples = _recent.get(key)
+        if samples is None:
+            samples = collections.deque(maxlen=RECENT_SAMPLES)
+            _recent[key] = samples
+        samples.append(value)
+
+
+def histogram(name, value, buckets, **labels):
+    """
+    Count an observation into a histogram
+
+    :param name: name of the histogram
+    :param value: the observed value
+    :param buckets: ascending upper bounds of the buckets; values above the last go only in the total count.  Every
+        observation of a series must use the same buckets
+    :param labels: optional labels which distinguish this series of the histogram
+    """
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = {"buckets": tuple(buckets), "counts": [0] * len(buckets), "sum": 0, "count": 0}
+            _histograms[key] = h
+        for i, bound in enumerate(h["buckets"]):
+            if value <= bound:
+                h["counts"][i] += 1
+                break
+        h["sum"] += value
+        h["count"] += 1
+
+
+def age(name, since, **labels):
+    """
+    Set an age gauge, which is reported as the time elapsed since a timestamp
+
+    :param name: name of the gauge
+    :param since: seconds since the epoch from which the age is measured, or 0/None for no age
+    :param labels: optional labels which distinguish this series of the gauge
+    """
+    key = _key(name, labels)
+    with _lock:
+        _ages[key] = since or 0
+
+
+@contextlib.contextmanager
+def in_flight(account, notification):
+    """
+    Record that the current thread is depositing a notification, for the duration of the block
+
+    :param account: the account id
+    :param notification: the notification id
+    """
+    ident = threading.get_ident()
+    now = time.time()
+    with _lock:
+        _work[ident] = {"account": account, "notification": notification, "started": now,
+                        "stage": None, "stage_started": now}
+    try:
+        yield
+    finally:
+        with _lock:
+            _work.pop(ident, None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Record that the deposit in flight in the current thread (if any) is in a stage, for the duration of the block,
+    and observe how long the stage took as stage_seconds
+
+    :param name: the stage, e.g. "download" or "create"
+    """
+    ident = threading.get_ident()
+    started = time.monotonic()
+    with _lock:
+        work = _work.get(ident)
+        previous = (work["stage"], work["stage_started"]) if work is not None else None
+        if work is not None:
+            work["stage"], work["stage_started"] = name, time.time()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.monotonic() - started, stage=name)
+        with _lock:
+            work = _work.get(ident)
+            if work is not None and previous is not None:
+                work["stage"], work["stage_started"] = previous
+
+
+def current_work():
+    """
+    The deposit in flight in the current thread, if any
+
+    :return: dict of its account, notification and stage, or None
+    """
+    with _lock:
+        work = _work.get(threading.get_ident())
+        return dict(work) if work is not None else None
+
+
+def work_in_flight():
+    """
+    The deposits in flight in this process, by the thread depositing each
+
+    :return: dict of thread ident to dict of the account, notification and stage
+    """
+    with _lock:
+        return {ident: dict(work) for ident, work in _work.items()}
+
+
+def timed(name):
+    """
+    Decorator which runs the whole of a function as a stage (see stage())
+
+    :param name: the stage
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def pass_progress(**fields):
+    """
+    Record the progress of the current pass (e.g. the number of accounts done so far)
+
+    :param fields: the fields to set
+    """
+    with _lock:
+        _pass.update(fields)
+
+
+def get(name, **labels):
+    """
+    Get the current value of a counter
+
+    :param name: name of the counter
+    :param labels: labels of the series to read
+    :return: the counter value, 0 if it has never been incremented
+    """
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def counters():
+    """
+    Take a copy of the counters, to compare with a later copy (see delta())
+
+    :return: dict of the counters, keyed by name and labels
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def delta(before, after):
+    """
+    How much each counter has gone up between two copies taken with counters(), summed over its labels
+
+    :param before: the earlier copy
+    :param after: the later copy
+    :return: dict of counter names to the increase
+    """
+    totals = {}
+    for (name, labels), value in after.items():
+        totals[name] = totals.get(name, 0) + value - before.get((name, labels), 0)
+    return totals
+
+
+def snapshot():
+    """
+    Take a copy of all the metrics held by this process, suitable for pickling across to another process
+
+    :return: dict of the metrics
+    """
+    pid = os.getpid()
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "recent": {k: list(v) for k, v in _recent.items()},
+            "histograms": {k: dict(v, counts=list(v["counts"])) for k, v in _histograms.items()},
+            "ages": dict(_ages),
+            "in_flight": [dict(w, pid=pid) for w in _work.values()],
+            "passes": [dict(_pass, pid=pid)] if _pass else []
+        }
+
+
+def reset():
+    """
+    Discard all the metrics held by this process
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _recent.clear()
+        _histograms.clear()
+        _ages.clear()
+        _work.clear()
+        _pass.clear()
+
+
+def merge(*snapshots):
+    """
+    Combine several snapshots into one, summing the counters.
+
+    The gauges and histograms are summed too, which suits the per-account ones, since each account is handled by one
+    process, and the oldest of each age is kept.  The recent observations are pooled, and the live state of each
+    process is listed
+
+    :param snapshots: snapshots as produced by snapshot()
+    :return: a new snapshot holding the totals
+    """
+    merged = {"counters": {}, "gauges": {}, "recent": {}, "histograms": {}, "ages": {}, "in_flight": [],
+              "passes": []}
+    for snap in snapshots:
+        if snap is None:
+            continue
+        for section in ("counters", "gauges"):
+            for key, value in snap.get(section, {}).items():
+                merged[section][key] = merged[section].get(key, 0) + value
+        for key, values in snap.get("recent", {}).items():
+            merged["recent"][key] = (merged["recent"].get(key, []) + values)[-RECENT_SAMPLES:]
+        for key, h in snap.get("histograms", {}).items():
+            total = merged["histograms"].get(key)
+            if total is None:
+                merged["histograms"][key] = dict(h, counts=list(h["counts"]))
+            elif total["buckets"] == h["buckets"]:
+                total["counts"] = [a + b for a, b in zip(total["counts"], h["counts"])]
+                total["sum"] += h["sum"]
+                total["count"] += h["count"]
+        for key, since in snap.get("ages", {}).items():
+            current = merged["ages"].get(key)
+            if current is None or (since and (not current or since < current)):
+                merged["ages"][key] = since
+        merged["in_flight"] += snap.get("in_flight", [])
+        merged["passes"] += snap.get("passes", [])
+    return merged
+
+
+def retire(snap):
+    """
+    The part of a snapshot which still counts once the process it came from has exited: its counters, histograms
+    and recent observations, without its gauges or live state
+
+    :param snap: snapshot as produced by snapshot(), or None
+    :return: snapshot
+    """
+    if snap is None:
+        return None
+    return {"counters": snap.get("counters", {}), "recent": snap.get("recent", {}),
+            "histograms": snap.get("histograms", {})}
+
+
+def format_counters(snap):
+    """
+    Render the counters of a snapshot as a single line, for the log
+
+    :param snap: snapshot as produced by snapshot() or merge()
+    :return: string of name{labels}=value pairs
+    """
+    parts = []
+    for (name, labels), value in sorted(snap.get("counters", {}).items()):
+        parts.append("{n}={v}".format(n=series_name(name, labels), v=value))
+    return " ".join(parts)
+
+
+def series_name(name, labels):
+    """
+    The name of a series, with its labels if it has any, e.g. deposits{account=acc1}
+
+    :param name: name of the counter or gauge
+    :param labels: its labels, as held in a snapshot
+    :return: string
+    """
+    if not labels:
+        return name
+    return "{n}{{{l}}}".format(n=name, l=",".join("{k}={v}".format(k=k, v=v) for k, v in labels))
+
+
+def percentile(values, p):
+    """
+    The p-th percentile of a list of values, by the nearest rank
+
+    :param values: the values
+    :param p: percentile, from 0 to 100
+    :return: the percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(p / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def histogram_quantile(h, q):
+    """
+    Estimate a quantile of a histogram, as the upper bound of the bucket it falls in
+
+    :param h: the histogram, from a snapshot
+    :param q: quantile, from 0 to 1
+    :return: the estimate, None if the histogram is empty, or infinity if it falls above the last bucket
+    """
+    if h["count"] == 0:
+        return None
+    rank = q * h["count"]
+    cumulative = 0
+    for bound, count in zip(h["buckets"], h["counts"]):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float("inf")
+
+
+def ages(snap, now=None):
+    """
+    The age gauges of a snapshot, as seconds elapsed
+
+    :param snap: snapshot as produced by snapshot() or merge()
+    :param now: time to measure to; by default the current time
+    :return: dict of (name, labels) to seconds, 0 where there is no age
+    """
+    now = now if now is not None else time.time()
+    return {key: max(0, now - since) if since else 0 for key, since in snap.get("ages", {}).items()}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append('{k}="{v}"'.format(k=k, v=v))
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_prometheus(snap):
+    """
+    Render a snapshot in the Prometheus text exposition format.  Counters, gauges and histograms are exported as they
+    are, the age gauges as the seconds elapsed, and the recent observations as gauges of their median, 90th
+    percentile and maximum
+
+    :param snap: snapshot as produced by snapshot() or merge()
+    :return: string
+    """
+    lines = []
+
+    def family(section, kind, suffix=""):
+        by_name = collections.OrderedDict()
+        for (name, labels), value in sorted(section.items()):
+            by_name.setdefault(name, []).append((labels, value))
+        for name, series in by_name.items():
+            metric = PROMETHEUS_PREFIX + name + suffix
+            lines.append("# TYPE {m} {k}".format(m=metric, k=kind))
+            for labels, value in series:
+                lines.append("{m}{l} {v}".format(m=metric, l=_prometheus_labels(labels), v=value))
+
+    family(snap.get("counters", {}), "counter", "_total")
+    family(snap.get("gauges", {}), "gauge")
+    family(ages(snap), "gauge", "_age_seconds")
+
+    histograms = collections.OrderedDict()
+    for (name, labels), h in sorted(snap.get("histograms", {}).items()):
+        histograms.setdefault(name, []).append((labels, h))
+    for name, series in histograms.items():
+        metric = PROMETHEUS_PREFIX + name
+        lines.append("# TYPE {m} histogram".format(m=metric))
+        for labels, h in series:
+            cumulative = 0
+            for bound, count in zip(h["buckets"], h["counts"]):
+                cumulative += count
+                lines.append("{m}_bucket{l} {v}".format(m=metric, l=_prometheus_labels(labels + (("le", bound),)),
+                                                        v=cumulative))
+            lines.append("{m}_bucket{l} {v}".format(m=metric, l=_prometheus_labels(labels + (("le", "+Inf"),)),
+                                                    v=h["count"]))
+            lines.append("{m}_sum{l} {v}".format(m=metric, l=_prometheus_labels(labels), v=h["sum"]))
+            lines.append("{m}_count{l} {v}".format(m=metric, l=_prometheus_labels(labels), v=h["count"]))
+
+    recent = collections.OrderedDict()
+    for (name, labels), values in sorted(snap.get("recent", {}).items()):
+        if not values:
+            continue
+        for q, value in (("0.5", percentile(values, 50)), ("0.9", percentile(values, 90)), ("1", max(values))):
+            recent.setdefault(name, []).append((labels + (("quantile", q),), value))
+    for name, series in recent.items():
+        metric = PROMETHEUS_PREFIX + name + "_recent"
+        lines.append("# TYPE {m} gauge".format(m=metric))
+        for labels, value in series:
+            lines.append("{m}{l} {v}".format(m=metric, l=_prometheus_labels(labels), v=value))
+
+    now = time.time()
+    in_flight = snap.get("in_flight", [])
+    lines.append("# TYPE {p}in_flight gauge".format(p=PROMETHEUS_PREFIX))
+    lines.append("{p}in_flight {v}".format(p=PROMETHEUS_PREFIX, v=len(in_flight)))
+    lines.append("# TYPE {p}in_flight_oldest_seconds gauge".format(p=PROMETHEUS_PREFIX))
+    lines.append("{p}in_flight_oldest_seconds {v}".format(
+        p=PROMETHEUS_PREFIX, v=max([now - w["started"] for w in in_flight] or [0])))
+    return "\n".join(lines) + "\n"
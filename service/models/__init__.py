@@ -19,5 +19,7 @@ you can do
 
 """
 from service.models.account import Account
-from service.models.sword import RepositoryStatus, DepositRecord, RepositoryDepositLog
-from service.models.requestnotification import RequestNotification
\ No newline at end of file
+from service.models.sword import RepositoryStatus, DepositRecord, RepositoryDepositLog, DeadLetter, DepositFilter, \
+    PassSummary
+from service.models.requestnotification import RequestNotification
+from service.models.views import AccountView, RepositoryStatusView, DepositRecordView, RequestNotificationView
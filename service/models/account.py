@@ -5,6 +5,7 @@ Model objects used to represent data from the JPER account system
 from flask_login import UserMixin
 
 from service import dao
+from service.models import views
 from octopus.lib import dataobj
 
 class Account(dataobj.DataObj, dao.AccountDAO, UserMixin):
@@ -117,3 +118,11 @@ class Account(dataobj.DataObj, dao.AccountDAO, UserMixin):
         :return:
         """
         self._set_single("repository.software", val, coerce=self._utf8_unicode())
+
+    def view(self):
+        """
+        Make a read-only snapshot of this record, for the hot paths of the deposit engine
+
+        :return: AccountView
+        """
+        return views.AccountView.of(self)
@@ -1,5 +1,6 @@
 from octopus.lib import dataobj
 from service import dao
+from service.models import views
 
 class RequestNotification(dataobj.DataObj, dao.RequestNotification):
     """
@@ -102,6 +103,14 @@ class RequestNotification(dataobj.DataObj, dao.RequestNotification):
         """
         self._set_single("status", val, coerce=dataobj.to_unicode(), allowed_values=["queued", "failed", "sent"])
 
+    def view(self):
+        """
+        Make a read-only snapshot of this record, for the hot paths of the deposit engine
+
+        :return: RequestNotificationView
+        """
+        return views.RequestNotificationView.of(self)
+
     @classmethod
     def iterate_request_notification(cls, repository_id, status='queued', size=100):
         from_count = 0
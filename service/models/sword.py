@@ -3,7 +3,8 @@ Models for representing the sword objects supporting the deposit run
 """
 
 from octopus.lib import dataobj, dates
-from service import dao
+from service import dao, bloom
+from service.models import views
 
 
 class RepositoryStatus(dataobj.DataObj, dao.RepositoryStatusDAO):
@@ -22,7 +23,8 @@ class RepositoryStatus(dataobj.DataObj, dao.RepositoryStatusDAO):
             "last_deposit_date" : "<date of analysed date of last deposited notification>",
             "status" : "<succeeding|failing|problem>",
             "retries" : <number of attempted deposits>,
-            "last_tried" : "<datestamp of last attempted deposit>"
+            "last_tried" : "<datestamp of last attempted deposit>",
+            "backlog_since" : "<created date of the notification to resume from, if the last pass ran out of quota>"
         }
     """
 
@@ -44,7 +46,8 @@ class RepositoryStatus(dataobj.DataObj, dao.RepositoryStatusDAO):
                 "last_deposit_date": {"coerce": "utcdatetime"},
                 "status": {"coerce": "unicode", "allowed_values": ["succeeding", "failing", "problem"]},
                 "retries": {"coerce": "integer"},
-                "last_tried": {"coerce": "utcdatetime"}
+                "last_tried": {"coerce": "utcdatetime"},
+                "backlog_since": {"coerce": "utcdatetime"}
             }
         }
 
@@ -141,6 +144,32 @@ class RepositoryStatus(dataobj.DataObj, dao.RepositoryStatusDAO):
         """
         self._set_single("last_tried", val, coerce=dataobj.date_str())
 
+    @property
+    def backlog_since(self):
+        """
+        Created date of the notification from which to resume processing, if the previous pass ran out of its
+        quota for this repository, as a string of the form YYYY-MM-DDTHH:MM:SSZ
+
+        :return: backlog cursor date, or None if there is no outstanding backlog
+        """
+        return self._get_single("backlog_since", coerce=dataobj.date_str())
+
+    @backlog_since.setter
+    def backlog_since(self, val):
+        """
+        Set the created date of the notification from which to resume processing on the next pass
+
+        :param val: backlog cursor date
+        """
+        self._set_single("backlog_since", val, coerce=dataobj.date_str())
+
+    @backlog_since.deleter
+    def backlog_since(self):
+        """
+        Remove the backlog cursor, which you do once the repository's backlog has been drained
+        """
+        self._delete("backlog_since")
+
     def record_failure(self, limit):
         """
         Record a failed attempt to deposit to this repository.
@@ -196,6 +225,14 @@ class RepositoryStatus(dataobj.DataObj, dao.RepositoryStatusDAO):
         self.status = "failing"
         self.retries = 0
 
+    def view(self):
+        """
+        Make a read-only snapshot of this record, for the hot paths of the deposit engine
+
+        :return: RepositoryStatusView
+        """
+        return views.RepositoryStatusView.of(self)
+
 
 class DepositRecord(dataobj.DataObj, dao.DepositRecordDAO):
     """
@@ -488,6 +525,14 @@ class DepositRecord(dataobj.DataObj, dao.DepositRecordDAO):
         comp = self.completed_status in ["deposited", "none"]
         return mds and cds and comp
 
+    def view(self):
+        """
+        Make a read-only snapshot of this record, for the hot paths of the deposit engine
+
+        :return: DepositRecordView
+        """
+        return views.DepositRecordView.of(self)
+
 
 class RepositoryDepositLog(dataobj.DataObj, dao.RepositoryDepositLogDAO):
     """
@@ -635,3 +680,460 @@ class RepositoryDepositLog(dataobj.DataObj, dao.RepositoryDepositLogDAO):
             "deposit_record": self._coerce(deposit_record, uc),
         }
         self._add_to_list("messages", obj)
+
+
+class DeadLetter(dataobj.DataObj, dao.DeadLetterDAO):
+    """
+    Class to represent a notification which will no longer be deposited to a repository in the normal run, either
+    because it has been attempted MAX_DEPOSIT_ATTEMPTS times, or because the repository rejected it in a way that
+    retrying cannot fix
+
+    Of the form:
+
+    ::
+
+        {
+            "id" : "<repository id>_<notification id>",
+            "last_updated" : "<date this record was last updated>",
+            "created_date" : "<date this record was created>",
+
+            "repo" : "<account id of the repository>",
+            "notification" : "<notification id>",
+            "reason" : "<attempts|invalidxml|payloadtoolarge>",
+            "attempts" : <number of deposit attempts made>
+        }
+    """
+
+    def __init__(self, raw=None):
+        """
+        Create a new instance of the DeadLetter object, optionally around the
+        raw python dictionary.
+
+        If supplied, the raw dictionary will be validated against the allowed structure of this
+        object, and an exception will be raised if it does not validate
+
+        :param raw: python dict object containing the metadata
+        """
+        struct = {
+            "fields": {
+                "id": {"coerce": "unicode"},
+                "last_updated": {"coerce": "utcdatetime"},
+                "created_date": {"coerce": "utcdatetime"},
+                "repo": {"coerce": "unicode"},
+                "notification": {"coerce": "unicode"},
+                "reason": {"coerce": "unicode", "allowed_values": ["attempts", "invalidxml", "payloadtoolarge"]},
+                "attempts": {"coerce": "integer"}
+            }
+        }
+
+        self._add_struct(struct)
+        super(DeadLetter, self).__init__(raw=raw)
+
+    @classmethod
+    def record(cls, repository_id, notification_id, reason, attempts=None):
+        """
+        Enter a notification into the dead letter store for the repository
+
+        :param repository_id: account id of the repository
+        :param notification_id: the notification id
+        :param reason: why the notification will not be deposited (attempts, invalidxml, payloadtoolarge)
+        :param attempts: the number of deposit attempts made so far
+        :return: the saved DeadLetter
+        """
+        dl = cls()
+        dl.id = cls.make_id(notification_id, repository_id)
+        dl.repository = repository_id
+        dl.notification = notification_id
+        dl.reason = reason
+        if attempts is not None:
+            dl.attempts = attempts
+        dl.save()
+        return dl
+
+    @property
+    def repository(self):
+        """
+        The repository account id
+
+        :return: account id
+        """
+        return self._get_single("repo", coerce=dataobj.to_unicode())
+
+    @repository.setter
+    def repository(self, val):
+        """
+        Set the repository account id
+
+        :param val: account id
+        """
+        self._set_single("repo", val, coerce=dataobj.to_unicode())
+
+    @property
+    def notification(self):
+        """
+        The notification id
+
+        :return: notification id
+        """
+        return self._get_single("notification", coerce=dataobj.to_unicode())
+
+    @notification.setter
+    def notification(self, val):
+        """
+        Set the notification id
+
+        :param val: notification id
+        """
+        self._set_single("notification", val, coerce=dataobj.to_unicode())
+
+    @property
+    def reason(self):
+        """
+        Why the notification is no longer being deposited: attempts, invalidxml or payloadtoolarge
+
+        :return: the reason
+        """
+        return self._get_single("reason", coerce=dataobj.to_unicode())
+
+    @reason.setter
+    def reason(self, val):
+        """
+        Set the reason the notification is no longer being deposited.  Must be one of "attempts", "invalidxml"
+        or "payloadtoolarge"
+
+        :param val: the reason
+        """
+        self._set_single("reason", val, coerce=dataobj.to_unicode(),
+                         allowed_values=["attempts", "invalidxml", "payloadtoolarge"])
+
+    @property
+    def attempts(self):
+        """
+        Number of deposit attempts made before the notification was given up on
+
+        :return: number of attempts
+        """
+        return self._get_single("attempts", coerce=dataobj.to_int(), default=0)
+
+    @attempts.setter
+    def attempts(self, val):
+        """
+        Set the number of deposit attempts made
+
+        :param val: number of attempts
+        """
+        self._set_single("attempts", val, coerce=dataobj.to_int())
+
+
+class DepositFilter(dataobj.DataObj, dao.DepositFilterDAO):
+    """
+    Class to persist the Bloom filter of the notifications which have been successfully deposited to a repository.
+    It has the same id as the repository's RepositoryStatus
+
+    Of the form:
+
+    ::
+
+        {
+            "id" : "<id of the repository account>",
+            "last_updated" : "<date this record was last updated>",
+            "created_date" : "<date this record was created>",
+
+            "bits" : "<base64 encoded bit array of the filter>",
+            "size" : <number of bits in the filter>,
+            "hashes" : <number of hash functions>,
+            "capacity" : <number of notification ids the filter was sized for>,
+            "count" : <number of notification ids added to the filter>,
+
+            "attempted" : {
+                "bits" : "<base64 encoded bit array of the filter of notifications with any deposit record>",
+                "size" : <number of bits in the filter>,
+                "hashes" : <number of hash functions>,
+                "count" : <number of notification ids added to the filter>
+            }
+        }
+    """
+
+    def __init__(self, raw=None):
+        """
+        Create a new instance of the DepositFilter object, optionally around the
+        raw python dictionary.
+
+        If supplied, the raw dictionary will be validated against the allowed structure of this
+        object, and an exception will be raised if it does not validate
+
+        :param raw: python dict object containing the metadata
+        """
+        struct = {
+            "fields": {
+                "id": {"coerce": "unicode"},
+                "last_updated": {"coerce": "utcdatetime"},
+                "created_date": {"coerce": "utcdatetime"},
+                "bits": {"coerce": "unicode"},
+                "size": {"coerce": "integer"},
+                "hashes": {"coerce": "integer"},
+                "capacity": {"coerce": "integer"},
+                "count": {"coerce": "integer"}
+            },
+            "objects": ["attempted"],
+            "structs": {
+                "attempted": {
+                    "fields": {
+                        "bits": {"coerce": "unicode"},
+                        "size": {"coerce": "integer"},
+                        "hashes": {"coerce": "integer"},
+                        "count": {"coerce": "integer"}
+                    }
+                }
+            }
+        }
+
+        self._add_struct(struct)
+        super(DepositFilter, self).__init__(raw=raw)
+
+    @property
+    def capacity(self):
+        """
+        Number of notification ids the filter was sized for
+
+        :return: capacity
+        """
+        return self._get_single("capacity", coerce=dataobj.to_int(), default=0)
+
+    @capacity.setter
+    def capacity(self, val):
+        """
+        Set the number of notification ids the filter was sized for
+
+        :param val: capacity
+        """
+        self._set_single("capacity", val, coerce=dataobj.to_int())
+
+    @property
+    def count(self):
+        """
+        Number of notification ids in the filter
+
+        :return: count
+        """
+        return self._get_single("count", coerce=dataobj.to_int(), default=0)
+
+    @property
+    def last_updated(self):
+        """
+        Date this record was last saved, as a string of the form YYYY-MM-DDTHH:MM:SSZ
+
+        :return: last updated date
+        """
+        return self._get_single("last_updated", coerce=dataobj.date_str())
+
+    def get_filter(self):
+        """
+        Load the Bloom filter held in this record
+
+        :return: bloom.BloomFilter
+        """
+        return bloom.BloomFilter.decode(self._get_single("size", coerce=dataobj.to_int()),
+                                        self._get_single("hashes", coerce=dataobj.to_int()),
+                                        self._get_single("bits", coerce=dataobj.to_unicode()),
+                                        count=self.count)
+
+    def set_filter(self, bf):
+        """
+        Store the Bloom filter in this record
+
+        :param bf: bloom.BloomFilter
+        """
+        self._set_single("bits", bf.encode(), coerce=dataobj.to_unicode())
+        self._set_single("size", bf.size, coerce=dataobj.to_int())
+        self._set_single("hashes", bf.hashes, coerce=dataobj.to_int())
+        self._set_single("count", bf.count, coerce=dataobj.to_int())
+
+    @property
+    def attempted_count(self):
+        """
+        Number of notification ids in the filter of attempted notifications
+
+        :return: count, or None if this record has no such filter
+        """
+        return self._get_single("attempted.count", coerce=dataobj.to_int())
+
+    def get_attempted_filter(self):
+        """
+        Load the Bloom filter of the notifications which have any deposit record, held in this record
+
+        :return: bloom.BloomFilter, or None if this record has no such filter
+        """
+        if self._get_single("attempted.bits") is None:
+            return None
+        return bloom.BloomFilter.decode(self._get_single("attempted.size", coerce=dataobj.to_int()),
+                                        self._get_single("attempted.hashes", coerce=dataobj.to_int()),
+                                        self._get_single("attempted.bits", coerce=dataobj.to_unicode()),
+                                        count=self.attempted_count)
+
+    def set_attempted_filter(self, bf):
+        """
+        Store the Bloom filter of the notifications which have any deposit record in this record
+
+        :param bf: bloom.BloomFilter
+        """
+        self._set_single("attempted.bits", bf.encode(), coerce=dataobj.to_unicode())
+        self._set_single("attempted.size", bf.size, coerce=dataobj.to_int())
+        self._set_single("attempted.hashes", bf.hashes, coerce=dataobj.to_int())
+        self._set_single("attempted.count", bf.count, coerce=dataobj.to_int())
+
+
+class PassSummary(dataobj.DataObj, dao.PassSummaryDAO):
+    """
+    Class to represent the summary of a single deposit pass (one call to deposit.run), written once at the end of the
+    pass, so that the throughput of the depositor can be followed over time
+
+    Of the form:
+
+    ::
+
+        {
+            "id" : "<opaque id of the summary>",
+            "last_updated" : "<date this record was last updated>",
+            "created_date" : "<date this record was created>",
+
+            "started" : "<date the pass started>",
+            "finished" : "<date the pass finished>",
+            "duration" : <seconds the pass took>,
+            "pid" : <id of the process which ran the pass>,
+            "partition" : "<partition of the accounts the pass covered, if run by a worker>",
+            "cut_short" : <true if the pass stopped at its deadline or was cancelled>,
+            "error" : "<the error the pass stopped with, if any>",
+
+            "accounts" : {
+                "total" : <number of accounts due in the pass>,
+                "visited" : <number processed>,
+                "skipped" : <number skipped as failing or awaiting a retry>
+            },
+            "notifications" : {
+                "listed" : <number listed by JPER>,
+                "skipped" : <number skipped as already deposited or given up on>,
+                "deposited" : <number deposited>,
+                "failed" : <number which failed to deposit>
+            },
+            "bytes" : {
+                "downloaded" : <content bytes downloaded from JPER>,
+                "uploaded" : <bytes sent to the repositories>,
+                "received" : <bytes received from the repositories>
+            },
+            "requests" : {
+                "es" : <requests to the index>,
+                "jper" : <requests to JPER>,
+                "sword" : <requests to the repositories>
+            },
+            "slowest_accounts" : [
+                {"account" : "<account id>", "seconds" : <time spent on it>, "deposits" : <number deposited>}
+            ]
+        }
+    """
+
+    def __init__(self, raw=None):
+        """
+        Create a new instance of the PassSummary object, optionally around the
+        raw python dictionary.
+
+        If supplied, the raw dictionary will be validated against the allowed structure of this
+        object, and an exception will be raised if it does not validate
+
+        :param raw: python dict object containing the metadata
+        """
+        struct = {
+            "fields": {
+                "id": {"coerce": "unicode"},
+                "last_updated": {"coerce": "utcdatetime"},
+                "created_date": {"coerce": "utcdatetime"},
+                "started": {"coerce": "utcdatetime"},
+                "finished": {"coerce": "utcdatetime"},
+                "duration": {"coerce": "float"},
+                "pid": {"coerce": "integer"},
+                "partition": {"coerce": "unicode"},
+                "cut_short": {"coerce": "bool"},
+                "error": {"coerce": "unicode"}
+            },
+            "objects": ["accounts", "notifications", "bytes", "requests"],
+            "lists": {
+                "slowest_accounts": {"contains": "object"}
+            },
+            "structs": {
+                "accounts": {
+                    "fields": {
+                        "total": {"coerce": "integer"},
+                        "visited": {"coerce": "integer"},
+                        "skipped": {"coerce": "integer"}
+                    }
+                },
+                "notifications": {
+                    "fields": {
+                        "listed": {"coerce": "integer"},
+                        "skipped": {"coerce": "integer"},
+                        "deposited": {"coerce": "integer"},
+                        "failed": {"coerce": "integer"}
+                    }
+                },
+                "bytes": {
+                    "fields": {
+                        "downloaded": {"coerce": "integer"},
+                        "uploaded": {"coerce": "integer"},
+                        "received": {"coerce": "integer"}
+                    }
+                },
+                "requests": {
+                    "fields": {
+                        "es": {"coerce": "integer"},
+                        "jper": {"coerce": "integer"},
+                        "sword": {"coerce": "integer"}
+                    }
+                },
+                "slowest_accounts": {
+                    "fields": {
+                        "account": {"coerce": "unicode"},
+                        "seconds": {"coerce": "float"},
+                        "deposits": {"coerce": "integer"}
+                    }
+                }
+            }
+        }
+
+        self._add_struct(struct)
+        super(PassSummary, self).__init__(raw=raw)
+
+    @property
+    def started(self):
+        """
+        Date the pass started, as a string of the form YYYY-MM-DDTHH:MM:SSZ
+
+        :return: start date
+        """
+        return self._get_single("started", coerce=dataobj.date_str())
+
+    @property
+    def duration(self):
+        """
+        Time the pass took
+
+        :return: seconds
+        """
+        return self._get_single("duration")
+
+    @property
+    def notifications(self):
+        """
+        The numbers of notifications listed, skipped, deposited and failed in the pass
+
+        :return: dict
+        """
+        return self._get_single("notifications", default={})
+
+    @property
+    def slowest_accounts(self):
+        """
+        The accounts which took longest in the pass, slowest first
+
+        :return: list of dicts of the account id, seconds and number of deposits
+        """
+        return self._get_list("slowest_accounts")
@@ -0,0 +1,96 @@
+"""
+Read-only snapshots of the model objects, for use on the hot paths of the deposit engine.
+
+Every property read on a DataObj walks its data and coerces the value, which adds up over a pass which reads the
+same account properties for each of thousands of notifications.  A view is built once, with each field read and
+coerced a single time, and thereafter its fields are plain slot attributes.
+
+Views are immutable: anything which needs to change the record must use the model object itself.
+"""
+
+
+class ModelView(object):
+    """
+    Base class for the views.  Each subclass lists the model properties it captures in its __slots__
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for f in self.__slots__:
+            object.__setattr__(self, f, kwargs.get(f))
+
+    @classmethod
+    def of(cls, obj):
+        """
+        Make a view of the model object, reading each field from its properties.  If obj is already a view, it is
+        returned as-is
+
+        :param obj: the model object
+        :return: the view
+        """
+        if isinstance(obj, cls):
+            return obj
+        return cls(**{f: getattr(obj, f) for f in cls.__slots__})
+
+    def __setattr__(self, key, value):
+        raise AttributeError("{x} is read-only".format(x=type(self).__name__))
+
+    def __delattr__(self, key):
+        raise AttributeError("{x} is read-only".format(x=type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, f) for f in self.__slots__))
+
+    def __repr__(self):
+        return "<{x} {y}>".format(x=type(self).__name__, y=getattr(self, "id", None))
+
+
+class AccountView(ModelView):
+    """
+    View of an Account, with the fields used to make deposits
+    """
+    __slots__ = ("id", "email", "api_key", "packaging", "sword_collection", "sword_username", "sword_password",
+                 "sword_deposit_method", "repository_software")
+
+    @classmethod
+    def of(cls, obj):
+        view = super(AccountView, cls).of(obj)
+        if isinstance(view.packaging, list):
+            object.__setattr__(view, "packaging", tuple(view.packaging))
+        return view
+
+
+class RepositoryStatusView(ModelView):
+    """
+    View of a RepositoryStatus
+    """
+    __slots__ = ("id", "status", "last_deposit_date", "retries", "last_tried", "backlog_since")
+
+
+class DepositRecordView(ModelView):
+    """
+    View of a DepositRecord
+    """
+    __slots__ = ("id", "repository", "notification", "deposit_date", "metadata_status", "content_status",
+                 "completed_status")
+
+    def was_successful(self):
+        """
+        Determine whether this was a successful deposit, as DepositRecord.was_successful
+
+        :return: True if successful, False if not
+        """
+        mds = self.metadata_status == "deposited"
+        cds = self.content_status in ["deposited", "none"]
+        comp = self.completed_status in ["deposited", "none"]
+        return mds and cds and comp
+
+
+class RequestNotificationView(ModelView):
+    """
+    View of a RequestNotification
+    """
+    __slots__ = ("id", "account_id", "notification_id", "deposit_id", "status")
@@ -0,0 +1,223 @@
+"""
+On-demand profiling of the runner (and of each worker), triggered by signals, so that a slow pass can be looked into
+without restarting the process under a profiler.
+
+* SIGUSR1 profiles the next PROFILE_PASSES passes (sending it again stops after the pass in hand).  Each profiled
+  pass is run under cProfile, while a background thread samples the stack of the thread running it every
+  PROFILE_SAMPLE_INTERVAL seconds.  At the end of the pass, the cProfile statistics are written to a .pstats file
+  (for python -m pstats or snakeviz), and the samples to a .collapsed file, one line per distinct stack with the
+  number of times it was seen (for flamegraph.pl or speedscope)
+* SIGUSR2 writes the stack of every thread, and the notifications in flight, to a dump file.  The first SIGUSR2 also
+  starts tracemalloc; each one after that adds the PROFILE_MEMORY_TOP lines of code holding the most memory, and
+  the change since the previous dump
+
+The files are written to PROFILE_DIR, named after the process id and the time.  With several workers, the
+supervisor passes both signals on to its workers (and dumps its own stacks on SIGUSR2).
+
+Nothing is imported or started until a signal is received, so the hooks cost nothing otherwise.
+"""
+import os, signal, sys, threading, time
+from contextlib import contextmanager
+from octopus.core import app
+from service import metrics
+
+_remaining = 0
+_memory = None
+_forward = None
+
+
+def install(forward=None):
+    """
+    Install the signal handlers in this process
+
+    :param forward: function to call with each signal, to pass it on (e.g. Supervisor.signal_workers); a process
+        which passes the signals on does not profile its own passes
+    """
+    global _remaining, _forward
+    _remaining = 0
+    _forward = forward
+    signal.signal(signal.SIGUSR1, _on_toggle)
+    signal.signal(signal.SIGUSR2, _on_dump)
+
+
+def _on_toggle(signum, frame):
+    if _forward is not None:
+        _forward(signum)
+        return
+    toggle()
+
+
+def _on_dump(signum, frame):
+    if _forward is not None:
+        _forward(signum)
+    # the dump is written from another thread, so that the one interrupted is left undisturbed
+    threading.Thread(target=dump, name="profiling-dump", daemon=True).start()
+
+
+def toggle():
+    """
+    Start profiling the next PROFILE_PASSES passes, or if they are already being profiled, stop after the pass in hand
+    """
+    global _remaining
+    if _remaining > 0:
+        _remaining = 0
+        app.logger.info("Profiling will stop at the end of the pass in hand")
+    else:
+        _remaining = app.config.get("PROFILE_PASSES", 1)
+        app.logger.info("Profiling the next {x} pass(es) into {y}".format(x=_remaining, y=_directory()))
+
+
+def profiling():
+    """
+    Will the next pass be profiled
+
+    :return: True if it will
+    """
+    return _remaining > 0
+
+
+def _directory():
+    return app.config.get("PROFILE_DIR") or os.path.join(os.getcwd(), "profiles")
+
+
+def _path(kind, ext):
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    return os.path.join(_directory(), "{k}-{p}-{t}.{e}".format(k=kind, p=os.getpid(), t=stamp, e=ext))
+
+
+class _Sampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval, counting each distinct stack
+    """
+
+    def __init__(self, ident, interval):
+        super(_Sampler, self).__init__(name="profiling-sampler", daemon=True)
+        self.target = ident
+        self.interval = interval
+        self.counts = {}
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{f} ({m}:{l})".format(f=code.co_name, m=os.path.basename(code.co_filename),
+                                                     l=code.co_firstlineno))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("{s} {c}\n".format(s=stack, c=count))
+
+
+@contextmanager
+def pass_profile():
+    """
+    Context manager around a pass, which profiles it if profiling has been switched on (see toggle())
+    """
+    global _remaining
+    if _remaining <= 0:
+        yield
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    sampler = _Sampler(threading.get_ident(), app.config.get("PROFILE_SAMPLE_INTERVAL", 0.01))
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # another profiler (e.g. a debugger) is already attached
+        app.logger.error("Unable to profile the pass - {x}".format(x=str(e)))
+        _remaining = 0
+        yield
+        return
+    sampler.start()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        _remaining = max(0, _remaining - 1)
+        _write_profile(profiler, sampler)
+
+
+def _write_profile(profiler, sampler):
+    try:
+        os.makedirs(_directory(), exist_ok=True)
+        stats = _path("pass", "pstats")
+        collapsed = stats[:-len("pstats")] + "collapsed"
+        profiler.dump_stats(stats)
+        sampler.write(collapsed)
+    except OSError as e:
+        app.logger.error("Unable to write the profile of the pass - {x}".format(x=str(e)))
+        return
+    metrics.incr("profiles_written")
+    app.logger.info("Profile of the pass written to {x} and {y}{z}".format(
+        x=stats, y=collapsed, z="" if _remaining > 0 else "; profiling stopped"))
+
+
+def dump():
+    """
+    Write the stack of every thread, and the notifications in flight, to a dump file, along with the lines of code
+    holding the most memory if tracemalloc has been started by an earlier dump (otherwise, start it)
+
+    :return: the path of the dump file, or None if it could not be written
+    """
+    global _memory
+    import traceback, tracemalloc
+    names = {t.ident: t.name for t in threading.enumerate()}
+    lines = ["Dump of process {x} at {y}".format(x=os.getpid(), y=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+             ""]
+
+    lines.append("In flight:")
+    for work in metrics.snapshot()["in_flight"]:
+        lines.append("  Account:{x} Notification:{y} stage {z}, for {s:.1f}s".format(
+            x=work["account"], y=work["notification"], z=work["stage"], s=time.time() - work["started"]))
+    lines.append("")
+
+    for ident, frame in sys._current_frames().items():
+        if names.get(ident) == "profiling-dump":
+            continue
+        lines.append("Thread {x} ({y}):".format(x=names.get(ident, "unknown"), y=ident))
+        lines.extend(l.rstrip("\n") for l in traceback.format_stack(frame))
+        lines.append("")
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        lines.append("Memory: tracemalloc started; send SIGUSR2 again for the allocations since now")
+    else:
+        top = app.config.get("PROFILE_MEMORY_TOP", 25)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append("Memory: {x} bytes traced, peak {y}; top {z} lines:".format(x=current, y=peak, z=top))
+        lines.extend("  " + str(s) for s in snapshot.statistics("lineno")[:top])
+        if _memory is not None:
+            lines.append("")
+            lines.append("Change since the previous dump:")
+            lines.extend("  " + str(s) for s in snapshot.compare_to(_memory, "lineno")[:top])
+        _memory = snapshot
+
+    try:
+        os.makedirs(_directory(), exist_ok=True)
+        path = _path("dump", "txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    except OSError as e:
+        app.logger.error("Unable to write the stack dump - {x}".format(x=str(e)))
+        return None
+    app.logger.info("Stack dump written to {x}".format(x=path))
+    return path
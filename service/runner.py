@@ -3,25 +3,26 @@ Main script which executes the run cycle.
 
 It will start and remain running until it is shut-down externally, and will execute the deposit.run method
 repeatedly.
+
+With --workers N (or the WORKERS configuration) greater than 1, it will instead start a supervisor which forks N
+worker processes, each running the deposit cycle over its own partition of the accounts.
+
+SIGTERM or SIGINT stops the runner once the deposit in hand has finished, and SIGHUP reloads its configuration (see
+service.lifecycle).  SIGUSR1 profiles the next pass, and SIGUSR2 dumps the stacks of all its threads (see
+service.profiling).
 """
 from octopus.core import app, initialise, add_configuration
-import logging
-from logging import Formatter
 from logging.handlers import RotatingFileHandler
 
+# written at LOG_LEVEL, with the format set by LOG_FORMAT (see service.logs)
 file_handler = RotatingFileHandler('jperswordoutlog', maxBytes=1000000000, backupCount=5)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(Formatter(
-    '%(asctime)s %(levelname)s: %(message)s '
-    '[in %(pathname)s:%(lineno)d %(module)s %(funcName)s]'
-))
-app.logger.addHandler(file_handler)
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--debug", action="store_true", help="pycharm debug support enable")
     parser.add_argument("-c", "--config", help="additional configuration to load (e.g. for testing)")
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes to run the deposit cycle in")
     args = parser.parse_args()
 
     if args.config:
@@ -39,13 +40,38 @@ if __name__ == "__main__":
 
     initialise()
 
+    # the log is written by a listener thread (and with several workers, by the supervisor alone), so that
+    # formatting and writing it, and rotating the file, do not hold up the deposits
+    from service import logs
+    logs.start(file_handler)
+
+    import sys
+    from service import tmpstore, journal, lifecycle, status, profiling, watchdog
+
+    lifecycle.install(args.config)
+    profiling.install()
+
+    workers = args.workers if args.workers is not None else app.config.get("WORKERS", 1)
+    if workers > 1:
+        from service import supervisor
+        supervisor.Supervisor(workers).run()
+        sys.exit(0)
+
     from service import deposit
-    import time, sys
+
+    # clear up anything left in the temp store by a previous run, and review the deposits it left in flight
+    tmpstore.sweep()
+    journal.recover()
+    status.serve()
+    watchdog.start()
 
     col_counter = 0
-    while True:
+    while not lifecycle.stopping():
         app.logger.info("Starting SWORDv2 Runner")
-        deposit.run(fail_on_error=True)
+        lifecycle.maybe_reload()
+        tmpstore.maybe_sweep()
+        with profiling.pass_profile():
+            deposit.run(fail_on_error=True, token=lifecycle.pass_token())
 
         print(".", end=' ')
         sys.stdout.flush()
@@ -54,4 +80,7 @@ if __name__ == "__main__":
             print("")
             col_counter = 0
 
-        time.sleep(app.config.get("RUN_THROTTLE"))
+        lifecycle.sleep(app.config.get("RUN_THROTTLE"))
+
+    status.stop()
+    lifecycle.shutdown()
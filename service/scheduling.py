@@ -0,0 +1,104 @@
+"""
+Fair-share scheduling of the accounts within a deposit pass.
+
+Each account is given a per-pass quota, capped by a number of deposits and by wall time, and scaled by an
+optional per-account weight.  When an account exhausts its quota, process_account records a cursor on the
+account's RepositoryStatus and resumes from there on the next pass, so one account's large backlog is drained
+over several passes rather than delaying every other account behind it.
+"""
+import time
+from octopus.core import app
+
+_turn = 0
+_resume_at = None
+
+
+def weight(account_id):
+    """
+    Get the scheduling weight for the account, from the ACCOUNT_QUOTA_WEIGHTS configuration
+
+    :param account_id: the account id
+    :return: the weight; 1 if none is configured
+    """
+    weights = app.config.get("ACCOUNT_QUOTA_WEIGHTS") or {}
+    return weights.get(account_id, 1)
+
+
+def rotate(accs):
+    """
+    Rotate the order of the accounts by one place on each pass, so that no account is always served first
+
+    :param accs: list of accounts in their natural order
+    :return: the rotated list
+    """
+    global _turn, _resume_at
+    if len(accs) == 0:
+        return accs
+    ids = [acc.id for acc in accs] if _resume_at is not None else []
+    if _resume_at in ids:
+        # the previous pass stopped early, so start where it stopped
+        offset = ids.index(_resume_at)
+        _turn = offset + 1
+    else:
+        offset = _turn % len(accs)
+        _turn += 1
+    _resume_at = None
+    return accs[offset:] + accs[:offset]
+
+
+def resume_at(account_id):
+    """
+    Start the next pass with the given account, because this pass stopped before (or while) serving it
+
+    :param account_id: the account id
+    """
+    global _resume_at
+    _resume_at = account_id
+
+
+class AccountQuota(object):
+    """
+    The share of a single pass which one account is allowed to use
+    """
+
+    def __init__(self, deposits=None, seconds=None):
+        """
+        :param deposits: maximum number of successful deposits in this pass; None or 0 for no limit
+        :param seconds: maximum wall time to spend on the account in this pass; None or 0 for no limit
+        """
+        self.deposits = deposits
+        self.seconds = seconds
+        self.used = 0
+        self.started = time.monotonic()
+
+    @classmethod
+    def for_account(cls, account_id):
+        """
+        Create the quota for the account from configuration, scaled by the account's weight
+
+        :param account_id: the account id
+        :return: AccountQuota
+        """
+        w = weight(account_id)
+        deposits = app.config.get("ACCOUNT_PASS_DEPOSIT_QUOTA")
+        seconds = app.config.get("ACCOUNT_PASS_TIME_QUOTA")
+        return cls(deposits=int(deposits * w) if deposits else None,
+                   seconds=seconds * w if seconds else None)
+
+    def record_deposit(self):
+        """
+        Count a deposit against the quota
+        """
+        self.used += 1
+
+    def exhausted(self):
+        """
+        Has the account used up its share of this pass
+
+        :return: True if no further notifications should be processed for the account in this pass
+        """
+        if self.deposits and self.used >= self.deposits:
+            return True
+        if self.seconds and time.monotonic() - self.started >= self.seconds:
+            return True
+        return False
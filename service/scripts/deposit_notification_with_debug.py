@@ -5,6 +5,7 @@ from octopus.modules.swordv2 import client_http
 from octopus.lib import dates
 from service import models
 from service.deposit import _cache_content
+from service.deposit_plan import DepositPlan
 
 def deposit_notification_with_debug(account_id, notification_id):
     print("Notification: %s" % notification_id)
@@ -15,9 +16,8 @@ def deposit_notification_with_debug(account_id, notification_id):
 
     deposit_done = False
 
-    deposit_method = 'single zip file'
-    if acc.sword_deposit_method == 'individual files':
-        deposit_method = acc.sword_deposit_method
+    plan = DepositPlan.for_account(acc)
+    deposit_method = plan.deposit_method
     print("Deposit method: %s" % deposit_method)
     if deposit_method != 'single zip file':
         print(f"Deposit method for this account is: {deposit_method}")
@@ -29,12 +29,8 @@ def deposit_notification_with_debug(account_id, notification_id):
     # work out if there is a content object to be deposited
     # which means asking the note if there's a content link with a package format supported
     # by the repository
-    link = None
-    packaging = None
-    for p in acc.packaging:
-        link = note.get_package_link(p)
-        if link is not None:
-            packaging = p
+    link = plan.link_for(note)
+    packaging = plan.packaging
 
     print(f"Link is {link}")
     print(f"packaging is {packaging}")
@@ -58,11 +54,8 @@ def deposit_notification_with_debug(account_id, notification_id):
     # make a copy of the tmp store for removing the content later
     tmp = store.StoreFactory.tmp()
 
-    if "opus4" in str(packaging).lower() or "escidoc" in str(packaging).lower():
-        if "opus4" in str(packaging).lower():
-            packaging = None
-        elif "escidoc" in str(packaging).lower():
-            packaging = "http://purl.org/escidoc/metadata/schemas/0.1/publication"
+    if plan.zip_packaging != packaging:
+        packaging = plan.zip_packaging
         print(f"packaging is changed to {packaging}")
 
     # Not checking deposit record exists
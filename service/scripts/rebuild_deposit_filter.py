@@ -0,0 +1,27 @@
+"""
+Script which rebuilds the deposit filter of one or all of the sword-enabled repositories from their deposit records
+"""
+from octopus.core import app, add_configuration
+from service import models
+from service.deposit_filter import AccountDepositFilter
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c", "--config", help="additional configuration to load (e.g. for testing)")
+    parser.add_argument("-r", "--repo", help="id of the repository account to rebuild the filter for.  If omitted, the filters of all the sword-enabled repositories are rebuilt")
+
+    args = parser.parse_args()
+
+    if args.config:
+        add_configuration(app, args.config)
+
+    if args.repo:
+        ids = [args.repo]
+    else:
+        ids = [acc.id for acc in models.Account.with_sword_activated()]
+
+    for acc_id in ids:
+        adf = AccountDepositFilter.rebuild(acc_id)
+        print("Rebuilt deposit filter for {x}: {y} notifications".format(x=acc_id, y=adf.filter.count))
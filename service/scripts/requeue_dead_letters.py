@@ -0,0 +1,33 @@
+"""
+Script which lists a repository's dead letters (notifications which are no longer being deposited), or queues
+some or all of them for deposit again
+"""
+from octopus.core import app, add_configuration
+from service import control, models
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c", "--config", help="additional configuration to load (e.g. for testing)")
+    parser.add_argument("-r", "--repo", help="id of the repository account to affect")
+    parser.add_argument("-n", "--notification", action="append", help="id of a notification to requeue; may be given more than once.  If omitted, all of the repository's dead letters are requeued")
+    parser.add_argument("-l", "--list", help="list the repository's dead letters instead of requeueing them", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.config:
+        add_configuration(app, args.config)
+
+    if not args.repo:
+        parser.print_help()
+        exit(0)
+
+    if args.list:
+        print("notification,reason,attempts,created_date")
+        for dl in models.DeadLetter.iterate_by_repository(args.repo):
+            print("{a},{b},{c},{d}".format(a=dl.notification, b=dl.reason, c=dl.attempts, d=dl.created_date))
+        exit(0)
+
+    count = control.requeue_dead_letters(args.repo, args.notification)
+    print("Requeued {x} notifications for {y}".format(x=count, y=args.repo))
@@ -0,0 +1,300 @@
+"""
+Settings which can be changed while the depositor is running, without a restart.
+
+Between passes, the runner (and each worker) checks whether the configuration files (config/service.py, local.cfg
+and the file given with --config) have been modified, or whether it has been sent SIGHUP (see service.lifecycle).
+If so, the files are read again, and every setting which has been changed in them is checked:
+
+* a setting registered here as reloadable must pass its validator
+* any other setting is left as it is, with a warning that it needs a restart to take effect
+
+If any change is invalid, none of them is applied, and the error is logged; otherwise they are all applied together,
+so that the next pass sees either the old settings or the new ones, never a mixture.
+
+The code which uses a reloadable setting must read it from app.config each time it is needed, rather than once at
+startup.  New settings are made reloadable with register().
+"""
+import os, types
+from octopus.core import app
+from octopus.lib import paths, dates
+from service import metrics
+
+_reloadable = {}
+_extra = None
+_loaded = {}
+_mtimes = {}
+
+
+def register(name, validator):
+    """
+    Make a setting reloadable
+
+    :param name: name of the setting
+    :param validator: function which takes the new value, and raises ValueError if it is not acceptable
+    """
+    _reloadable[name] = validator
+
+
+def reloadable():
+    """
+    The names of the reloadable settings
+
+    :return: sorted list of names
+    """
+    return sorted(_reloadable.keys())
+
+
+def number(minimum=0, integer=False, optional=False):
+    """
+    Validator for a numeric setting
+
+    :param minimum: the smallest acceptable value
+    :param integer: whether the value must be a whole number
+    :param optional: whether the value may be None (e.g. for no limit)
+    :return: validator function
+    """
+    def validate(value):
+        if value is None and optional:
+            return
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+            raise ValueError("must be {x}".format(x="a whole number" if integer else "a number"))
+        if value < minimum:
+            raise ValueError("must be at least {x}".format(x=minimum))
+    return validate
+
+
+def boolean(value):
+    """
+    Validator for a True/False setting
+    """
+    if not isinstance(value, bool):
+        raise ValueError("must be True or False")
+
+
+def one_of(*options):
+    """
+    Validator for a setting with a fixed set of values
+
+    :param options: the acceptable values
+    :return: validator function
+    """
+    def validate(value):
+        if value not in options:
+            raise ValueError("must be one of {x}".format(x=", ".join(repr(o) for o in options)))
+    return validate
+
+
+def budgets(value):
+    """
+    Validator for WATCHDOG_STAGE_BUDGETS: a dict of stages to positive numbers of seconds, or None for no limit
+    """
+    if not isinstance(value, dict):
+        raise ValueError("must be a dict of stages to seconds")
+    for k, v in value.items():
+        if v is not None and (isinstance(v, bool) or not isinstance(v, (int, float)) or v <= 0):
+            raise ValueError("budget for {x} must be a positive number or None".format(x=k))
+
+
+def date(value):
+    """
+    Validator for a date setting, in the format used by JPER
+    """
+    try:
+        dates.parse(value)
+    except (TypeError, ValueError):
+        raise ValueError("must be a date such as 1970-01-01T00:00:00Z")
+
+
+def weights(value):
+    """
+    Validator for ACCOUNT_QUOTA_WEIGHTS: a dict of account ids to positive numbers
+    """
+    if not isinstance(value, dict):
+        raise ValueError("must be a dict of account ids to weights")
+    for k, v in value.items():
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or v <= 0:
+            raise ValueError("weight for {x} must be a positive number".format(x=k))
+
+
+# deposit cycle and retries
+register("RUN_THROTTLE", number())
+register("LONG_CYCLE_RETRY_DELAY", number(integer=True))
+register("LONG_CYCLE_RETRY_LIMIT", number(integer=True))
+register("MAX_DEPOSIT_ATTEMPTS", number(minimum=1, integer=True))
+register("DEFAULT_SINCE_DELTA_DAYS", number(integer=True))
+register("DEFAULT_SINCE_DATE", date)
+register("WORKER_RESTART_DELAY", number())
+
+# time limits
+register("PASS_DEADLINE", number(optional=True))
+register("DOWNLOAD_TIMEOUT", number(optional=True))
+register("SWORD_TIMEOUT", number(optional=True))
+register("SHUTDOWN_GRACE_PERIOD", number(optional=True))
+register("WATCHDOG_INTERVAL", number(minimum=1))
+register("WATCHDOG_ABORT", boolean)
+register("WATCHDOG_STAGE_BUDGETS", budgets)
+
+# profiling
+register("PROFILE_PASSES", number(minimum=1, integer=True))
+register("PROFILE_SAMPLE_INTERVAL", number(minimum=0.001))
+register("PROFILE_MEMORY_TOP", number(minimum=1, integer=True))
+
+# fair-share scheduling
+register("ACCOUNT_PASS_DEPOSIT_QUOTA", number(integer=True, optional=True))
+register("ACCOUNT_PASS_TIME_QUOTA", number(optional=True))
+register("ACCOUNT_QUOTA_WEIGHTS", weights)
+
+# temp store and content handling
+register("SPOOL_CONTENT_THRESHOLD", number(integer=True, optional=True))
+register("TMP_STORE_MAX_AGE", number(optional=True))
+register("TMP_STORE_SWEEP_INTERVAL", number(optional=True))
+register("TMP_STORE_QUOTA", number(integer=True, optional=True))
+register("TMP_STORE_MIN_FREE", number(integer=True, optional=True))
+register("TMP_STORE_WAIT", number())
+
+# pass summaries
+register("PASS_SUMMARY_ENABLE", boolean)
+register("PASS_SUMMARY_SLOWEST_ACCOUNTS", number(integer=True))
+
+# repository deposits
+register("STORE_RESPONSE_DATA", boolean)
+register("EPRINTS_SEND_XML_FILE", boolean)
+register("XWALK_ENGINE", one_of("dom", "stream"))
+register("XWALK_CACHE_SIZE", number(integer=True))
+register("DEPOSIT_FILTER_AUTHORITATIVE", boolean)
+
+
+def config_files():
+    """
+    The configuration files which are watched, in the order they are applied
+
+    :return: list of paths
+    """
+    files = [paths.rel2abs(__file__, "..", "config", "service.py"), paths.rel2abs(__file__, "..", "local.cfg")]
+    if _extra is not None:
+        files.append(_extra)
+    return files
+
+
+def _mtime(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def read(files=None):
+    """
+    Read the settings from the configuration files, in the same way as the application does at startup, but
+    without applying them
+
+    :param files: the files to read; by default config_files()
+    :return: dict of the settings, with the later files taking precedence
+    """
+    values = {}
+    for path in files if files is not None else config_files():
+        if not os.path.exists(path):
+            continue
+        d = types.ModuleType("config")
+        d.__file__ = path
+        with open(path, "rb") as f:
+            exec(compile(f.read(), path, "exec"), d.__dict__)
+        values.update({k: v for k, v in d.__dict__.items() if k.isupper()})
+    return values
+
+
+def init(config=None):
+    """
+    Start watching the configuration files, from the settings they hold now
+
+    :param config: path of the additional configuration file given on the command line, if any
+    """
+    global _extra, _loaded, _mtimes
+    if config is not None:
+        _extra = config
+    _mtimes = {path: _mtime(path) for path in config_files()}
+    try:
+        _loaded = read()
+    except Exception as e:
+        app.logger.error("Unable to read the configuration files to watch them: {x}".format(x=str(e)))
+        _loaded = {}
+
+
+def watching():
+    """
+    Has init() been called in this process (or the process it was forked from)
+
+    :return: True if the configuration files are being watched
+    """
+    return len(_mtimes) > 0
+
+
+def changed():
+    """
+    Have any of the configuration files been modified since they were last read
+
+    :return: True if they have
+    """
+    return any(_mtime(path) != _mtimes.get(path) for path in config_files())
+
+
+def validate(changes):
+    """
+    Check a set of changed settings
+
+    :param changes: dict of the settings which have changed, and their new values
+    :return: tuple of (dict of the reloadable changes, list of the names which need a restart, list of errors)
+    """
+    apply, restart, errors = {}, [], []
+    for name, value in changes.items():
+        validator = _reloadable.get(name)
+        if validator is None:
+            restart.append(name)
+            continue
+        try:
+            validator(value)
+        except ValueError as e:
+            errors.append("{x} {y} (got {z!r})".format(x=name, y=str(e), z=value))
+            continue
+        apply[name] = value
+    return apply, sorted(restart), errors
+
+
+def maybe_reload(force=False):
+    """
+    Read the configuration files again if they have been modified (or if forced, e.g. on SIGHUP), and apply the
+    changed settings if they are all valid.  This must only be called between passes
+
+    :param force: read the files even if they do not appear to have been modified
+    :return: True if any settings were changed, False if not
+    """
+    global _loaded, _mtimes
+    if not force and not changed():
+        return False
+    _mtimes = {path: _mtime(path) for path in config_files()}
+    try:
+        current = read()
+    except Exception as e:
+        metrics.incr("config_reload_failures")
+        app.logger.error("Not reloading configuration - unable to read it: {x}".format(x=str(e)))
+        return False
+
+    changes = {k: v for k, v in current.items() if k not in _loaded or _loaded[k] != v}
+    apply, restart, errors = validate(changes)
+    if len(errors) > 0:
+        metrics.incr("config_reload_failures")
+        app.logger.error("Not reloading configuration - {x}".format(x="; ".join(errors)))
+        return False
+    _loaded = current
+
+    if len(restart) > 0:
+        app.logger.warning("Configuration changes which need a restart to take effect: {x}".format(
+            x=", ".join(restart)))
+    if len(apply) == 0:
+        return False
+    app.config.update(apply)
+    metrics.incr("config_reloads")
+    app.logger.info("Reloaded configuration: {x}".format(
+        x=", ".join("{k}={v!r}".format(k=k, v=v) for k, v in sorted(apply.items()))))
+    return True
@@ -0,0 +1,195 @@
+"""
+Read-only HTTP status server, which shows what the depositor is doing without a trip through the log.
+
+It is run in a background thread of the runner (or of the supervisor, which serves the figures aggregated from its
+workers), on STATUS_HOST:PORT, and has two endpoints:
+
+* /status - the deposits in flight and the stage each is in, the progress of the current pass, the backlog of each
+  account, the lag of the deposits, the hit rates of the caches, the depths of the queues and the recent latency of
+  each stage, as JSON
+* /metrics - the counters, gauges and histograms, and the stage latencies, in the Prometheus text format
+
+Everything is read from the metrics held in memory (see service.metrics), so a request makes no requests to the
+index or to JPER.
+"""
+import datetime, threading, time
+from flask import Blueprint, Response, jsonify
+from werkzeug.serving import make_server
+from octopus.core import app
+from octopus.lib import dates
+from service import metrics
+
+blueprint = Blueprint("status", __name__)
+
+_source = metrics.snapshot
+_server = None
+
+CACHES = {
+    "xwalk": ("xwalk_cache_hits", "xwalk_cache_misses"),
+    # a negative from the deposit filter is the hit: it saves a look up in the index
+    "deposit_filter": ("deposit_filter_negatives", "deposit_filter_positives")
+}
+"""the caches to report, with the counters of their hits and misses"""
+
+
+@blueprint.route("/status")
+def status_document():
+    return jsonify(document(_source()))
+
+
+@blueprint.route("/metrics")
+def prometheus():
+    return Response(metrics.format_prometheus(_source()), mimetype="text/plain; version=0.0.4")
+
+
+def _series(section, name):
+    return {labels: value for (n, labels), value in section.items() if n == name}
+
+
+def _date(timestamp):
+    if not timestamp:
+        return None
+    return dates.format(datetime.datetime.utcfromtimestamp(timestamp))
+
+
+def _lag(h):
+    if h is None or h["count"] == 0:
+        return None
+    lag = {"deposits": h["count"], "mean_seconds": round(h["sum"] / h["count"], 3)}
+    for name, q in (("p50_seconds", 0.5), ("p90_seconds", 0.9), ("p99_seconds", 0.99)):
+        # the upper bound of the bucket the quantile falls in (JSON has no infinity)
+        bound = metrics.histogram_quantile(h, q)
+        lag[name] = "+Inf" if bound == float("inf") else bound
+    return lag
+
+
+def document(snap):
+    """
+    Build the status document from a metrics snapshot
+
+    :param snap: snapshot as produced by metrics.snapshot() or metrics.merge()
+    :return: dict
+    """
+    now = time.time()
+    counters = snap.get("counters", {})
+    gauges = snap.get("gauges", {})
+
+    in_flight = []
+    for w in sorted(snap.get("in_flight", []), key=lambda w: w["started"]):
+        in_flight.append({
+            "account": w["account"],
+            "notification": w["notification"],
+            "pid": w.get("pid"),
+            "stage": w["stage"],
+            "running_seconds": round(now - w["started"], 3),
+            "stage_seconds": round(now - w["stage_started"], 3)
+        })
+
+    passes = []
+    for p in snap.get("passes", []):
+        passes.append({
+            "pid": p.get("pid"),
+            "started": _date(p.get("started")),
+            "finished": _date(p.get("finished")),
+            "elapsed_seconds": round((p.get("finished") or now) - p["started"], 3) if p.get("started") else None,
+            "accounts": p.get("accounts"),
+            "accounts_done": p.get("accounts_done"),
+            "account": p.get("account")
+        })
+
+    accounts = {}
+    undelivered = _series(snap.get("ages", {}), "account_max_undelivered")
+    lags = _series(snap.get("histograms", {}), "account_deposit_lag_seconds")
+    for labels in set(undelivered.keys()) | set(lags.keys()):
+        since = undelivered.get(labels)
+        accounts[dict(labels).get("account")] = {
+            "oldest_undelivered": _date(since),
+            "max_undelivered_age_seconds": round(now - since) if since else 0,
+            "pass_deposits": _series(gauges, "account_pass_deposits").get(labels, 0),
+            "lag": _lag(lags.get(labels))
+        }
+
+    caches = {}
+    for name, (hits_name, misses_name) in CACHES.items():
+        hits = counters.get((hits_name, ()), 0)
+        misses = counters.get((misses_name, ()), 0)
+        caches[name] = {"hits": hits, "misses": misses,
+                        "hit_rate": round(hits / float(hits + misses), 4) if hits + misses > 0 else None}
+
+    queues = {}
+    for (name, labels), value in gauges.items():
+        if name.endswith("_queue_depth") and not labels:
+            queues[name[:-len("_queue_depth")]] = value
+
+    stages = {}
+    for labels, values in _series(snap.get("recent", {}), "stage_seconds").items():
+        if not values:
+            continue
+        stages[dict(labels).get("stage")] = {
+            "samples": len(values),
+            "median_seconds": round(metrics.percentile(values, 50), 3),
+            "p90_seconds": round(metrics.percentile(values, 90), 3),
+            "max_seconds": round(max(values), 3)
+        }
+
+    return {
+        "time": _date(now),
+        "in_flight": in_flight,
+        "passes": passes,
+        "accounts": accounts,
+        "lag": _lag(snap.get("histograms", {}).get(("deposit_lag_seconds", ()))),
+        "max_undelivered_age_seconds": max([a["max_undelivered_age_seconds"] for a in accounts.values()] or [0]),
+        "caches": caches,
+        "queues": queues,
+        "stages": stages,
+        "counters": {metrics.series_name(name, labels): value for (name, labels), value in sorted(counters.items())}
+    }
+
+
+def serve(source=None):
+    """
+    Start the status server in a background thread, if STATUS_ENABLE is set
+
+    :param source: function which returns the metrics snapshot to serve; by default this process's own
+    :return: the server, or None if it is not running
+    """
+    global _source, _server
+    if not app.config.get("STATUS_ENABLE", False):
+        return None
+    if source is not None:
+        _source = source
+    if blueprint.name not in app.blueprints:
+        app.register_blueprint(blueprint)
+    host = app.config.get("STATUS_HOST", "127.0.0.1")
+    port = app.config.get("PORT")
+    try:
+        _server = make_server(host, port, app, threaded=app.config.get("THREADED", True))
+    except (OSError, SystemExit) as e:
+        app.logger.error("Unable to start the status server on {x}:{y} - {z}".format(x=host, y=port, z=str(e)))
+        return None
+    t = threading.Thread(target=_server.serve_forever, name="status-server", daemon=True)
+    t.start()
+    app.logger.info("Status server listening on http://{x}:{y}/status".format(x=host, y=port))
+    return _server
+
+
+def stop():
+    """
+    Stop the status server, if it is running
+    """
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+def close():
+    """
+    Close the status server's socket without stopping it, in a process forked from the one which runs it (so that
+    the port is released when that process exits)
+    """
+    global _server
+    if _server is not None:
+        _server.socket.close()
+        _server = None
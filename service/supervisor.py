@@ -0,0 +1,239 @@
+"""
+Supervisor which runs the deposit cycle in several worker processes.
+
+Each worker owns a hash-partition of the sword-enabled account ids, and executes deposit.run repeatedly
+for only those accounts.  The supervisor (the parent process) starts the workers, restarts any that exit
+and aggregates the metrics that they report.
+
+On SIGTERM or SIGINT the supervisor stops restarting workers and passes the signal on to them; each finishes the
+deposit in hand and exits (see service.lifecycle).  SIGHUP is passed on too, so that every process reloads its
+configuration, and SIGUSR1 and SIGUSR2, so that the workers can be profiled (see service.profiling).
+"""
+import multiprocessing, os, queue, signal, threading, time, zlib
+from octopus.core import app
+from service import deposit, metrics, tmpstore, journal, lifecycle, status, logs, profiling, watchdog
+
+
+def partition_of(account_id, workers):
+    """
+    Determine which partition an account id belongs to.
+
+    This uses a stable hash, so that the allocation is the same in every process and across restarts
+
+    :param account_id: the account id
+    :param workers: total number of partitions
+    :return: the partition index, from 0 to workers - 1
+    """
+    return zlib.crc32(account_id.encode("utf-8")) % workers
+
+
+class Partition(object):
+    """
+    The share of the account ids which a single worker process is responsible for
+    """
+
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+
+    def owns(self, account_id):
+        """
+        Is the account in this partition
+
+        :param account_id: the account id
+        :return: True if this partition owns the account, False if not
+        """
+        return partition_of(account_id, self.workers) == self.index
+
+    def __str__(self):
+        return "{x}/{y}".format(x=self.index, y=self.workers)
+
+
+def _report(report_queue, index):
+    try:
+        report_queue.put((index, multiprocessing.current_process().pid, metrics.snapshot()))
+    except Exception as e:
+        app.logger.error("Worker {x} was unable to report its metrics: {y}".format(x=index, y=str(e)))
+
+
+def _reporter(report_queue, index, interval):
+    while True:
+        time.sleep(interval)
+        _report(report_queue, index)
+
+
+def worker_main(index, workers, report_queue):
+    """
+    Main loop of a worker process.
+
+    Executes deposit.run repeatedly over the accounts in this worker's partition, reporting its metrics to
+    the supervisor periodically, and once more when it exits.
+
+    :param index: partition index of this worker
+    :param workers: total number of workers
+    :param report_queue: queue on which to send metrics snapshots to the supervisor
+    """
+    partition = Partition(index, workers)
+    lifecycle.install()
+    profiling.install()
+    # the supervisor's status server is not ours to serve, and it writes the log for us
+    status.close()
+    logs.forked()
+    metrics.reset()
+    interval = app.config.get("METRICS_REPORT_INTERVAL", 60)
+    if app.config.get("STATUS_ENABLE", False):
+        # report often enough for the supervisor's status server to show what is in flight
+        interval = min(interval, app.config.get("STATUS_REPORT_INTERVAL", interval))
+    t = threading.Thread(target=_reporter, args=(report_queue, index, interval), daemon=True)
+    t.start()
+    watchdog.start()
+
+    app.logger.info("Starting SWORDv2 worker for partition {x}".format(x=partition))
+    try:
+        while not lifecycle.stopping():
+            lifecycle.maybe_reload()
+            with profiling.pass_profile():
+                deposit.run(fail_on_error=True, partition=partition, token=lifecycle.pass_token())
+            lifecycle.sleep(app.config.get("RUN_THROTTLE"))
+        # the supervisor sweeps the temp store that the workers share
+        lifecycle.shutdown(sweep=False)
+    finally:
+        _report(report_queue, index)
+
+
+class Supervisor(object):
+    """
+    Starts and supervises the worker processes, and aggregates their metrics
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._ctx = multiprocessing.get_context("fork")
+        logs.share(self._ctx)
+        self._queue = self._ctx.Queue()
+        self._procs = {}
+        self._restart_at = {}
+        self._latest = {}
+        self._retired = metrics.merge()
+        self.restarts = 0
+
+    def start_worker(self, index):
+        """
+        Start (or restart) the worker process for the given partition
+
+        :param index: the partition index
+        """
+        p = self._ctx.Process(target=worker_main, args=(index, self.workers, self._queue),
+                              name="sword-out-worker-{x}".format(x=index))
+        p.start()
+        self._procs[index] = p
+        app.logger.info("Started worker {x} with pid {y}".format(x=index, y=p.pid))
+
+    def aggregate(self):
+        """
+        Aggregate the metrics of all the workers, including those reported by workers which have since exited, and
+        those of the supervisor itself
+
+        :return: metrics snapshot
+        """
+        snap = metrics.merge(self._retired, metrics.snapshot(), *self._latest.values())
+        snap["counters"][("worker_restarts", ())] = self.restarts
+        return snap
+
+    def _drain(self, timeout=0):
+        while True:
+            try:
+                index, pid, snap = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            self._latest[pid] = snap
+            timeout = 0
+
+    def _check_workers(self):
+        delay = app.config.get("WORKER_RESTART_DELAY", 10)
+        now = time.time()
+        for index in range(self.workers):
+            p = self._procs.get(index)
+            if p is not None and not p.is_alive():
+                p.join()
+                # pick up any final report before retiring the metrics of that process
+                self._drain()
+                self._retired = metrics.merge(self._retired, metrics.retire(self._latest.pop(p.pid, None)))
+                app.logger.error("Worker {x} (pid {y}) exited with code {z}; restarting in {d}s".format(
+                    x=index, y=p.pid, z=p.exitcode, d=delay))
+                self._procs[index] = None
+                self._restart_at[index] = now + delay
+            if self._procs.get(index) is None and self._restart_at.get(index, 0) <= now:
+                self.start_worker(index)
+                if index in self._restart_at:
+                    del self._restart_at[index]
+                    self.restarts += 1
+
+    def run(self):
+        """
+        Start all the workers, and supervise them indefinitely
+        """
+        app.logger.info("Starting SWORDv2 Supervisor with {x} workers".format(x=self.workers))
+        # clear up anything left in the temp store by a previous run; the workers share it, so the supervisor
+        # is the one to sweep it from now on
+        tmpstore.sweep()
+        journal.recover()
+        for index in range(self.workers):
+            self.start_worker(index)
+        status.serve(self.aggregate)
+        profiling.install(forward=self.signal_workers)
+
+        last_report = time.time()
+        while not lifecycle.stopping():
+            if lifecycle.maybe_reload():
+                self.signal_workers(signal.SIGHUP)
+            self._drain(timeout=1)
+            self._check_workers()
+            tmpstore.maybe_sweep()
+            try:
+                metrics.gauge("report_queue_depth", self._queue.qsize())
+            except NotImplementedError:
+                pass
+            interval = app.config.get("METRICS_REPORT_INTERVAL", 60)
+            if time.time() - last_report >= interval:
+                app.logger.info("Worker metrics: {x}".format(x=metrics.format_counters(self.aggregate())))
+                last_report = time.time()
+        self.stop()
+
+    def signal_workers(self, signum):
+        """
+        Send a signal to all the running workers
+
+        :param signum: the signal
+        """
+        for p in self._procs.values():
+            if p is not None and p.is_alive():
+                try:
+                    os.kill(p.pid, signum)
+                except OSError:
+                    pass
+
+    def stop(self):
+        """
+        Stop all the workers, waiting for each to finish the deposit in hand.  A worker which has not exited within
+        the SHUTDOWN_GRACE_PERIOD, plus SWORD_TIMEOUT for a request to a repository already under way, is killed
+        """
+        self.signal_workers(signal.SIGTERM)
+        wait = (app.config.get("SHUTDOWN_GRACE_PERIOD") or 0) + (app.config.get("SWORD_TIMEOUT") or 0) + 10
+        deadline = time.time() + wait
+        for index, p in self._procs.items():
+            if p is None:
+                continue
+            # keep picking up the final reports, so that no worker blocks on a full queue as it exits
+            while p.is_alive() and time.time() < deadline:
+                self._drain(timeout=1)
+                p.join(timeout=0)
+            if p.is_alive():
+                app.logger.error("Worker {x} (pid {y}) did not stop within {z}s; killing it".format(
+                    x=index, y=p.pid, z=wait))
+                p.kill()
+            p.join()
+        self._drain()
+        app.logger.info("Worker metrics: {x}".format(x=metrics.format_counters(self.aggregate())))
+        status.stop()
+        lifecycle.shutdown()
@@ -0,0 +1,3 @@
+"""
+Module which contains benchmarks of the performance critical parts of the system
+"""
@@ -0,0 +1,227 @@
+"""
+Benchmark of the crosswalk from notifications to atom entries (service/xwalk.py), with a regression gate.
+
+Notifications are generated across a range of sizes, from 1 to 5000 authors (with proportionately many identifiers,
+projects and subjects), and for each size and crosswalk engine (see XWALK_ENGINE) the benchmark measures:
+
+* build_per_sec - entries/sec crosswalked by xwalk.to_dc_rioxx into a new entry
+* serialise_per_sec - entries/sec serialised with str(entry)
+* allocated_blocks - memory blocks still held by one built entry
+* peak_bytes - peak memory while building and serialising one entry
+
+The memory figures come from tracemalloc, so they cover Python's allocations only; memory which lxml allocates
+for itself is not included.
+
+The results are written as JSON, and compared against a stored baseline: the run fails if any rate has fallen, or
+any memory figure has grown, by more than the tolerance, or if there is no baseline for any of the figures (unless
+--allow-missing-baseline is given, when the baseline file is missing altogether).  Run it with
+
+::
+
+    python -m service.tests.performance.bench_xwalk
+
+and use --save-baseline to record the results as the new baseline (on the machine which will run the gate, as the
+figures are only comparable on the same hardware).
+"""
+import json, os, sys, time, tracemalloc
+from octopus.core import app, add_configuration
+from octopus.lib import paths
+from octopus.modules.jper import models
+from service import xwalk
+from service.tests import fixtures
+
+SIZES = [1, 10, 100, 1000, 5000]
+"""numbers of authors in the generated notifications"""
+
+ENGINES = ["dom", "stream"]
+"""crosswalk engines to benchmark"""
+
+BASELINE = paths.rel2abs(__file__, "xwalk_baseline.json")
+"""Default location of the stored baseline"""
+
+TOLERANCE = 0.25
+"""Default fraction by which a figure may be worse than the baseline before it counts as a regression"""
+
+MIN_TIME = 1.0
+"""Minimum number of seconds to spend timing each measurement"""
+
+RATES = ["build_per_sec", "serialise_per_sec"]
+MEMORY = ["allocated_blocks", "peak_bytes"]
+
+
+def generate_notification(authors):
+    """
+    Generate an outgoing notification with the given number of authors, and proportionately many
+    identifiers, projects and subjects
+
+    :param authors: number of authors
+    :return: OutgoingNotification
+    """
+    source = fixtures.NotificationFactory.outgoing_notification()
+    md = source["metadata"]
+    md["author"] = [{
+        "name": "Author {x}, Émilie".format(x=i),
+        "identifier": [
+            {"type": "orcid", "id": "0000-0002-{x:04d}-{y:04d}".format(x=i // 10000, y=i % 10000)},
+            {"type": "email", "id": "author{x}@example.com".format(x=i)}
+        ],
+        "affiliation": "Department {x}, University of Somewhere & Elsewhere".format(x=i % 50)
+    } for i in range(authors)]
+    md["identifier"] = [{"type": t, "id": "{t}:{x}".format(t=t, x=i)}
+                        for i in range(max(1, authors // 20)) for t in ["doi", "pmid", "pmcid", "url"]]
+    md["project"] = [{
+        "name": "Funder {x}".format(x=i),
+        "identifier": [{"type": "ringold", "id": "funder{x}".format(x=i)}],
+        "grant_number": "GR/{x}/<{y}>".format(x=i, y=authors)
+    } for i in range(max(1, authors // 10))]
+    md["subject"] = ["Subject {x}".format(x=i) for i in range(max(1, authors // 5))]
+    return models.OutgoingNotification(source)
+
+
+def _timeit(fn):
+    """
+    Call fn repeatedly for at least MIN_TIME seconds
+
+    :return: calls per second
+    """
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < MIN_TIME or count < 3:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+def _build(note):
+    entry = xwalk.new_entry()
+    xwalk.to_dc_rioxx(note, entry)
+    return entry
+
+
+def measure(note):
+    """
+    Measure the crosswalk of one notification with the currently configured engine
+
+    :param note: the notification
+    :return: dict of the figures
+    """
+    entry = _build(note)
+    result = {
+        "build_per_sec": _timeit(lambda: _build(note)),
+        "serialise_per_sec": _timeit(lambda: str(entry))
+    }
+    del entry
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        entry = _build(note)
+        after = tracemalloc.take_snapshot()
+        str(entry)
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        result["allocated_blocks"] = sum(s.count_diff for s in after.compare_to(before, "filename") if s.count_diff > 0)
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def run(sizes=None, engines=None):
+    """
+    Run the benchmark
+
+    :param sizes: numbers of authors to benchmark; by default SIZES
+    :param engines: crosswalk engines to benchmark; by default ENGINES
+    :return: dict of figures, keyed by engine and then by number of authors
+    """
+    sizes = sizes if sizes is not None else SIZES
+    engines = engines if engines is not None else ENGINES
+    original = app.config.get("XWALK_ENGINE")
+    results = {}
+    try:
+        for engine in engines:
+            app.config["XWALK_ENGINE"] = engine
+            results[engine] = {}
+            for size in sizes:
+                results[engine][str(size)] = measure(generate_notification(size))
+    finally:
+        app.config["XWALK_ENGINE"] = original
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare the results against the baseline
+
+    :param results: results of this run
+    :param baseline: stored results
+    :param tolerance: fraction by which a figure may be worse than the baseline
+    :return: list of descriptions of the regressions (including any figures which have no baseline to be compared
+        against); empty if there are none
+    """
+    regressions = []
+    for engine, sizes in results.items():
+        if engine not in baseline:
+            regressions.append("{e}: no baseline for this engine".format(e=engine))
+            continue
+        for size, figures in sizes.items():
+            base = baseline[engine].get(size)
+            if base is None:
+                regressions.append("{e}/{s} authors: no baseline for this size".format(e=engine, s=size))
+                continue
+            for k in RATES:
+                if k in base and figures[k] < base[k] * (1 - tolerance):
+                    regressions.append("{e}/{s} authors: {k} {x:.1f} is below baseline {y:.1f}".format(
+                        e=engine, s=size, k=k, x=figures[k], y=base[k]))
+            for k in MEMORY:
+                if k in base and figures[k] > base[k] * (1 + tolerance):
+                    regressions.append("{e}/{s} authors: {k} {x} is above baseline {y}".format(
+                        e=engine, s=size, k=k, x=figures[k], y=base[k]))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c", "--config", help="additional configuration to load")
+    parser.add_argument("-o", "--out", default="xwalk_bench.json", help="file to write the results to")
+    parser.add_argument("-b", "--baseline", default=BASELINE, help="baseline to compare the results against")
+    parser.add_argument("-t", "--tolerance", type=float, default=TOLERANCE, help="fraction by which a figure may be worse than the baseline")
+    parser.add_argument("-s", "--sizes", help="comma separated numbers of authors to benchmark")
+    parser.add_argument("--save-baseline", action="store_true", help="record the results as the new baseline")
+    parser.add_argument("--allow-missing-baseline", action="store_true", help="pass the gate if there is no baseline")
+
+    args = parser.parse_args()
+
+    if args.config:
+        add_configuration(app, args.config)
+
+    sizes = [int(s) for s in args.sizes.split(",")] if args.sizes else None
+    results = run(sizes=sizes)
+
+    with open(args.out, "w") as f:
+        json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+    for engine, by_size in results.items():
+        for size, figures in by_size.items():
+            print("{e:6} {s:>5} authors: build {b:10.1f}/s  serialise {x:10.1f}/s  blocks {a:8}  peak {p:10} bytes".format(
+                e=engine, s=size, b=figures["build_per_sec"], x=figures["serialise_per_sec"],
+                a=figures["allocated_blocks"], p=figures["peak_bytes"]))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to {x}".format(x=args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {x} - run with --save-baseline to record one".format(x=args.baseline))
+        sys.exit(0 if args.allow_missing_baseline else 1)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION " + r)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,69 @@
+"""
+Tests on the repository adapters
+"""
+
+from unittest import TestCase
+from service import models, adapters
+from octopus.core import app
+
+
+class MockErrorDocument(object):
+    def __init__(self, error_href=None):
+        self.error_href = error_href
+
+
+class TestAdapters(TestCase):
+    def setUp(self):
+        super(TestAdapters, self).setUp()
+        self.send_xml_file = app.config.get("EPRINTS_SEND_XML_FILE")
+
+    def tearDown(self):
+        app.config["EPRINTS_SEND_XML_FILE"] = self.send_xml_file
+        super(TestAdapters, self).tearDown()
+
+    def _account(self, packaging, software):
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_packaging(packaging)
+        acc.repository_software = software
+        return acc
+
+    def test_01_choose(self):
+        assert type(adapters.for_account(self._account("http://purl.org/net/sword/package/SimpleZip", "dspace"))) \
+            is adapters.RepositoryAdapter
+        assert isinstance(adapters.for_account(self._account("http://opus4.kobv.de/package", "opus")),
+                          adapters.OPUS4Adapter)
+        assert isinstance(adapters.for_account(self._account("http://escidoc.org/package", "pubman")),
+                          adapters.EScidocAdapter)
+
+        # the software decides before the packaging
+        assert isinstance(adapters.for_account(self._account("http://opus4.kobv.de/package", "eprints")),
+                          adapters.EPrintsAdapter)
+
+    def test_02_sequence(self):
+        standard = adapters.RepositoryAdapter()
+        assert standard.sequence("single zip file", True) == (adapters.CREATE_PACKAGE,)
+        assert standard.sequence("individual files", True) == \
+            (adapters.CREATE, adapters.RECEIPT, adapters.PACKAGE, adapters.COMPLETE)
+        # a metadata only deposit is complete in a single request
+        assert standard.sequence("individual files", False) == (adapters.CREATE,)
+
+        app.config["EPRINTS_SEND_XML_FILE"] = True
+        eprints = adapters.EPrintsAdapter()
+        assert eprints.sequence("individual files", True) == \
+            (adapters.CREATE, adapters.RECEIPT, adapters.XML_FILE, adapters.PACKAGE)
+        assert eprints.sequence("individual files", False) == (adapters.CREATE, adapters.RECEIPT, adapters.XML_FILE)
+
+        # without the second upload of the atom entry
+        app.config["EPRINTS_SEND_XML_FILE"] = False
+        assert eprints.sequence("individual files", False) == (adapters.CREATE,)
+        assert eprints.sequence("individual files", True) == (adapters.CREATE, adapters.RECEIPT, adapters.PACKAGE)
+
+    def test_03_classify_error(self):
+        standard = adapters.RepositoryAdapter()
+        assert standard.classify_error(MockErrorDocument()) is None
+        assert standard.classify_error(MockErrorDocument("http://purl.org/net/sword/error/ErrorBadRequest")) is None
+        assert standard.classify_error(MockErrorDocument("http://opus-repository.org/sword/error/InvalidXml")) == \
+            "invalidxml"
+        assert standard.classify_error(MockErrorDocument("http://opus-repository.org/sword/error/PayloadToLarge")) == \
+            "payloadtoolarge"
@@ -0,0 +1,53 @@
+"""
+Tests on the Bloom filter used for the per-repository deposit filters
+"""
+
+from unittest import TestCase
+from service import bloom
+import uuid
+
+
+class TestBloom(TestCase):
+
+    def test_01_no_false_negatives(self):
+        bf = bloom.BloomFilter.for_capacity(1000, 0.01)
+        ids = [uuid.uuid4().hex for i in range(1000)]
+        for i in ids:
+            bf.add(i)
+
+        # a new key which happens to be a false positive is not counted, so the count may fall a little short
+        assert 980 <= bf.count <= 1000
+        for i in ids:
+            assert i in bf
+
+    def test_02_false_positive_rate(self):
+        bf = bloom.BloomFilter.for_capacity(1000, 0.01)
+        for i in range(1000):
+            bf.add(uuid.uuid4().hex)
+
+        fp = len([1 for i in range(10000) if uuid.uuid4().hex in bf])
+        # comfortably within the configured rate, allowing for chance
+        assert fp < 300
+
+    def test_03_encode_decode(self):
+        bf = bloom.BloomFilter.for_capacity(100, 0.01)
+        ids = [uuid.uuid4().hex for i in range(100)]
+        for i in ids:
+            bf.add(i)
+
+        bf2 = bloom.BloomFilter.decode(bf.size, bf.hashes, bf.encode(), bf.count)
+        assert bf2.bits == bf.bits
+        assert bf2.count == bf.count
+        for i in ids:
+            assert i in bf2
+
+        with self.assertRaises(ValueError):
+            bloom.BloomFilter.decode(bf.size + 64, bf.hashes, bf.encode())
+
+    def test_04_count_distinct(self):
+        bf = bloom.BloomFilter.for_capacity(100, 0.01)
+        assert bf.add("note1") is True
+        assert bf.add("note1") is False
+        assert bf.count == 1
+        bf.add("note2")
+        assert bf.count == 2
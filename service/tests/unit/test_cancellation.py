@@ -0,0 +1,61 @@
+"""
+Tests on the cancellation token which bounds each deposit pass
+"""
+
+from unittest import TestCase
+from service.cancellation import CancellationToken, Cancelled
+from octopus.core import app
+import time
+
+
+class TestCancellation(TestCase):
+    def setUp(self):
+        super(TestCancellation, self).setUp()
+        self.deadline = app.config.get("PASS_DEADLINE")
+
+    def tearDown(self):
+        app.config["PASS_DEADLINE"] = self.deadline
+        super(TestCancellation, self).tearDown()
+
+    def test_01_no_deadline(self):
+        token = CancellationToken()
+        assert not token.cancelled
+        assert token.remaining() is None
+        token.check()
+
+        token.cancel("stopping")
+        assert token.cancelled
+        assert token.remaining() == 0
+        with self.assertRaises(Cancelled):
+            token.check()
+        assert token.reason == "stopping"
+
+    def test_02_deadline(self):
+        app.config["PASS_DEADLINE"] = 1
+        token = CancellationToken.for_pass()
+        assert not token.cancelled
+        assert 0 < token.remaining() <= 1
+
+        time.sleep(1.1)
+        assert token.cancelled
+        assert token.reason == "pass deadline reached"
+        with self.assertRaises(Cancelled):
+            token.check()
+
+        app.config["PASS_DEADLINE"] = None
+        assert CancellationToken.for_pass().deadline is None
+
+    def test_03_drain(self):
+        token = CancellationToken()
+        token.drain("shutting down")
+        # the pass stops at its next boundary, but the work in hand carries on
+        assert token.cancelled
+        assert token.draining
+        assert token.reason == "shutting down"
+        token.check()
+
+        # until the token is cancelled outright
+        token.cancel("shutdown grace period expired")
+        assert token.reason == "shutdown grace period expired"
+        with self.assertRaises(Cancelled):
+            token.check()
@@ -42,3 +42,33 @@ class TestModels(ESTestCase):
         assert rs.status == "succeeding"
 
 
+    def test_02_requeue_dead_letters(self):
+        models.DeadLetter.record("123456789", "1111", "attempts", 10)
+        models.DeadLetter.record("123456789", "2222", "invalidxml")
+        models.DeadLetter.record("123456789", "3333", "payloadtoolarge")
+        models.DeadLetter.record("987654321", "1111", "attempts", 10)
+
+        time.sleep(2)
+
+        assert models.DeadLetter.notification_ids_for("123456789") == set(["1111", "2222", "3333"])
+
+        # requeue just one of them
+        count = control.requeue_dead_letters("123456789", ["2222", "4444"])
+        assert count == 1
+
+        time.sleep(2)
+
+        assert models.DeadLetter.notification_ids_for("123456789") == set(["1111", "3333"])
+
+        # then the rest
+        count = control.requeue_dead_letters("123456789")
+        assert count == 2
+
+        time.sleep(2)
+
+        assert models.DeadLetter.notification_ids_for("123456789") == set()
+        assert models.DeadLetter.notification_ids_for("987654321") == set(["1111"])
+
+        rns = list(models.RequestNotification.iterate_request_notification("123456789"))
+        assert len(rns) == 3
+        assert sorted([rn.notification_id for rn in rns]) == ["1111", "2222", "3333"]
@@ -3,14 +3,15 @@ Tests on the deposit functions
 """
 
 from octopus.modules.es.testindex import ESTestCase
-from service import deposit, models
+from service import deposit, models, http_layer, journal, metrics, deposit_plan
+from service.cancellation import CancellationToken, Cancelled
+from service.deposit_filter import AccountDepositFilter
 from octopus.modules.jper import client
 from octopus.modules.jper import models as jmod
 from octopus.modules.store import store
 from service.tests import fixtures
 from octopus.lib import dates, http
-from octopus.modules.swordv2 import client_http
-import time, sword2, urllib.parse, json, os, zipfile
+import time, sword2, urllib.parse, json, os, zipfile, tempfile, shutil
 from io import StringIO
 from octopus.core import app
 
@@ -52,6 +53,36 @@ def mock_get_content(url, *args, **kwargs):
         cont = f.read()
     return http.MockResponse(200, cont), "", 0
 
+class MockRangeResponse(object):
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+    def iter_content(self, chunk_size=8096):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+def mock_get_content_dropped(self, url, *args, **kwargs):
+    def gen():
+        yield PACKAGE[:1000]
+        raise IOError("connection dropped")
+    return gen(), {"content-length": str(len(PACKAGE))}
+
+def mock_get_content_dropped_etag(self, url, *args, **kwargs):
+    gen, headers = mock_get_content_dropped(self, url, *args, **kwargs)
+    headers["etag"] = '"v1"'
+    return gen, headers
+
+def mock_get_stream_range(url, *args, **kwargs):
+    offset = int(kwargs["headers"]["Range"][len("bytes="):-1])
+    headers = {"content-length": str(len(PACKAGE) - offset),
+               "content-range": "bytes {x}-{y}/{z}".format(x=offset, y=len(PACKAGE) - 1, z=len(PACKAGE))}
+    return MockRangeResponse(206, PACKAGE[offset:], headers), "", 0
+
+with open(fixtures.NotificationFactory.example_package_path(), 'rb') as f:
+    PACKAGE = f.read()
+
 def mock_iterate_fail(*args, **kwargs):
     raise client.JPERException()
 
@@ -74,15 +105,24 @@ class TestDeposit(ESTestCase):
         self.old_http_get_stream = http.get_stream
 
         self.old_iterate = client.JPER.iterate_notifications
+        self.old_get_content = client.JPER.get_content
 
-        self.old_octopus_http = client_http.OctopusHttpLayer
+        self.old_sword_http = http_layer.SwordHttpLayer
+        self.old_connection = deposit._connection
 
         self.stored_ids = []
 
+        self.journal_dir = app.config.get("DEPOSIT_JOURNAL_DIR")
+        app.config["DEPOSIT_JOURNAL_DIR"] = tempfile.mkdtemp()
+
         self.retry_delay = app.config.get("LONG_CYCLE_RETRY_DELAY")
         self.retry_limit = app.config.get("LONG_CYCLE_RETRY_LIMIT")
         self.store_responses = app.config.get("STORE_RESPONSE_DATA")
         app.config["STORE_RESPONSE_DATA"] = True
+        self.spool_threshold = app.config.get("SPOOL_CONTENT_THRESHOLD")
+        self.max_attempts = app.config.get("MAX_DEPOSIT_ATTEMPTS")
+        self.send_xml_file = app.config.get("EPRINTS_SEND_XML_FILE")
+        self.filter_authoritative = app.config.get("DEPOSIT_FILTER_AUTHORITATIVE")
 
     def tearDown(self):
         deposit.process_notification = self.old_process_notification
@@ -94,12 +134,21 @@ class TestDeposit(ESTestCase):
         http.get_stream = self.old_http_get_stream
 
         client.JPER.iterate_notifications = self.old_iterate
+        client.JPER.get_content = self.old_get_content
 
-        client_http.OctopusHttpLayer = self.old_octopus_http
+        http_layer.SwordHttpLayer = self.old_sword_http
+        deposit._connection = self.old_connection
+
+        shutil.rmtree(app.config["DEPOSIT_JOURNAL_DIR"])
+        app.config["DEPOSIT_JOURNAL_DIR"] = self.journal_dir
 
         app.config["LONG_CYCLE_RETRY_DELAY"] = self.retry_delay
         app.config["LONG_CYCLE_RETRY_LIMIT"] = self.retry_limit
         app.config["STORE_RESPONSE_DATA"] = self.store_responses
+        app.config["SPOOL_CONTENT_THRESHOLD"] = self.spool_threshold
+        app.config["MAX_DEPOSIT_ATTEMPTS"] = self.max_attempts
+        app.config["EPRINTS_SEND_XML_FILE"] = self.send_xml_file
+        app.config["DEPOSIT_FILTER_AUTHORITATIVE"] = self.filter_authoritative
 
         tmp = store.StoreFactory.tmp()
         for sid in self.stored_ids:
@@ -546,7 +595,7 @@ class TestDeposit(ESTestCase):
         assert status.last_tried is None
 
     def test_12_broken_repository(self):
-        client_http.OctopusHttpLayer = fixtures.MockHttpLayer
+        http_layer.SwordHttpLayer = fixtures.MockHttpLayer
 
         # give us an account to process for
         acc = models.Account()
@@ -580,4 +629,460 @@ class TestDeposit(ESTestCase):
         since = dates.now()
 
         with self.assertRaises(deposit.DepositException):   # because this is what the mock does if it gets called
-            deposit.process_notification(acc, note, since)
\ No newline at end of file
+            deposit.process_notification(acc, note, since)
+
+    def test_14_resume_content(self):
+        # packages are always downloaded to a (resumable) file
+        app.config["SPOOL_CONTENT_THRESHOLD"] = 0
+
+        # the first attempt is cut off part way through
+        client.JPER.get_content = mock_get_content_dropped
+        http.get_stream = mock_get_stream_range
+
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+
+        source = fixtures.NotificationFactory.outgoing_notification()
+        note = jmod.OutgoingNotification(source)
+        link = note.get_package_link("http://purl.org/net/sword/package/SimpleZip")
+
+        with self.assertRaises(client.JPERException):
+            deposit._fetch_content(link, note, acc)
+
+        # the partial download is kept
+        part = deposit._partial_path(acc, link.get("url"))
+        assert os.path.getsize(part) == 1000
+
+        # and the next attempt only asks for the rest of it
+        with deposit._fetch_content(link, note, acc) as f:
+            assert f.read() == PACKAGE
+        assert not os.path.exists(part)
+
+    def test_15_lazy_receipt(self):
+        fetched = []
+        completed = []
+
+        def created(location, headers):
+            # as the sword client makes it from a 201 response with an empty body
+            dr = sword2.Deposit_Receipt(response_headers=headers, code=201)
+            dr.location = location
+            return dr
+
+        class MockConnection(object):
+            def get_deposit_receipt(self, edit_iri):
+                fetched.append(edit_iri)
+                dr = sword2.Deposit_Receipt()
+                dr.location = edit_iri
+                dr.edit = edit_iri
+                dr.edit_media = "http://sword/em/1"
+                dr.se_iri = "http://sword/se/1"
+                return dr
+
+            def complete_deposit(self, dr=None, **kwargs):
+                completed.append(dr.se_iri or dr.edit)
+                return sword2.Deposit_Receipt(code=200)
+
+        dr = models.DepositRecord()
+
+        # the IRIs in the create response's headers are used without retrieving the receipt
+        headers = {"Location": "http://sword/edit/1",
+                   "Link": '<http://sword/em/1>; rel="edit-media", <http://sword/se/1>; rel="http://purl.org/net/sword/terms/add"'}
+        receipt = deposit.LazyReceipt(created("http://sword/edit/1", headers), MockConnection(), dr)
+        receipt.require("edit_media", "se_iri")
+        assert receipt.edit == "http://sword/edit/1"
+        assert receipt.edit_media == "http://sword/em/1"
+        assert receipt.se_iri == "http://sword/se/1"
+        assert fetched == []
+
+        # otherwise the receipt is retrieved once, from the Location, when a missing field is first needed
+        receipt = deposit.LazyReceipt(created("http://sword/edit/2", {"Location": "http://sword/edit/2"}),
+                                      MockConnection(), dr)
+        assert receipt.edit == "http://sword/edit/2"
+        assert fetched == []
+        assert receipt.edit_media == "http://sword/em/1"
+        assert receipt.se_iri == "http://sword/se/1"
+        assert fetched == ["http://sword/edit/2"]
+
+        # the complete request falls back to the Edit-IRI, so it does not need the receipt
+        del fetched[:]
+        deposit._connection = lambda acc: MockConnection()
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "individual files")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        dr.id = dr.makeid()
+        receipt = deposit.LazyReceipt(created("http://sword/edit/3", {"Location": "http://sword/edit/3"}),
+                                      MockConnection(), dr)
+        deposit.complete_deposit(receipt, acc, dr)
+        assert fetched == []
+        assert completed == ["http://sword/edit/3"]
+        assert dr.completed_status == "deposited"
+
+    def test_16_journal_resume(self):
+        calls = []
+
+        class MockConnection(object):
+            def __init__(self, code):
+                self.code = code
+
+            def get_deposit_receipt(self, edit_iri):
+                calls.append("receipt")
+                dr = sword2.Deposit_Receipt()
+                dr.location = edit_iri
+                dr.edit = edit_iri
+                dr.code = self.code
+                return dr
+
+        def mock_metadata_deposit(*args, **kwargs):
+            calls.append("metadata")
+            dr = sword2.Deposit_Receipt()
+            dr.location = "http://sword/edit/2"
+            dr.edit = "http://sword/edit/2"
+            return dr
+
+        def mock_package_deposit(*args, **kwargs):
+            calls.append("package")
+
+        deposit.metadata_deposit = mock_metadata_deposit
+        deposit.package_deposit = mock_package_deposit
+        deposit.complete_deposit = mock_complete_deposit_success
+        http.get_stream = mock_get_content
+
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "individual files")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        note = jmod.OutgoingNotification(fixtures.NotificationFactory.outgoing_notification())
+
+        # an earlier attempt created the item, and then the process was killed
+        journal.begin(acc.id, note.id, "dr1", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+
+        # the item is still there, so only the content is deposited, to that item
+        deposit._connection = lambda acc: MockConnection(200)
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "package"]
+        assert journal.get(acc.id, note.id) is None
+
+        # if the item has gone, the deposit is made again
+        del calls[:]
+        journal.begin(acc.id, note.id, "dr2", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+        deposit._connection = lambda acc: MockConnection(404)
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "metadata", "package"]
+        assert journal.get(acc.id, note.id) is None
+
+    def test_17_pass_summary(self):
+        def mock_process_account(acc, quota=None, token=None):
+            metrics.incr("notifications_listed", 3)
+            metrics.incr("notifications_skipped", reason="deposited")
+            metrics.incr("deposits")
+            if acc.id == "acc2":
+                metrics.incr("deposit_failures")
+                time.sleep(0.1)
+
+        deposit.process_account = mock_process_account
+
+        acc1 = models.Account()
+        acc1.id = "acc1"
+        acc1.add_sword_credentials("acc1", "pass1", "http://sword/1")
+        acc1.save()
+
+        acc2 = models.Account()
+        acc2.id = "acc2"
+        acc2.add_sword_credentials("acc2", "pass2", "http://sword/2")
+        acc2.save(blocking=True)
+
+        deposit.run(True)
+        time.sleep(2)
+
+        # a single summary of the pass is written, with the figures for that pass alone
+        summaries = list(models.PassSummary.iterate_since("1970-01-01T00:00:00Z"))
+        assert len(summaries) == 1
+        summary = summaries[0]
+        assert summary.notifications == {"listed": 6, "skipped": 1, "deposited": 2, "failed": 1}
+        assert summary.data["accounts"]["total"] == 2
+        assert summary.data["accounts"]["visited"] == 2
+        assert summary.data["requests"]["es"] > 0
+        assert summary.duration >= 0.1
+        assert summary.slowest_accounts[0]["account"] == "acc2"
+        assert summary.slowest_accounts[0]["deposits"] == 1
+
+    def test_18_deposit_filter_attempts(self):
+        deposit.metadata_deposit = mock_metadata_deposit_fail
+        deposit.package_deposit = mock_package_deposit_fail
+        deposit.complete_deposit = mock_complete_deposit_fail
+        app.config["MAX_DEPOSIT_ATTEMPTS"] = 3
+
+        acc = models.Account()
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        acc.save()
+
+        source = fixtures.NotificationFactory.outgoing_notification()
+        note = jmod.OutgoingNotification(source)
+
+        metrics.reset()
+        deposit_filter = AccountDepositFilter.load(acc.id)
+        time.sleep(2)
+        for i in range(3):
+            repository_status = deposit.create_repo_status(acc)
+            status, repository_status, deposit_log, count = deposit.attempt_deposit(
+                acc, note, True, repository_status, models.RepositoryDepositLog(), 0, deposit_filter=deposit_filter)
+            assert status is False
+            time.sleep(2)
+
+        # only the first attempt was taken on the word of the filter; after that the deposit records are consulted
+        assert metrics.get("deposit_filter_negatives") == 1
+        assert deposit_filter.attempted_before(note.id)
+        assert note.id not in deposit_filter
+
+        # having used up its attempts, the notification is given up on rather than attempted again
+        repository_status = deposit.create_repo_status(acc)
+        status, repository_status, deposit_log, count = deposit.attempt_deposit(
+            acc, note, True, repository_status, models.RepositoryDepositLog(), 0, deposit_filter=deposit_filter)
+        assert status is True
+        assert count == 0
+        assert models.DepositRecord.pull_count_by_ids(note.id, acc.id) == 3
+        time.sleep(2)
+        assert note.id in models.DeadLetter.notification_ids_for(acc.id)
+
+        # and the attempts survive the filter being saved and loaded again
+        deposit_filter.save()
+        time.sleep(2)
+        assert AccountDepositFilter.load(acc.id).attempted_before(note.id)
+
+    def test_19_journal_replay(self):
+        calls = []
+
+        class MockConnection(object):
+            def __init__(self, content=False, statement=None):
+                self.content = content
+                self.statement = statement
+
+            def get_deposit_receipt(self, edit_iri):
+                calls.append("receipt")
+                dr = sword2.Deposit_Receipt()
+                dr.location = edit_iri
+                dr.edit = edit_iri
+                dr.edit_media = "http://sword/em/1"
+                dr.code = 200
+                if self.content:
+                    dr.content = {"http://sword/cont/1": {}}
+                if self.statement is not None:
+                    dr.atom_statement_iri = "http://sword/statement/1"
+                return dr
+
+            def get_atom_sword_statement(self, iri):
+                calls.append("statement")
+                return self.statement
+
+            def add_file_to_resource(self, edit_media, payload, filename, mimetype, packaging=None):
+                calls.append(filename)
+                return sword2.Deposit_Receipt(code=201)
+
+        def mock_package_deposit(*args, **kwargs):
+            calls.append("package")
+
+        deposit.metadata_deposit = mock_metadata_deposit_fail
+        deposit.package_deposit = mock_package_deposit
+        deposit.complete_deposit = mock_complete_deposit_success
+        http.get_stream = mock_get_content
+        app.config["EPRINTS_SEND_XML_FILE"] = True
+
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "individual files")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        acc.repository_software = "eprints"
+        note = jmod.OutgoingNotification(fixtures.NotificationFactory.outgoing_notification())
+        deposit_plan.clear()
+
+        # the item was created, but the process was killed before the atom entry was sent as a file
+        journal.begin(acc.id, note.id, "dr1", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+        deposit._connection = lambda acc: MockConnection()
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "sword.xml", "package"]
+        assert journal.get(acc.id, note.id) is None
+
+        # once the atom entry is recorded as sent, only the package is deposited
+        del calls[:]
+        journal.begin(acc.id, note.id, "dr2", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+        journal.advance(acc.id, note.id, journal.XML_FILE)
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "package"]
+
+        # the package is only taken as deposited if the repository shows it, here in the item's statement
+        del calls[:]
+        journal.begin(acc.id, note.id, "dr3", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+        journal.advance(acc.id, note.id, journal.CONTENT)
+        statement = sword2.Atom_Sword_Statement()
+        statement.original_deposits.append("http://sword/cont/1")
+        deposit._connection = lambda acc: MockConnection(statement=statement)
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "statement"]
+
+        # and otherwise it is deposited again, to the same item
+        del calls[:]
+        journal.begin(acc.id, note.id, "dr4", "individual files")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/1")
+        journal.advance(acc.id, note.id, journal.CONTENT)
+        deposit._connection = lambda acc: MockConnection(statement=sword2.Atom_Sword_Statement())
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt", "statement", "package"]
+
+        # a single zip file deposit is done if the receipt lists the package
+        acc = models.Account()
+        acc.id = "acc2"
+        acc.add_sword_credentials("acc2", "pass2", "http://sword/2", "single zip file")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        deposit_plan.clear()
+        del calls[:]
+        journal.begin(acc.id, note.id, "dr5", "single zip file")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/2")
+        deposit._connection = lambda acc: MockConnection(content=True)
+        done, dr_id = deposit.process_notification(acc, note, check_deposit_record=False)
+        assert done is True
+        assert calls == ["receipt"]
+        assert journal.get(acc.id, note.id) is None
+
+        # but not if the repository does not show it; the item is kept in the journal for a later attempt
+        journal.begin(acc.id, note.id, "dr6", "single zip file")
+        journal.advance(acc.id, note.id, journal.CREATED, edit="http://sword/edit/2")
+        deposit._connection = lambda acc: MockConnection()
+        with self.assertRaises(deposit.DepositException):
+            deposit.process_notification(acc, note, check_deposit_record=False)
+        assert journal.get(acc.id, note.id)["edit"] == "http://sword/edit/2"
+
+    def test_20_deposit_filter_partial(self):
+        def mock_get_content_fail(self, url, *args, **kwargs):
+            raise client.JPERException("content unavailable")
+
+        deposit.metadata_deposit = mock_metadata_deposit_success
+        deposit.package_deposit = mock_package_deposit_fail
+        deposit.complete_deposit = mock_complete_deposit_fail
+        client.JPER.get_content = mock_get_content_fail
+        app.config["DEPOSIT_FILTER_AUTHORITATIVE"] = True
+
+        acc = models.Account()
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "individual files")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        acc.save()
+
+        note = jmod.OutgoingNotification(fixtures.NotificationFactory.outgoing_notification())
+
+        deposit_filter = AccountDepositFilter.load(acc.id)
+        time.sleep(2)
+        status, repository_status, deposit_log, count = deposit.attempt_deposit(
+            acc, note, True, deposit.create_repo_status(acc), models.RepositoryDepositLog(), 0,
+            deposit_filter=deposit_filter)
+        time.sleep(2)
+
+        # the metadata went in, but not the content, so the notification is not taken as deposited
+        assert not models.DepositRecord.pull_by_ids(note.id, acc.id).was_successful()
+        assert note.id not in deposit_filter
+        assert deposit_filter.attempted_before(note.id)
+
+        # and so, even with the filter taken as authoritative, the next attempt deposits the content
+        client.JPER.get_content = self.old_get_content
+        http.get_stream = mock_get_content
+        deposit.package_deposit = mock_package_deposit_success
+        deposit.complete_deposit = mock_complete_deposit_success
+        status, repository_status, deposit_log, count = deposit.attempt_deposit(
+            acc, note, True, deposit.create_repo_status(acc), models.RepositoryDepositLog(), 0,
+            deposit_filter=deposit_filter)
+        assert count == 1
+        assert note.id in deposit_filter
+
+    def test_21_cancelled_content(self):
+        def mock_get_content_chunks(self, url, *args, **kwargs):
+            return iter([PACKAGE]), {"content-length": str(len(PACKAGE))}
+
+        deposit.metadata_deposit = mock_metadata_deposit_success
+        deposit.package_deposit = mock_package_deposit_fail
+        deposit.complete_deposit = mock_complete_deposit_fail
+        client.JPER.get_content = mock_get_content_chunks
+
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "individual files")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        note = jmod.OutgoingNotification(fixtures.NotificationFactory.outgoing_notification())
+
+        # the pass reaches its deadline while the content is downloaded, after the metadata has been sent
+        metrics.reset()
+        token = CancellationToken()
+        token.cancel("deadline")
+        repository_status = deposit.create_repo_status(acc)
+        last_deposit_date = repository_status.last_deposit_date
+        with self.assertRaises(Cancelled):
+            deposit.attempt_deposit(acc, note, False, repository_status, models.RepositoryDepositLog(), 0,
+                                    token=token)
+
+        # it is not reported as deposited, and the item is left in the journal for the next pass
+        assert metrics.get("deposits") == 0
+        assert repository_status.last_deposit_date == last_deposit_date
+        assert journal.get(acc.id, note.id)["stage"] == journal.CREATED
+
+    def test_22_resume_content_checked(self):
+        app.config["SPOOL_CONTENT_THRESHOLD"] = 0
+
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+
+        source = fixtures.NotificationFactory.outgoing_notification()
+        note = jmod.OutgoingNotification(source)
+        link = note.get_package_link("http://purl.org/net/sword/package/SimpleZip")
+        part = deposit._partial_path(acc, link.get("url"))
+
+        # the validator JPER gave is kept with the partial download, and sent when it is resumed
+        client.JPER.get_content = mock_get_content_dropped_etag
+        with self.assertRaises(client.JPERException):
+            deposit._fetch_content(link, note, acc)
+        assert deposit._read_validator(part) == '"v1"'
+
+        requested = []
+        def get_stream_range(url, *args, **kwargs):
+            requested.append(kwargs["headers"])
+            return mock_get_stream_range(url, *args, **kwargs)
+        http.get_stream = get_stream_range
+
+        with deposit._fetch_content(link, note, acc) as f:
+            assert f.read() == PACKAGE
+        assert requested[0].get("If-Range") == '"v1"'
+        assert not os.path.exists(part)
+        assert deposit._read_validator(part) is None
+
+        # a range which does not start where the partial download ends is not appended to it
+        client.JPER.get_content = mock_get_content_dropped
+        with self.assertRaises(client.JPERException):
+            deposit._fetch_content(link, note, acc)
+        assert os.path.getsize(part) == 1000
+
+        def get_stream_wrong_range(url, *args, **kwargs):
+            headers = {"content-length": str(len(PACKAGE) - 500),
+                       "content-range": "bytes 500-{y}/{z}".format(y=len(PACKAGE) - 1, z=len(PACKAGE))}
+            return MockRangeResponse(206, PACKAGE[500:], headers), "", 0
+        http.get_stream = get_stream_wrong_range
+
+        def get_content(self, url, *args, **kwargs):
+            return iter([PACKAGE]), {"content-length": str(len(PACKAGE))}
+        client.JPER.get_content = get_content
+
+        with deposit._fetch_content(link, note, acc) as f:
+            assert f.read() == PACKAGE
+        assert not os.path.exists(part)
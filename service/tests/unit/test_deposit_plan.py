@@ -0,0 +1,76 @@
+"""
+Tests on the per-account deposit plan
+"""
+
+from unittest import TestCase
+from service import models, deposit_plan, adapters
+from service.deposit_plan import DepositPlan
+from service.tests import fixtures
+from octopus.modules.jper import models as jper
+
+SIMPLE_ZIP = "http://purl.org/net/sword/package/SimpleZip"
+FILES_AND_JATS = "https://pubrouter.jisc.ac.uk/FilesAndJATS"
+
+
+class TestDepositPlan(TestCase):
+    def setUp(self):
+        super(TestDepositPlan, self).setUp()
+        deposit_plan.clear()
+
+    def tearDown(self):
+        deposit_plan.clear()
+        super(TestDepositPlan, self).tearDown()
+
+    def _account(self, packaging, method="single zip file", software="dspace"):
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", method)
+        for p in packaging:
+            acc.add_packaging(p)
+        acc.repository_software = software
+        return acc
+
+    def test_01_plan(self):
+        note = jper.OutgoingNotification(fixtures.NotificationFactory.outgoing_notification())
+
+        # the package is taken in the account's last format
+        plan = DepositPlan.for_account(self._account([FILES_AND_JATS, SIMPLE_ZIP]))
+        assert plan.packaging == SIMPLE_ZIP
+        assert plan.zip_packaging == SIMPLE_ZIP
+        assert plan.deposit_method == "single zip file"
+        assert plan.link_for(note).get("packaging") == SIMPLE_ZIP
+        assert type(plan.adapter) is adapters.RepositoryAdapter
+
+        # even if the notification has none in that format
+        plan = DepositPlan.for_account(self._account([SIMPLE_ZIP, "http://some.package/or/other"]))
+        assert plan.link_for(note) is None
+
+        # and not at all without any format
+        plan = DepositPlan.for_account(self._account([]))
+        assert plan.packaging is None
+        assert plan.link_for(note) is None
+
+        # the repository quirks come from the adapter
+        plan = DepositPlan.for_account(self._account(["http://opus4.kobv.de/package"], "individual files"))
+        assert isinstance(plan.adapter, adapters.OPUS4Adapter)
+        assert plan.zip_packaging is None
+        assert plan.deposit_method == "individual files"
+
+        plan = DepositPlan.for_account(self._account(["http://escidoc.org/package"]))
+        assert plan.zip_packaging == "http://purl.org/escidoc/metadata/schemas/0.1/publication"
+        assert plan.packaging == "http://escidoc.org/package"
+
+    def test_02_cache(self):
+        acc = self._account([SIMPLE_ZIP])
+        plan = DepositPlan.for_account(acc)
+        assert DepositPlan.for_account(acc.view()) is plan
+
+        # a change to the account's settings gets a new plan
+        acc.repository_software = "eprints"
+        changed = DepositPlan.for_account(acc)
+        assert changed is not plan
+        assert isinstance(changed.adapter, adapters.EPrintsAdapter)
+
+        # and the plans are made afresh after clearing
+        deposit_plan.clear()
+        assert DepositPlan.for_account(acc) is not changed
@@ -0,0 +1,135 @@
+"""
+Tests on the HTTP layer used for requests to the repositories
+"""
+
+from unittest import TestCase
+from service import http_layer, metrics, tmpstore
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib, tempfile, threading, os, socket, json
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length"))
+        md5 = hashlib.md5()
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(65536, remaining))
+            if not chunk:
+                break
+            md5.update(chunk)
+            remaining -= len(chunk)
+        body = json.dumps({"length": length, "md5": md5.hexdigest(),
+                           "auth": self.headers.get("Authorization"),
+                           "packaging": self.headers.get("Packaging")}).encode("utf-8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Location", "http://sword/item/1")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class NoSendfileSocket(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+
+class TestHttpLayer(TestCase):
+    def setUp(self):
+        super(TestHttpLayer, self).setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{x}/collection".format(x=self.server.server_port)
+
+        self.file = tempfile.NamedTemporaryFile(delete=False)
+        data = os.urandom(1024 * 1024)
+        self.md5 = hashlib.md5()
+        for i in range(5):
+            self.file.write(data)
+            self.md5.update(data)
+        self.file.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.file.name)
+        super(TestHttpLayer, self).tearDown()
+
+    def test_01_stream_file(self):
+        layer = http_layer.SwordHttpLayer(timeout=10)
+        layer.add_credentials("user", "pass")
+        with open(self.file.name, "rb") as f:
+            resp, content = layer.request(self.url, "POST", headers={"Content-Length": str(5 * 1024 * 1024),
+                                                                     "Packaging": "http://purl.org/net/sword/package/SimpleZip"},
+                                          payload=f)
+
+        assert resp["status"] == 201
+        assert resp.get("location") == "http://sword/item/1"
+        echo = json.loads(content.decode("utf-8"))
+        assert echo["length"] == 5 * 1024 * 1024
+        assert echo["md5"] == self.md5.hexdigest()
+        assert echo["auth"].startswith("Basic ")
+        assert echo["packaging"] == "http://purl.org/net/sword/package/SimpleZip"
+
+    def test_02_send_file_without_sendfile(self):
+        a, b = socket.socketpair()
+        received = []
+
+        def read():
+            while True:
+                chunk = b.recv(65536)
+                if not chunk:
+                    break
+                received.append(chunk)
+
+        t = threading.Thread(target=read)
+        t.start()
+        with open(self.file.name, "rb") as f:
+            f.seek(1024)
+            http_layer.send_file(NoSendfileSocket(a), f, 2048)
+        a.close()
+        t.join()
+        b.close()
+
+        with open(self.file.name, "rb") as f:
+            f.seek(1024)
+            assert b"".join(received) == f.read(2048)
+
+    def test_03_spooled_in_memory(self):
+        layer = http_layer.SwordHttpLayer(timeout=10)
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as f:
+            f.write(b"x" * 1000)
+            f.seek(0)
+            resp, content = layer.request(self.url, "PUT", headers={"Content-Length": "1000"}, payload=f)
+
+            # the file was sent from memory, without being rolled over to disk
+            assert tmpstore.in_memory(f)
+
+        assert resp["status"] == 201
+        echo = json.loads(content.decode("utf-8"))
+        assert echo["length"] == 1000
+        assert echo["md5"] == hashlib.md5(b"x" * 1000).hexdigest()
+
+    def test_04_metering(self):
+        metrics.reset()
+        layer = http_layer.SwordHttpLayer(timeout=10)
+        resp, content = layer.request(self.url, "POST", headers={"Content-Length": "1000"}, payload=b"x" * 1000)
+        with open(self.file.name, "rb") as f:
+            resp, content2 = layer.request(self.url, "PUT", payload=f)
+
+        # both the requests and the bytes each way are counted
+        assert metrics.get("sword_requests", op="POST") == 1
+        assert metrics.get("sword_requests", op="PUT") == 1
+        assert metrics.get("sword_bytes_sent") == 1000 + 5 * 1024 * 1024
+        assert metrics.get("sword_bytes_received") == len(content) + len(content2)
+        metrics.reset()
+
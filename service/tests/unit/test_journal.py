@@ -0,0 +1,93 @@
+"""
+Tests on the deposit journal
+"""
+
+from unittest import TestCase
+from service import journal
+from octopus.core import app
+import os, shutil, tempfile
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.journal_dir = app.config.get("DEPOSIT_JOURNAL_DIR")
+        self.tmpdir = tempfile.mkdtemp()
+        app.config["DEPOSIT_JOURNAL_DIR"] = os.path.join(self.tmpdir, "journal")
+
+    def tearDown(self):
+        app.config["DEPOSIT_JOURNAL_DIR"] = self.journal_dir
+        shutil.rmtree(self.tmpdir)
+        super(TestJournal, self).tearDown()
+
+    def test_01_stages(self):
+        assert journal.get("acc1", "note1") is None
+
+        journal.begin("acc1", "note1", "dr1", "individual files")
+        entry = journal.get("acc1", "note1")
+        assert entry["stage"] == journal.INTENT
+        assert entry["deposit_record"] == "dr1"
+        assert "edit" not in entry
+
+        journal.advance("acc1", "note1", journal.CREATED, edit="http://sword/edit/1")
+        journal.advance("acc1", "note1", journal.CONTENT)
+        entry = journal.get("acc1", "note1")
+        assert entry["stage"] == journal.CONTENT
+        assert entry["edit"] == "http://sword/edit/1"
+
+        # entries are kept per account and notification
+        journal.begin("acc2", "note1", "dr2", "single zip file")
+        assert len(list(journal.entries())) == 2
+        assert journal.get("acc1", "note1")["deposit_record"] == "dr1"
+
+        # and nothing but the entries is left in the journal
+        assert all(name.endswith(".json") for name in os.listdir(app.config["DEPOSIT_JOURNAL_DIR"]))
+
+        journal.finish("acc1", "note1")
+        assert journal.get("acc1", "note1") is None
+        journal.finish("acc1", "note1")
+        assert len(list(journal.entries())) == 1
+
+    def test_02_disabled(self):
+        app.config["DEPOSIT_JOURNAL_DIR"] = None
+        journal.begin("acc1", "note1", "dr1", "individual files")
+        journal.advance("acc1", "note1", journal.CREATED, edit="http://sword/edit/1")
+        assert journal.get("acc1", "note1") is None
+        assert list(journal.entries()) == []
+
+    def test_03_listing(self):
+        journal.begin("acc1", "note1", "dr1", "individual files")
+
+        opened = []
+        real_open = open
+
+        def counting_open(path, *args, **kwargs):
+            opened.append(path)
+            return real_open(path, *args, **kwargs)
+
+        import builtins
+        builtins.open = counting_open
+        try:
+            with journal.listing():
+                # only the entries in the listing are read
+                assert journal.get("acc1", "note2") is None
+                assert opened == []
+                assert journal.get("acc1", "note1")["deposit_record"] == "dr1"
+                assert len(opened) == 1
+
+                # and the listing follows the entries written and removed during the pass
+                journal.begin("acc1", "note2", "dr2", "single zip file")
+                assert journal.get("acc1", "note2")["deposit_record"] == "dr2"
+                journal.finish("acc1", "note1")
+                assert journal.get("acc1", "note1") is None
+        finally:
+            builtins.open = real_open
+
+        # outside a pass, the journal directory is read directly
+        assert journal.get("acc1", "note2")["deposit_record"] == "dr2"
+
+    def test_04_listing_no_directory(self):
+        with journal.listing():
+            assert journal.get("acc1", "note1") is None
+            journal.begin("acc1", "note1", "dr1", "individual files")
+            assert journal.get("acc1", "note1")["deposit_record"] == "dr1"
@@ -0,0 +1,75 @@
+"""
+Tests on the signal handling which drains the runner and reloads its configuration
+"""
+
+from unittest import TestCase
+from service import lifecycle, settings
+from octopus.core import app
+import os, signal, tempfile, time
+
+
+class TestLifecycle(TestCase):
+    def setUp(self):
+        super(TestLifecycle, self).setUp()
+        self.handlers = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+        self.app_config = dict(app.config)
+        self.extra = settings._extra
+
+    def tearDown(self):
+        lifecycle._cancel_timer()
+        lifecycle._stopping.clear()
+        lifecycle._token = None
+        settings._extra = self.extra
+        for s, h in self.handlers.items():
+            signal.signal(s, h)
+        app.config.clear()
+        app.config.update(self.app_config)
+        super(TestLifecycle, self).tearDown()
+
+    def test_01_drain(self):
+        app.config["SHUTDOWN_GRACE_PERIOD"] = 0.5
+        lifecycle.install()
+        token = lifecycle.pass_token()
+        assert not lifecycle.stopping()
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert lifecycle.stopping()
+
+        # the pass stops scheduling, but the deposit in hand may finish
+        assert token.cancelled
+        token.check()
+
+        # the wait between passes is cut short
+        started = time.time()
+        lifecycle.sleep(10)
+        assert time.time() - started < 1
+
+        # a pass started after the request to stop does nothing
+        assert lifecycle.pass_token().cancelled
+
+        # and once the grace period is up, the work in hand is cancelled too
+        time.sleep(1)
+        assert lifecycle._token.reason == "shutdown grace period expired"
+
+        # a second SIGTERM is ignored, a second SIGINT exits at once
+        os.kill(os.getpid(), signal.SIGTERM)
+        with self.assertRaises(SystemExit):
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def test_02_reload(self):
+        fd, path = tempfile.mkstemp(suffix=".cfg")
+        try:
+            os.close(fd)
+            lifecycle.install(path)
+            assert settings.config_files()[-1] == path
+            assert not lifecycle.maybe_reload()
+
+            with open(path, "w") as f:
+                f.write("RUN_THROTTLE = 17\n")
+            os.kill(os.getpid(), signal.SIGHUP)
+            assert app.config.get("RUN_THROTTLE") != 17
+            assert lifecycle.maybe_reload()
+            assert app.config.get("RUN_THROTTLE") == 17
+            assert not lifecycle.maybe_reload()
+        finally:
+            os.remove(path)
@@ -0,0 +1,113 @@
+"""
+Tests on the queued, structured log
+"""
+
+from unittest import TestCase
+from octopus.core import app
+from service import logs, metrics
+import io, json, logging, multiprocessing
+
+
+class Counting(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __format__(self, spec):
+        self.calls += 1
+        return "counted"
+
+
+class TestLogs(TestCase):
+    def setUp(self):
+        super(TestLogs, self).setUp()
+        metrics.reset()
+        self.handlers = list(app.logger.handlers)
+        self.level = app.logger.level
+        self.log_level = app.config.get("LOG_LEVEL")
+        self.log_format = app.config.get("LOG_FORMAT")
+        self.out = io.StringIO()
+        self.target = logging.StreamHandler(self.out)
+
+    def tearDown(self):
+        logs.stop()
+        app.logger.handlers = self.handlers
+        app.logger.setLevel(self.level)
+        app.config["LOG_LEVEL"] = self.log_level
+        app.config["LOG_FORMAT"] = self.log_format
+        metrics.reset()
+        super(TestLogs, self).tearDown()
+
+    def _records(self):
+        return [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+    def test_01_lazy(self):
+        app.config["LOG_LEVEL"] = "INFO"
+        app.config["LOG_FORMAT"] = "json"
+        logs.start(self.target)
+        skipped, written = Counting(), Counting()
+        app.logger.debug(logs.lazy("Not written: {x}", x=skipped))
+        app.logger.info(logs.lazy("Written: {x}", x=written))
+        logs.stop()
+
+        # only the message which was written was formatted
+        assert skipped.calls == 0
+        assert written.calls > 0
+        records = self._records()
+        assert len(records) == 1
+        assert records[0]["message"] == "Written: counted"
+        assert records[0]["level"] == "INFO"
+
+    def test_02_context(self):
+        app.config["LOG_LEVEL"] = "DEBUG"
+        app.config["LOG_FORMAT"] = "json"
+        logs.start(self.target)
+        with metrics.in_flight("acc1", "note1"):
+            with metrics.stage("create"):
+                app.logger.debug("In the deposit")
+        app.logger.info("Outside the deposit", extra={"account": "acc2"})
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            app.logger.exception("Failed")
+        logs.stop()
+
+        # once stopped, the handlers are attached directly again
+        assert self.target in app.logger.handlers
+        app.logger.info("After stopping")
+
+        records = self._records()
+        assert len(records) == 4
+        assert records[0]["account"] == "acc1"
+        assert records[0]["notification"] == "note1"
+        assert records[0]["stage"] == "create"
+        assert records[1]["account"] == "acc2"
+        assert "notification" not in records[1]
+        assert "ValueError: oops" in records[2]["exception"]
+        assert records[3]["message"] == "After stopping"
+
+    def test_03_text(self):
+        app.config["LOG_LEVEL"] = "INFO"
+        app.config["LOG_FORMAT"] = "text"
+        logs.start(self.target)
+        app.logger.info(logs.lazy("Plain {x}", x="text"))
+        logs.stop()
+        assert "INFO: Plain text [in " in self.out.getvalue()
+
+    def test_04_shared(self):
+        app.config["LOG_LEVEL"] = "INFO"
+        app.config["LOG_FORMAT"] = "json"
+        logs.start(self.target)
+        logs.share(multiprocessing.get_context("fork"))
+
+        # on a queue shared with other processes, the message is rendered before it is sent
+        record = app.logger.makeRecord(app.logger.name, logging.INFO, __file__, 1, logs.lazy("Sent {x}", x=1), None,
+                                       None)
+        with metrics.in_flight("acc1", "note1"):
+            prepared = logs._handler.prepare(record)
+        assert prepared.msg == "Sent 1"
+        assert prepared.args is None
+        assert prepared.account == "acc1"
+
+        app.logger.info(logs.lazy("Through the shared queue {x}", x=2))
+        logs.stop()
+        assert self._records()[0]["message"] == "Through the shared queue 2"
@@ -150,3 +150,58 @@ class TestModels(ESTestCase):
         assert r.completed_status == "failed"
         assert r.deposit_date == dd
 
+
+    def test_05_views(self):
+        acc = models.Account()
+        acc.id = "acc1"
+        acc.add_sword_credentials("acc1", "pass1", "http://sword/1", "single zip file")
+        acc.add_packaging("http://purl.org/net/sword/package/SimpleZip")
+        acc.repository_software = "eprints"
+
+        # the view carries the account's fields, coerced as by the model
+        av = acc.view()
+        assert av.id == "acc1"
+        assert av.sword_username == "acc1"
+        assert av.sword_password == "pass1"
+        assert av.sword_collection == "http://sword/1"
+        assert av.sword_deposit_method == "single zip file"
+        assert av.repository_software == "eprints"
+        assert av.packaging == ("http://purl.org/net/sword/package/SimpleZip",)
+        assert models.AccountView.of(av) is av
+
+        # and is read-only, and detached from the model
+        with self.assertRaises(AttributeError):
+            av.sword_collection = "http://sword/2"
+        with self.assertRaises(AttributeError):
+            av.other = "value"
+        acc.sword_collection = "http://sword/2"
+        assert av.sword_collection == "http://sword/1"
+
+        dr = models.DepositRecord()
+        dr.id = "dr1"
+        dr.notification = "123456"
+        dr.repository = "acc1"
+        dr.metadata_status = "deposited"
+        dr.content_status = "none"
+        dr.completed_status = "none"
+        drv = dr.view()
+        assert drv.notification == "123456"
+        assert drv.was_successful() == dr.was_successful() == True
+        dr.completed_status = "failed"
+        assert dr.view().was_successful() is False
+
+        rs = models.RepositoryStatus()
+        rs.id = "acc1"
+        rs.status = "problem"
+        rs.retries = 2
+        rsv = rs.view()
+        assert rsv.status == "problem"
+        assert rsv.retries == 2
+
+        rn = models.RequestNotification()
+        rn.account_id = "acc1"
+        rn.notification_id = "123456"
+        rn.status = "queued"
+        rnv = rn.view()
+        assert rnv.notification_id == "123456"
+        assert rnv.status == "queued"
@@ -0,0 +1,100 @@
+"""
+Tests on the signal-triggered profiling and stack dumps
+"""
+
+from unittest import TestCase
+from octopus.core import app
+from service import metrics, profiling
+import os, shutil, signal, tempfile, time, tracemalloc
+
+
+def busy(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sum(range(1000))
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.handlers = {s: signal.getsignal(s) for s in (signal.SIGUSR1, signal.SIGUSR2)}
+        self.app_config = dict(app.config)
+        self.dir = tempfile.mkdtemp()
+        app.config["PROFILE_DIR"] = self.dir
+        metrics.reset()
+
+    def tearDown(self):
+        profiling._remaining = 0
+        profiling._memory = None
+        profiling._forward = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        for s, h in self.handlers.items():
+            signal.signal(s, h)
+        app.config.clear()
+        app.config.update(self.app_config)
+        shutil.rmtree(self.dir)
+        metrics.reset()
+        super(TestProfiling, self).tearDown()
+
+    def test_01_pass_profile(self):
+        app.config["PROFILE_PASSES"] = 2
+        app.config["PROFILE_SAMPLE_INTERVAL"] = 0.005
+        profiling.install()
+
+        # nothing is profiled until asked
+        with profiling.pass_profile():
+            busy(0.05)
+        assert os.listdir(self.dir) == []
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert profiling.profiling()
+        with profiling.pass_profile():
+            busy(0.2)
+
+        files = sorted(os.listdir(self.dir))
+        assert len(files) == 2
+        assert files[0].endswith(".collapsed") and files[1].endswith(".pstats")
+
+        # one line per distinct stack, outermost first, with the number of samples
+        with open(os.path.join(self.dir, files[0])) as f:
+            lines = f.read().splitlines()
+        assert len(lines) > 0
+        assert any("test_01_pass_profile" in l and "busy" in l for l in lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        assert int(count) > 0
+
+        import pstats
+        stats = pstats.Stats(os.path.join(self.dir, files[1]))
+        assert any(func[2] == "busy" for func in stats.stats.keys())
+        assert metrics.snapshot()["counters"][("profiles_written", ())] == 1
+
+        # a second signal stops profiling after the pass in hand
+        assert profiling.profiling()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert not profiling.profiling()
+
+    def test_02_dump(self):
+        with metrics.in_flight("acc1", "note1"):
+            first = profiling.dump()
+        with open(first) as f:
+            text = f.read()
+        assert "Account:acc1 Notification:note1" in text
+        assert "test_02_dump" in text
+        assert "tracemalloc started" in text
+        assert tracemalloc.is_tracing()
+
+        hold = [bytearray(1024) for i in range(1000)]
+        second = profiling.dump()
+        with open(second) as f:
+            text = f.read()
+        assert "bytes traced" in text
+        assert "test_profiling.py" in text
+        assert len(hold) == 1000
+
+    def test_03_forward(self):
+        forwarded = []
+        profiling.install(forward=forwarded.append)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert forwarded == [signal.SIGUSR1]
+        assert not profiling.profiling()
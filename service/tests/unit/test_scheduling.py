@@ -0,0 +1,81 @@
+"""
+Tests on the fair-share scheduling of accounts
+"""
+
+from unittest import TestCase
+from service import scheduling
+from octopus.core import app
+import time
+
+
+class TestScheduling(TestCase):
+    def setUp(self):
+        super(TestScheduling, self).setUp()
+        self.weights = app.config.get("ACCOUNT_QUOTA_WEIGHTS")
+        self.deposit_quota = app.config.get("ACCOUNT_PASS_DEPOSIT_QUOTA")
+        self.time_quota = app.config.get("ACCOUNT_PASS_TIME_QUOTA")
+
+    def tearDown(self):
+        app.config["ACCOUNT_QUOTA_WEIGHTS"] = self.weights
+        app.config["ACCOUNT_PASS_DEPOSIT_QUOTA"] = self.deposit_quota
+        app.config["ACCOUNT_PASS_TIME_QUOTA"] = self.time_quota
+        super(TestScheduling, self).tearDown()
+
+    def test_01_deposit_quota(self):
+        quota = scheduling.AccountQuota(deposits=2)
+        assert not quota.exhausted()
+        quota.record_deposit()
+        assert not quota.exhausted()
+        quota.record_deposit()
+        assert quota.exhausted()
+
+        # no limits, never exhausted
+        quota = scheduling.AccountQuota()
+        for i in range(1000):
+            quota.record_deposit()
+        assert not quota.exhausted()
+
+    def test_02_time_quota(self):
+        quota = scheduling.AccountQuota(seconds=0.1)
+        assert not quota.exhausted()
+        time.sleep(0.2)
+        assert quota.exhausted()
+
+    def test_03_weights(self):
+        app.config["ACCOUNT_QUOTA_WEIGHTS"] = {"big": 0.5, "vip": 3}
+        app.config["ACCOUNT_PASS_DEPOSIT_QUOTA"] = 10
+        app.config["ACCOUNT_PASS_TIME_QUOTA"] = 0
+
+        assert scheduling.AccountQuota.for_account("big").deposits == 5
+        assert scheduling.AccountQuota.for_account("vip").deposits == 30
+        assert scheduling.AccountQuota.for_account("other").deposits == 10
+        assert scheduling.AccountQuota.for_account("other").seconds is None
+
+    def test_04_rotate(self):
+        accs = ["a", "b", "c"]
+        firsts = set()
+        for i in range(3):
+            order = scheduling.rotate(accs)
+            assert sorted(order) == accs
+            firsts.add(order[0])
+        assert firsts == set(accs)
+        assert scheduling.rotate([]) == []
+
+    def test_05_resume_at(self):
+        class Acc(object):
+            def __init__(self, id):
+                self.id = id
+        accs = [Acc("a"), Acc("b"), Acc("c")]
+
+        scheduling.resume_at("b")
+        order = scheduling.rotate(accs)
+        assert [acc.id for acc in order] == ["b", "c", "a"]
+
+        # and then carries on rotating from there
+        order = scheduling.rotate(accs)
+        assert [acc.id for acc in order] == ["c", "a", "b"]
+
+        # an account which has since gone is ignored
+        scheduling.resume_at("x")
+        order = scheduling.rotate(accs)
+        assert sorted([acc.id for acc in order]) == ["a", "b", "c"]
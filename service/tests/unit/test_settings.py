@@ -0,0 +1,78 @@
+"""
+Tests on the settings which are reloaded while the depositor is running
+"""
+
+from unittest import TestCase
+from service import settings
+from octopus.core import app
+import os, tempfile
+
+
+class TestSettings(TestCase):
+    def setUp(self):
+        super(TestSettings, self).setUp()
+        self.app_config = dict(app.config)
+        self.extra = settings._extra
+        fd, self.path = tempfile.mkstemp(suffix=".cfg")
+        os.close(fd)
+        settings.init(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+        settings._extra = self.extra
+        settings.init()
+        app.config.clear()
+        app.config.update(self.app_config)
+        super(TestSettings, self).tearDown()
+
+    def _write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_01_validate(self):
+        apply, restart, errors = settings.validate({
+            "RUN_THROTTLE": 0.5,
+            "MAX_DEPOSIT_ATTEMPTS": 0,
+            "LONG_CYCLE_RETRY_LIMIT": "24",
+            "PASS_DEADLINE": None,
+            "DEFAULT_SINCE_DATE": "yesterday",
+            "ACCOUNT_QUOTA_WEIGHTS": {"acc1": 2, "acc2": -1},
+            "XWALK_ENGINE": "stream",
+            "WORKERS": 8
+        })
+        assert apply == {"RUN_THROTTLE": 0.5, "PASS_DEADLINE": None, "XWALK_ENGINE": "stream"}
+        assert restart == ["WORKERS"]
+        assert len(errors) == 4
+        assert "RUN_THROTTLE" in settings.reloadable()
+
+    def test_02_reload(self):
+        # nothing has changed
+        assert not settings.changed()
+        assert not settings.maybe_reload()
+        assert not settings.maybe_reload(force=True)
+
+        # a valid change is applied once the file is modified
+        self._write("RUN_THROTTLE = 11\nLONG_CYCLE_RETRY_DELAY = 60\n")
+        assert settings.changed()
+        assert settings.maybe_reload()
+        assert app.config.get("RUN_THROTTLE") == 11
+        assert app.config.get("LONG_CYCLE_RETRY_DELAY") == 60
+        assert not settings.changed()
+
+        # if any change is invalid, none of them is applied
+        self._write("RUN_THROTTLE = 12\nLONG_CYCLE_RETRY_DELAY = -1\n")
+        assert not settings.maybe_reload(force=True)
+        assert app.config.get("RUN_THROTTLE") == 11
+        assert app.config.get("LONG_CYCLE_RETRY_DELAY") == 60
+
+        # and a setting which needs a restart is left alone
+        self._write("RUN_THROTTLE = 12\nLONG_CYCLE_RETRY_DELAY = 60\nWORKERS = 8\n")
+        workers = app.config.get("WORKERS")
+        assert settings.maybe_reload(force=True)
+        assert app.config.get("RUN_THROTTLE") == 12
+        assert app.config.get("WORKERS") == workers
+
+        # a file which cannot be read is not applied either
+        self._write("RUN_THROTTLE = \n")
+        assert not settings.maybe_reload(force=True)
+        assert app.config.get("RUN_THROTTLE") == 12
@@ -0,0 +1,150 @@
+"""
+Tests on the live state held in the metrics, and the status server which reports it
+"""
+
+from unittest import TestCase
+from flask import Flask
+from service import metrics, status
+import json, time
+
+
+class TestStatus(TestCase):
+    def setUp(self):
+        super(TestStatus, self).setUp()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        super(TestStatus, self).tearDown()
+
+    def test_01_in_flight(self):
+        @metrics.timed("create")
+        def create():
+            # the deposit is in this stage while the function runs
+            return metrics.snapshot()["in_flight"][0]["stage"]
+
+        with metrics.in_flight("acc1", "note1"):
+            snap = metrics.snapshot()
+            assert len(snap["in_flight"]) == 1
+            assert snap["in_flight"][0]["account"] == "acc1"
+            assert snap["in_flight"][0]["stage"] is None
+
+            with metrics.stage("download"):
+                assert metrics.snapshot()["in_flight"][0]["stage"] == "download"
+                assert create() == "create"
+                assert metrics.snapshot()["in_flight"][0]["stage"] == "download"
+
+        snap = metrics.snapshot()
+        assert snap["in_flight"] == []
+        assert len(snap["recent"][("stage_seconds", (("stage", "download"),))]) == 1
+        assert len(snap["recent"][("stage_seconds", (("stage", "create"),))]) == 1
+
+        # the live state of a process which has exited is dropped, but its counts are kept
+        metrics.incr("deposits")
+        metrics.age("account_max_undelivered", 100, account="acc1")
+        with metrics.in_flight("acc1", "note2"):
+            retired = metrics.retire(metrics.snapshot())
+        assert retired["counters"][("deposits", ())] == 1
+        assert "gauges" not in retired and "ages" not in retired and "in_flight" not in retired
+
+    def test_02_document(self):
+        metrics.incr("xwalk_cache_hits", 3)
+        metrics.incr("xwalk_cache_misses")
+        metrics.incr("deposits", account="acc1")
+        metrics.age("account_max_undelivered", time.time() - 60, account="acc1")
+        metrics.gauge("account_pass_deposits", 5, account="acc1")
+        metrics.age("account_max_undelivered", 0, account="acc2")
+        for lag in (30, 100, 100, 5000):
+            metrics.histogram("account_deposit_lag_seconds", lag, [60, 300, 3600], account="acc2")
+        metrics.gauge("report_queue_depth", 2)
+        metrics.pass_progress(started=time.time(), finished=None, accounts=2, accounts_done=1, account="acc2")
+        for i in range(10):
+            metrics.observe("stage_seconds", i + 1, stage="update")
+
+        with metrics.in_flight("acc2", "note1"):
+            with metrics.stage("update"):
+                doc = status.document(metrics.snapshot())
+
+        assert doc["in_flight"][0]["notification"] == "note1"
+        assert doc["in_flight"][0]["stage"] == "update"
+        assert doc["passes"][0]["accounts_done"] == 1
+        assert doc["accounts"]["acc1"]["pass_deposits"] == 5
+        assert 59 <= doc["accounts"]["acc1"]["max_undelivered_age_seconds"] <= 61
+        assert doc["accounts"]["acc2"]["oldest_undelivered"] is None
+        assert doc["accounts"]["acc1"]["lag"] is None
+        assert doc["accounts"]["acc2"]["lag"]["deposits"] == 4
+        assert doc["accounts"]["acc2"]["lag"]["p50_seconds"] == 300
+        assert doc["accounts"]["acc2"]["lag"]["p90_seconds"] == "+Inf"
+        assert 59 <= doc["max_undelivered_age_seconds"] <= 61
+        assert doc["caches"]["xwalk"]["hit_rate"] == 0.75
+        assert doc["caches"]["deposit_filter"]["hit_rate"] is None
+        assert doc["queues"] == {"report": 2}
+        assert doc["stages"]["update"]["median_seconds"] == 5
+        assert doc["stages"]["update"]["max_seconds"] == 10
+        assert doc["counters"]["deposits{account=acc1}"] == 1
+
+    def test_03_endpoints(self):
+        metrics.incr("deposits", 2)
+        metrics.incr("deposits", account='odd"id')
+        metrics.gauge("report_queue_depth", 1)
+        metrics.observe("stage_seconds", 0.5, stage="create")
+
+        web = Flask(__name__)
+        web.register_blueprint(status.blueprint)
+        client = web.test_client()
+
+        resp = client.get("/status")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["counters"]["deposits"] == 2
+
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        text = resp.data.decode("utf-8")
+        assert "# TYPE sword_out_deposits_total counter" in text
+        assert "sword_out_deposits_total 2" in text
+        assert 'sword_out_deposits_total{account="odd\\"id"} 1' in text
+        assert "sword_out_report_queue_depth 1" in text
+        assert 'sword_out_stage_seconds_recent{stage="create",quantile="0.5"} 0.5' in text
+        assert "sword_out_in_flight 0" in text
+
+    def test_04_lag(self):
+        buckets = [60, 300, 3600]
+        for lag in (10, 200, 200, 4000):
+            metrics.histogram("deposit_lag_seconds", lag, buckets)
+        first = metrics.snapshot()
+        metrics.reset()
+        metrics.histogram("deposit_lag_seconds", 50, buckets)
+        metrics.age("account_max_undelivered", 2000, account="acc1")
+        second = metrics.snapshot()
+        metrics.age("account_max_undelivered", 1000, account="acc1")
+        third = metrics.snapshot()
+
+        # histograms from several processes are summed, and the oldest of each age is kept
+        total = metrics.merge(first, second, third)
+        h = total["histograms"][("deposit_lag_seconds", ())]
+        assert h["counts"] == [3, 2, 0]
+        assert h["count"] == 6
+        assert metrics.histogram_quantile(h, 0.5) == 60
+        assert metrics.ages(total, now=3000)[("account_max_undelivered", (("account", "acc1"),))] == 2000
+
+        text = metrics.format_prometheus(total)
+        assert "# TYPE sword_out_deposit_lag_seconds histogram" in text
+        assert 'sword_out_deposit_lag_seconds_bucket{le="60"} 3' in text
+        assert 'sword_out_deposit_lag_seconds_bucket{le="300"} 5' in text
+        assert 'sword_out_deposit_lag_seconds_bucket{le="+Inf"} 6' in text
+        assert "sword_out_deposit_lag_seconds_count 6" in text
+        assert 'sword_out_account_max_undelivered_age_seconds{account="acc1"}' in text
+
+    def test_05_delta(self):
+        metrics.incr("deposits", 2)
+        metrics.incr("notifications_skipped", reason="deposited")
+        before = metrics.counters()
+        metrics.incr("deposits")
+        metrics.incr("notifications_skipped", reason="deposited")
+        metrics.incr("notifications_skipped", 2, reason="attempts")
+
+        # the increase since the copy was taken, summed over the labels
+        counts = metrics.delta(before, metrics.counters())
+        assert counts["deposits"] == 1
+        assert counts["notifications_skipped"] == 3
+
@@ -0,0 +1,55 @@
+"""
+Tests on the multi-process supervisor and the metrics it aggregates
+"""
+
+from unittest import TestCase
+from service import supervisor, metrics
+import uuid
+
+
+class TestSupervisor(TestCase):
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        super(TestSupervisor, self).tearDown()
+
+    def test_01_partition(self):
+        ids = [uuid.uuid4().hex for i in range(200)]
+        partitions = [supervisor.Partition(i, 4) for i in range(4)]
+
+        # every account is owned by exactly one partition
+        for acc_id in ids:
+            owners = [p for p in partitions if p.owns(acc_id)]
+            assert len(owners) == 1
+
+        # and the allocation is stable
+        for acc_id in ids:
+            assert supervisor.partition_of(acc_id, 4) == supervisor.partition_of(acc_id, 4)
+
+        # and no partition is left empty
+        for p in partitions:
+            assert len([acc_id for acc_id in ids if p.owns(acc_id)]) > 0
+
+    def test_02_metrics_merge(self):
+        metrics.incr("deposits")
+        metrics.incr("deposits", 2)
+        metrics.incr("deposits", account="acc1")
+        first = metrics.snapshot()
+
+        assert metrics.get("deposits") == 3
+        assert metrics.get("deposits", account="acc1") == 1
+
+        metrics.reset()
+        metrics.incr("deposits", 5)
+        second = metrics.snapshot()
+
+        total = metrics.merge(first, second, None)
+        assert total["counters"][("deposits", ())] == 8
+        assert total["counters"][("deposits", (("account", "acc1"),))] == 1
+
+        line = metrics.format_counters(total)
+        assert "deposits=8" in line
+        assert "deposits{account=acc1}=1" in line
@@ -0,0 +1,126 @@
+"""
+Tests on the housekeeping of the temp store
+"""
+
+from unittest import TestCase
+from service import tmpstore
+from service.cancellation import CancellationToken, Cancelled
+from octopus.core import app
+import os, shutil, tempfile, time, uuid
+
+
+class TestTmpStore(TestCase):
+    def setUp(self):
+        super(TestTmpStore, self).setUp()
+        self.config = {k: app.config.get(k) for k in ["STORE_TMP_DIR", "TMP_STORE_QUOTA", "TMP_STORE_MIN_FREE",
+                                                     "TMP_STORE_WAIT", "TMP_STORE_USAGE_TTL"]}
+        self.tmpdir = tempfile.mkdtemp()
+        app.config["STORE_TMP_DIR"] = self.tmpdir
+        app.config["TMP_STORE_MIN_FREE"] = None
+
+    def tearDown(self):
+        for k, v in self.config.items():
+            app.config[k] = v
+        shutil.rmtree(self.tmpdir)
+        super(TestTmpStore, self).tearDown()
+
+    def _entry(self, age, size=10):
+        path = os.path.join(self.tmpdir, uuid.uuid4().hex)
+        os.makedirs(path)
+        fn = os.path.join(path, "SimpleZip")
+        with open(fn, "wb") as f:
+            f.write(b"x" * size)
+        then = time.time() - age
+        os.utime(fn, (then, then))
+        os.utime(path, (then, then))
+        return path
+
+    def test_01_sweep(self):
+        old = self._entry(7200)
+        new = self._entry(10)
+        os.makedirs(os.path.join(self.tmpdir, "partial"))
+        part = os.path.join(self.tmpdir, "partial", "abc.part")
+        with open(part, "wb") as f:
+            f.write(b"x")
+        os.utime(part, (time.time() - 7200, time.time() - 7200))
+        with open(part + ".validator", "w") as f:
+            f.write('"v1"')
+        readme = os.path.join(self.tmpdir, "README.md")
+        with open(readme, "w") as f:
+            f.write("not ours")
+        os.utime(readme, (time.time() - 7200, time.time() - 7200))
+
+        assert tmpstore.sweep(3600) == 2
+        assert not os.path.exists(old)
+        assert not os.path.exists(part)
+        assert not os.path.exists(part + ".validator")
+        assert os.path.exists(new)
+        assert os.path.exists(readme)
+        assert os.path.exists(os.path.join(self.tmpdir, "partial"))
+
+    def test_02_quota(self):
+        self._entry(10, size=1000)
+        assert tmpstore.usage() == 1000
+
+        app.config["TMP_STORE_QUOTA"] = 1500
+        assert tmpstore.has_space(400)
+        assert not tmpstore.has_space(600)
+
+        # there is no room, and none is freed in the time allowed, so the pass is cancelled
+        app.config["TMP_STORE_WAIT"] = 0
+        token = CancellationToken()
+        with self.assertRaises(Cancelled):
+            tmpstore.reserve(600, token)
+        assert token.cancelled
+
+        tmpstore.reserve(400, token)
+
+    def test_03_in_memory(self):
+        with tempfile.SpooledTemporaryFile(max_size=100, dir=self.tmpdir) as f:
+            f.write(b"x" * 100)
+            assert tmpstore.in_memory(f)
+            f.write(b"x")
+            assert not tmpstore.in_memory(f)
+
+        with tempfile.TemporaryFile(dir=self.tmpdir) as f:
+            assert not tmpstore.in_memory(f)
+
+    def test_04_spooled_file(self):
+        self._entry(10, size=1000)
+        app.config["TMP_STORE_QUOTA"] = 1500
+        app.config["TMP_STORE_WAIT"] = 0
+
+        # content held in memory needs no room in the store, and rolls over to disk if there is room for it
+        with tmpstore.SpooledFile(100) as f:
+            f.write(b"x" * 100)
+            assert tmpstore.in_memory(f)
+            f.write(b"x" * 100)
+            assert not tmpstore.in_memory(f)
+
+        # but if there is no room, the pass is cancelled before it rolls over
+        token = CancellationToken()
+        with tmpstore.SpooledFile(100, expected=600, token=token) as f:
+            with self.assertRaises(Cancelled):
+                f.write(b"x" * 101)
+            assert token.cancelled
+            assert tmpstore.in_memory(f)
+
+    def test_05_usage_cached(self):
+        app.config["TMP_STORE_USAGE_TTL"] = 60
+        self._entry(10, size=1000)
+        assert tmpstore.usage() == 1000
+
+        # the store is not measured again within the interval, but reservations are counted against it
+        self._entry(10, size=500)
+        assert tmpstore.usage() == 1000
+        tmpstore.reserve(200)
+        assert tmpstore.usage() == 1200
+
+        # a sweep measures it afresh
+        tmpstore.sweep(3600)
+        assert tmpstore.usage() == 1500
+
+        # as does every call, if there is no interval
+        app.config["TMP_STORE_USAGE_TTL"] = 0
+        self._entry(10, size=100)
+        assert tmpstore.usage() == 1600
@@ -0,0 +1,146 @@
+"""
+Tests on the watchdog which aborts deposits stuck in a stage
+"""
+
+from unittest import TestCase
+from octopus.core import app
+from service import metrics, watchdog, http_layer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os, tempfile, threading, time
+
+
+class HangingHandler(BaseHTTPRequestHandler):
+    """
+    Reads the request, then never responds
+    """
+    release = threading.Event()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.release.wait(30)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWatchdog(TestCase):
+    def setUp(self):
+        super(TestWatchdog, self).setUp()
+        metrics.reset()
+        self.app_config = dict(app.config)
+        app.config["WATCHDOG_STAGE_BUDGETS"] = {"create": 0.2, "es": 0.2}
+        app.config["WATCHDOG_ABORT"] = True
+        HangingHandler.release.clear()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), HangingHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{x}/collection".format(x=self.server.server_port)
+
+    def tearDown(self):
+        HangingHandler.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        watchdog.stop()
+        watchdog._reported.clear()
+        app.config.clear()
+        app.config.update(self.app_config)
+        metrics.reset()
+        super(TestWatchdog, self).tearDown()
+
+    def _deposit(self, stage, work):
+        """
+        Run work in a thread, as a deposit in flight in a stage, and return a dict which receives its outcome
+        """
+        outcome = {}
+        started = threading.Event()
+
+        def run():
+            with metrics.in_flight("acc1", "note1"):
+                with metrics.stage(stage):
+                    started.set()
+                    try:
+                        outcome["result"] = work()
+                    except Exception as e:
+                        outcome["error"] = e
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        started.wait(5)
+        outcome["thread"] = t
+        return outcome
+
+    def test_01_stall(self):
+        release = threading.Event()
+        aborted = []
+
+        def work():
+            with watchdog.on_abort(lambda: aborted.append(True)):
+                release.wait(10)
+
+        outcome = self._deposit("create", work)
+        # within its budget
+        assert watchdog.check() == []
+
+        stalled = watchdog.check(now=time.time() + 1)
+        assert stalled == [outcome["thread"].ident]
+        assert aborted == [True]
+        assert metrics.get("watchdog_stalls", stage="create") == 1
+        assert metrics.get("watchdog_aborts", stage="create") == 1
+
+        # each overrun is dealt with once
+        assert watchdog.check(now=time.time() + 2) == []
+        assert metrics.get("watchdog_stalls", stage="create") == 1
+
+        release.set()
+        outcome["thread"].join(5)
+
+    def test_02_not_abortable(self):
+        release = threading.Event()
+        outcome = self._deposit("es", lambda: release.wait(10))
+        assert len(watchdog.check(now=time.time() + 1)) == 1
+        assert metrics.get("watchdog_stalls", stage="es") == 1
+        assert metrics.get("watchdog_aborts", stage="es") == 0
+
+        # the stage with no budget is left alone
+        app.config["WATCHDOG_STAGE_BUDGETS"] = {}
+        watchdog._reported.clear()
+        assert watchdog.check(now=time.time() + 1000) == []
+
+        release.set()
+        outcome["thread"].join(5)
+
+    def test_03_abort_request(self):
+        layer = http_layer.SwordHttpLayer(timeout=None)
+        outcome = self._deposit("create", lambda: layer.request(self.url, "POST", headers={}, payload=b"x" * 100))
+        time.sleep(0.3)
+        assert len(watchdog.check()) == 1
+        outcome["thread"].join(5)
+        assert not outcome["thread"].is_alive()
+        assert isinstance(outcome.get("error"), watchdog.Aborted)
+
+    def test_04_abort_streamed_upload(self):
+        layer = http_layer.SwordHttpLayer(timeout=None)
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(os.urandom(1024 * 1024))
+        f.close()
+        try:
+            with open(f.name, "rb") as payload:
+                outcome = self._deposit("create", lambda: layer.request(self.url, "POST", headers={}, payload=payload))
+                time.sleep(0.3)
+                assert len(watchdog.check()) == 1
+                outcome["thread"].join(5)
+            assert not outcome["thread"].is_alive()
+            assert isinstance(outcome.get("error"), watchdog.Aborted)
+        finally:
+            os.remove(f.name)
+
+    def test_05_thread(self):
+        app.config["WATCHDOG_INTERVAL"] = 0.05
+        layer = http_layer.SwordHttpLayer(timeout=None)
+        assert watchdog.start()
+        outcome = self._deposit("create", lambda: layer.request(self.url, "GET"))
+        outcome["thread"].join(5)
+        assert isinstance(outcome.get("error"), watchdog.Aborted)
+        watchdog.stop()
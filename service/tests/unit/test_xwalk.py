@@ -7,7 +7,10 @@ from unittest import TestCase
 from service.tests import fixtures
 import sword2
 from service import xwalk
+from service.xwalk_stream import StreamingEntry
+from service.tests.performance import bench_xwalk
 from octopus.modules.jper import models
+from octopus.core import app
 
 TERMS = "http://purl.org/dc/terms/"
 DC = "http://purl.org/dc/elements/"
@@ -18,9 +21,13 @@ ATOM = "http://www.w3.org/2005/Atom"
 class TestModels(TestCase):
     def setUp(self):
         super(TestModels, self).setUp()
+        self.old_cache_size = app.config.get("XWALK_CACHE_SIZE")
+        xwalk.clear_cache()
 
     def tearDown(self):
         super(TestModels, self).tearDown()
+        app.config["XWALK_CACHE_SIZE"] = self.old_cache_size
+        xwalk.clear_cache()
 
     def test_01_xwalk(self):
         e = sword2.Entry()
@@ -165,3 +172,83 @@ class TestModels(TestCase):
 
         subs = _texts(DC, "subject")
         assert len(subs) == 4
+
+    def test_02_stream_engine(self):
+        # the streaming entry must serialise to exactly the same XML as the sword client's Entry
+        sources = [fixtures.NotificationFactory.outgoing_notification(),
+                   fixtures.NotificationFactory.special_character_notification()]
+        escapes = fixtures.NotificationFactory.outgoing_notification()
+        escapes["metadata"]["title"] = 'Fish & "Chips" <b>\r\n\t]]> é\U0001F600'
+        escapes["metadata"]["author"][0]["identifier"][0]["id"] = 'a&b "c"\t<d>\n'
+        sources.append(escapes)
+
+        for source in sources:
+            n = models.OutgoingNotification(source)
+            dom = sword2.Entry(updated="2020-01-01T00:00:00")
+            xwalk.to_dc_rioxx(n, dom)
+            stream = StreamingEntry(updated="2020-01-01T00:00:00")
+            xwalk.to_dc_rioxx(n, stream)
+            assert str(stream) == str(dom)
+
+        # and refuse the same values
+        stream = StreamingEntry()
+        stream.register_namespace("dc", DC)
+        with self.assertRaises(ValueError):
+            stream.add_field("dc_title", "bad \x01 character")
+        with self.assertRaises(TypeError):
+            stream.add_field("dc_title", "ok", attrs={"id": None})
+
+    def test_03_entry_cache(self):
+        app.config["XWALK_CACHE_SIZE"] = 2
+
+        source = fixtures.NotificationFactory.outgoing_notification()
+        source["id"] = "1111"
+        source["last_updated"] = "2020-01-01T00:00:00Z"
+        n = models.OutgoingNotification(source)
+
+        # the first crosswalk is cached, and the second gets the same XML
+        first = xwalk.entry_for(n)
+        assert "<dc:title" in str(first)
+        assert xwalk.entry_for(n).xml is first.xml
+
+        # a new version of the notification is crosswalked afresh
+        source["last_updated"] = "2020-01-02T00:00:00Z"
+        updated = models.OutgoingNotification(source)
+        assert xwalk.entry_for(updated).xml is not first.xml
+
+        # the least recently used entry is evicted when the cache is full
+        source["id"] = "2222"
+        xwalk.entry_for(models.OutgoingNotification(source))
+        assert len(xwalk._cache) == 2
+        assert ("1111", "2020-01-01T00:00:00Z") not in xwalk._cache
+        assert ("1111", "2020-01-02T00:00:00Z") in xwalk._cache
+
+        # and nothing is cached when it is disabled
+        xwalk.clear_cache()
+        app.config["XWALK_CACHE_SIZE"] = 0
+        xwalk.entry_for(n)
+        assert len(xwalk._cache) == 0
+
+    def test_04_benchmark_gate(self):
+        # generated notifications are crosswalked with all their authors
+        n = bench_xwalk.generate_notification(25)
+        entry = xwalk.new_entry()
+        xwalk.to_dc_rioxx(n, entry)
+        assert str(entry).count("<atom:author") == 25
+
+        # and the gate only fails on figures worse than the baseline by more than the tolerance
+        base = {"dom": {"10": {"build_per_sec": 100.0, "serialise_per_sec": 200.0, "allocated_blocks": 1000, "peak_bytes": 50000}}}
+        ok = {"dom": {"10": {"build_per_sec": 80.0, "serialise_per_sec": 250.0, "allocated_blocks": 1200, "peak_bytes": 40000}}}
+        bad = {"dom": {"10": {"build_per_sec": 70.0, "serialise_per_sec": 200.0, "allocated_blocks": 1000, "peak_bytes": 70000}}}
+        assert bench_xwalk.compare(ok, base, 0.25) == []
+        regressions = bench_xwalk.compare(bad, base, 0.25)
+        assert len(regressions) == 2
+        assert "build_per_sec" in regressions[0]
+        assert "peak_bytes" in regressions[1]
+
+        # and figures which have no baseline to be compared against fail it too
+        more = {"dom": {"10": ok["dom"]["10"], "100": ok["dom"]["10"]}, "stream": {"10": ok["dom"]["10"]}}
+        regressions = bench_xwalk.compare(more, base, 0.25)
+        assert len(regressions) == 2
+        assert any("dom/100" in r for r in regressions)
+        assert any("stream" in r for r in regressions)
@@ -0,0 +1,232 @@
+"""
+Housekeeping for the local temporary store (STORE_TMP_DIR).
+
+Content is downloaded into the temporary store on its way from JPER to the repositories.  Entries can be left
+behind when a deposit fails in an unexpected way, or the process is killed, so sweep() removes any which have not
+been touched for TMP_STORE_MAX_AGE seconds.  It is run when the runner (or supervisor) starts, and then every
+TMP_STORE_SWEEP_INTERVAL seconds.
+
+Before each download to disk (and before a download held in memory rolls over to disk, see SpooledFile), reserve()
+checks that the store is within its quota (TMP_STORE_QUOTA) and that the disk has TMP_STORE_MIN_FREE bytes to spare.
+If not, it sweeps, then backs off until space is freed, and if that takes longer than TMP_STORE_WAIT it cancels the
+pass, so that the remaining work is deferred rather than filling the disk.  Measuring the store means walking all of
+it, so the size is remembered for TMP_STORE_USAGE_TTL seconds (or until the next sweep), and each reservation is
+added to it in the meantime.
+"""
+import io, os, shutil, tempfile, time
+from octopus.core import app
+from service import metrics
+from service.cancellation import Cancelled
+
+_last_sweep = None
+
+_usage = None
+"""the last measurement of the store, as a tuple of the directory, its size in bytes and when it was measured"""
+
+
+def _entry_mtime(path):
+    """
+    The most recent modification time of a file, or of a directory and anything in it
+    """
+    latest = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+                except OSError:
+                    pass
+    return latest
+
+
+def _entries(tmpdir):
+    """
+    The entries in the temporary store: the directories left by _cache_content, and the partial downloads.  Any
+    other files at the top of the store (e.g. a README) are not ours, and are left alone
+    """
+    for name in os.listdir(tmpdir):
+        path = os.path.join(tmpdir, name)
+        if name == "partial" and os.path.isdir(path):
+            for part in os.listdir(path):
+                if part.endswith(".part"):
+                    yield os.path.join(path, part)
+        elif os.path.isdir(path):
+            yield path
+
+
+def in_memory(f):
+    """
+    Is the file a SpooledTemporaryFile whose content is still held in memory, i.e. which has not rolled over to disk
+
+    :param f: file object
+    :return: True if it is
+    """
+    if not isinstance(f, tempfile.SpooledTemporaryFile):
+        return False
+    # until it rolls over, the file it wraps is an in-memory buffer
+    held = getattr(f, "_file", None)
+    if held is None:
+        return not getattr(f, "_rolled", True)
+    return isinstance(held, (io.BytesIO, io.StringIO))
+
+
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    A SpooledTemporaryFile in the temporary store, which waits for room in the store (see reserve()) before its
+    content rolls over from memory to disk
+    """
+
+    def __init__(self, max_size, expected=None, token=None):
+        """
+        :param max_size: number of bytes held in memory before rolling over to disk
+        :param expected: expected size of the content in bytes, if known
+        :param token: cancellation token for the pass, if any
+        """
+        super(SpooledFile, self).__init__(max_size=max_size, dir=app.config.get("STORE_TMP_DIR"))
+        self.expected = expected
+        self.token = token
+
+    def rollover(self):
+        if in_memory(self):
+            reserve(max(self.expected or 0, self.tell()), self.token)
+        super(SpooledFile, self).rollover()
+
+
+def sweep(max_age=None):
+    """
+    Remove entries from the temporary store which have not been modified for max_age seconds
+
+    :param max_age: age in seconds; by default TMP_STORE_MAX_AGE from configuration
+    :return: the number of entries removed
+    """
+    global _last_sweep
+    _last_sweep = time.monotonic()
+    tmpdir = app.config.get("STORE_TMP_DIR")
+    if tmpdir is None or not os.path.isdir(tmpdir):
+        return 0
+    if max_age is None:
+        max_age = app.config.get("TMP_STORE_MAX_AGE", 21600)
+
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in list(_entries(tmpdir)):
+        try:
+            if _entry_mtime(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+                # along with the validator kept for a partial download, if any
+                if os.path.exists(path + ".validator"):
+                    os.remove(path + ".validator")
+            removed += 1
+        except OSError as e:
+            # it may have been removed by its owner in the meantime
+            app.logger.debug("Unable to sweep {x} from the temp store: {y}".format(x=path, y=str(e)))
+
+    if removed > 0:
+        app.logger.info("Removed {x} orphaned entries from the temp store".format(x=removed))
+        metrics.incr("tmp_store_swept", removed)
+    usage(refresh=True)
+    return removed
+
+
+def maybe_sweep():
+    """
+    Sweep the temporary store if TMP_STORE_SWEEP_INTERVAL has passed since the last sweep
+    """
+    interval = app.config.get("TMP_STORE_SWEEP_INTERVAL", 3600)
+    if _last_sweep is None or time.monotonic() - _last_sweep >= interval:
+        sweep()
+
+
+def usage(refresh=False):
+    """
+    Total size of the files in the temporary store.
+
+    The size measured within the last TMP_STORE_USAGE_TTL seconds (plus anything reserved since) is used, unless
+    refresh is given
+
+    :param refresh: measure the store again regardless
+    :return: size in bytes
+    """
+    global _usage
+    tmpdir = app.config.get("STORE_TMP_DIR")
+    ttl = app.config.get("TMP_STORE_USAGE_TTL", 0)
+    now = time.monotonic()
+    if not refresh and ttl and _usage is not None and _usage[0] == tmpdir and now - _usage[2] < ttl:
+        return _usage[1]
+
+    total = 0
+    if tmpdir is not None and os.path.isdir(tmpdir):
+        for root, dirs, files in os.walk(tmpdir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+    _usage = (tmpdir, total, now)
+    return total
+
+
+def has_space(needed=0):
+    """
+    Is there room in the temporary store for a further download
+
+    :param needed: size of the download in bytes, if known
+    :return: True if the download fits within TMP_STORE_QUOTA and leaves TMP_STORE_MIN_FREE bytes free on the disk
+    """
+    tmpdir = app.config.get("STORE_TMP_DIR")
+    quota = app.config.get("TMP_STORE_QUOTA")
+    if quota and usage() + needed > quota:
+        return False
+    min_free = app.config.get("TMP_STORE_MIN_FREE")
+    if min_free and tmpdir is not None and os.path.isdir(tmpdir):
+        if shutil.disk_usage(tmpdir).free - needed < min_free:
+            return False
+    return True
+
+
+def reserve(needed=0, token=None):
+    """
+    Wait until there is room in the temporary store for a download.
+
+    Sweeps the store first, then backs off (up to TMP_STORE_WAIT seconds) for space to be freed by deposits in
+    other processes.  If there is still no room, the pass is cancelled
+
+    :param needed: size of the download in bytes, if known
+    :param token: cancellation token for the pass, if any
+    :raises Cancelled: if there is no room
+    """
+    if not has_space(needed):
+        _wait_for_space(needed, token)
+
+    # count the download against the store until it is next measured, so that reservations made in the meantime
+    # cannot all claim the same room
+    global _usage
+    if _usage is not None:
+        _usage = (_usage[0], _usage[1] + needed, _usage[2])
+
+
+def _wait_for_space(needed, token):
+    """
+    Sweep, then back off until there is room for a download, or cancel the pass if there is none within TMP_STORE_WAIT
+    """
+    metrics.incr("tmp_store_full")
+    sweep()
+    wait = app.config.get("TMP_STORE_WAIT", 300)
+    deadline = time.monotonic() + wait
+    delay = 5
+    while not has_space(needed):
+        if token is not None:
+            token.check()
+        if time.monotonic() >= deadline:
+            reason = "temp store full (usage {x} bytes)".format(x=usage())
+            app.logger.error("No room in the temp store after waiting {x}s - cancelling the pass".format(x=wait))
+            if token is not None:
+                token.cancel(reason)
+            raise Cancelled(reason)
+        app.logger.info("Temp store full - waiting {x}s for space".format(x=delay))
+        time.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(delay * 2, 60)
@@ -0,0 +1,172 @@
+"""
+Watchdog for stuck deposits.
+
+A background thread in the runner (and in each worker) looks every WATCHDOG_INTERVAL seconds at the stage each
+deposit in flight has reached (download, create, receipt, update, complete, or es; see metrics.in_flight and
+metrics.stage).  A deposit which has spent longer in its stage than the budget given for it in
+WATCHDOG_STAGE_BUDGETS is logged, with the stack of the thread running it, and counted in watchdog_stalls.
+
+If WATCHDOG_ABORT is set, the stuck deposit is then aborted: the code running a stage registers how to abort it with
+on_abort() (the HTTP layer shuts down the sockets of its request to the repository, and a content download stops at
+its next chunk), so that the deposit fails with Aborted, is recorded as failed, and is retried by a later pass, while
+the pass moves on to the next notification.  A stage with nothing registered (e.g. a request to the index) is only
+logged.
+"""
+import contextlib, sys, threading, time, traceback
+from octopus.core import app
+from service import metrics
+
+_lock = threading.Lock()
+_aborts = {}
+_reported = {}
+_thread = None
+_stop = threading.Event()
+
+
+class Aborted(Exception):
+    """
+    Raised in place of the error from a request which the watchdog aborted
+    """
+    pass
+
+
+@contextlib.contextmanager
+def on_abort(callback):
+    """
+    Register how to abort the work in the current thread, for the duration of the block.  The callback is called
+    from the watchdog's thread, and must make the work fail promptly (e.g. by shutting down its socket)
+
+    :param callback: function of no arguments
+    """
+    ident = threading.get_ident()
+    with _lock:
+        _aborts.setdefault(ident, []).append(callback)
+    try:
+        yield
+    finally:
+        with _lock:
+            callbacks = _aborts.get(ident, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if len(callbacks) == 0:
+                _aborts.pop(ident, None)
+
+
+def budget(stage):
+    """
+    The time allowed for a stage
+
+    :param stage: the stage, e.g. "create"
+    :return: seconds, or None for no limit
+    """
+    return (app.config.get("WATCHDOG_STAGE_BUDGETS") or {}).get(stage)
+
+
+def check(now=None):
+    """
+    Check each deposit in flight against the budget for its stage, and deal with any which have overrun it.  Each
+    overrun is dealt with once
+
+    :param now: the time to check against; by default the current time
+    :return: list of the thread idents of the deposits which were found to have overrun
+    """
+    now = now if now is not None else time.time()
+    work = metrics.work_in_flight()
+    stalled = []
+    frames = None
+    for ident, w in work.items():
+        limit = budget(w["stage"]) if w["stage"] is not None else None
+        elapsed = now - w["stage_started"]
+        if not limit or elapsed < limit:
+            continue
+        seen = (w["notification"], w["stage"], w["stage_started"])
+        if _reported.get(ident) == seen:
+            continue
+        _reported[ident] = seen
+        if frames is None:
+            frames = sys._current_frames()
+        _stalled(ident, w, elapsed, limit, frames.get(ident))
+        stalled.append(ident)
+
+    for ident in list(_reported.keys()):
+        if ident not in work:
+            del _reported[ident]
+    return stalled
+
+
+def _stalled(ident, work, elapsed, limit, frame):
+    context = {"account": work["account"], "notification": work["notification"], "stage": work["stage"]}
+    stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack available)\n"
+    metrics.incr("watchdog_stalls", stage=work["stage"])
+    app.logger.warning("Notification:{y} for Account:{x} has been in stage {z} for {s:.0f}s, over its budget of "
+                       "{b}s; stack:\n{t}".format(x=work["account"], y=work["notification"], z=work["stage"],
+                                                   s=elapsed, b=limit, t=stack.rstrip("\n")), extra=context)
+    if app.config.get("WATCHDOG_ABORT", True):
+        abort(ident, work)
+
+
+def abort(ident, work):
+    """
+    Abort the work in hand in a thread, with the callbacks it has registered with on_abort()
+
+    :param ident: the thread ident
+    :param work: the deposit in flight in the thread, as held by the metrics
+    :return: True if there was anything to abort, False if not
+    """
+    context = {"account": work["account"], "notification": work["notification"], "stage": work["stage"]}
+    with _lock:
+        callbacks = list(_aborts.get(ident, []))
+    if len(callbacks) == 0:
+        app.logger.warning("Notification:{y} for Account:{x} cannot be aborted in stage {z}".format(
+            x=work["account"], y=work["notification"], z=work["stage"]), extra=context)
+        return False
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            app.logger.error("Error aborting Notification:{y} for Account:{x}: {z}".format(
+                x=work["account"], y=work["notification"], z=str(e)), extra=context)
+    metrics.incr("watchdog_aborts", stage=work["stage"])
+    app.logger.warning("Aborted Notification:{y} for Account:{x} in stage {z}".format(
+        x=work["account"], y=work["notification"], z=work["stage"]), extra=context)
+    return True
+
+
+def _run():
+    while not _stop.wait(app.config.get("WATCHDOG_INTERVAL", 10)):
+        try:
+            check()
+        except Exception as e:
+            app.logger.error("Watchdog check failed: {x}".format(x=str(e)))
+
+
+def start():
+    """
+    Start the watchdog thread in this process, if WATCHDOG_ENABLE is set
+
+    :return: True if the watchdog is running
+    """
+    global _thread
+    if not app.config.get("WATCHDOG_ENABLE", True):
+        return False
+    if _thread is not None and _thread.is_alive():
+        return True
+    # a process forked from one with a watchdog has neither its thread nor its deposits in flight
+    _reported.clear()
+    with _lock:
+        _aborts.clear()
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="watchdog", daemon=True)
+    _thread.start()
+    return True
+
+
+def stop():
+    """
+    Stop the watchdog thread, if it is running
+    """
+    global _thread
+    _stop.set()
+    if _thread is not None and _thread is not threading.current_thread():
+        _thread.join(timeout=5)
+    _thread = None
@@ -2,6 +2,85 @@
 Module that handles the conversion of JPER json formatted notifications to XML suitable for delivery via SWORDv2
 """
 from octopus.modules.jper import models
+from octopus.core import app
+from service import metrics
+from collections import OrderedDict
+import sword2, threading
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class SerialisedEntry(object):
+    """
+    An entry which has already been crosswalked and serialised.  The sword client only needs str() of the
+    metadata entry it is given, so this stands in for the entry itself
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def __str__(self):
+        return self.xml
+
+
+def entry_for(note):
+    """
+    Crosswalk the notification into a serialised entry.
+
+    The crosswalk depends only on the notification, so the XML is kept in a least-recently-used cache of up to
+    XWALK_CACHE_SIZE entries, keyed by the notification's id and last_updated date, and reused for every
+    repository which receives the same version of the notification
+
+    :param note: the notification
+    :return: SerialisedEntry
+    """
+    size = app.config.get("XWALK_CACHE_SIZE", 0)
+    key = (note.id, note.data.get("last_updated"))
+    if size:
+        with _cache_lock:
+            xml = _cache.get(key)
+            if xml is not None:
+                _cache.move_to_end(key)
+        if xml is not None:
+            metrics.incr("xwalk_cache_hits")
+            return SerialisedEntry(xml)
+
+    entry = new_entry()
+    to_dc_rioxx(note, entry)
+    xml = str(entry)
+    metrics.incr("xwalk_cache_misses")
+
+    if size:
+        with _cache_lock:
+            _cache[key] = xml
+            _cache.move_to_end(key)
+            while len(_cache) > size:
+                _cache.popitem(last=False)
+    return SerialisedEntry(xml)
+
+
+def clear_cache():
+    """
+    Empty the cache of serialised entries
+    """
+    with _cache_lock:
+        _cache.clear()
+
+
+def new_entry():
+    """
+    Create an empty entry for to_dc_rioxx to populate, using the engine set by XWALK_ENGINE: "dom" for the sword
+    client's Entry, or "stream" for service.xwalk_stream.StreamingEntry, which serialises to the same XML without
+    building a document tree
+
+    :return: the entry
+    """
+    if app.config.get("XWALK_ENGINE", "dom") == "stream":
+        from service.xwalk_stream import StreamingEntry
+        return StreamingEntry()
+    return sword2.Entry()
+
 
 def to_dc_rioxx(note, entry):
     """
@@ -10,7 +89,7 @@ def to_dc_rioxx(note, entry):
     See the overview system documentation for details of the field-to-field mappings used
 
     :param note: the notification
-    :param entry: an EntryDocument to be populated
+    :param entry: an EntryDocument to be populated (see new_entry)
     :return:
     """
     # first register all the namespaces we're going to use
@@ -0,0 +1,171 @@
+"""
+Streaming alternative to the sword client's Entry, for use by xwalk.to_dc_rioxx.
+
+StreamingEntry supports the parts of the sword2.Entry interface which the crosswalk uses (register_namespace,
+add_field, add_author, add_contributor and str()), but serialises each element as it is added, rather than building
+an lxml tree.  The output reproduces, byte for byte, what lxml produces for a sword2.Entry: every element added
+carries the declarations of the entry's namespaces which are not already in scope on the root element, and text and
+attribute values are escaped in the same way.
+
+Select it with XWALK_ENGINE = "stream" (see xwalk.new_entry).
+"""
+import re
+from datetime import datetime
+from lxml import etree
+from sword2 import Entry
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+# the root element of a fresh Entry (with its generator), up to the point where the fields are appended
+_root = etree.tounicode(etree.fromstring(Entry.bootstrap))
+ROOT_OPEN = '<?xml version="1.0"?>' + _root[:-len("</entry>")]
+ROOT_CLOSE = "</entry>"
+
+# the namespaces declared on the root element
+ROOT_NS = {prefix: uri for prefix, uri in etree.fromstring(Entry.bootstrap).nsmap.items() if prefix is not None}
+
+# characters which lxml refuses in text and attribute values (XML 1.0 Char, plus the surrogates)
+_INVALID = re.compile("[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+_TEXT_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#13;"}
+_ATTR_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#9;"}
+_TEXT_RE = re.compile("[&<>\r]")
+_ATTR_RE = re.compile('[&<>"\r\n\t]')
+
+
+def _check(v):
+    if isinstance(v, bytes):
+        v = v.decode("utf-8")
+    if not isinstance(v, str):
+        raise TypeError("Argument must be bytes or unicode, got '{x}'".format(x=type(v).__name__))
+    if _INVALID.search(v) is not None:
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    return v
+
+
+def escape_text(v):
+    """
+    Escape an element's text as lxml does
+
+    :param v: the text
+    :return: the escaped text
+    """
+    v = _check(v)
+    return _TEXT_RE.sub(lambda m: _TEXT_ESCAPES[m.group(0)], v)
+
+
+def escape_attr(v):
+    """
+    Escape an attribute value as lxml does
+
+    :param v: the value
+    :return: the escaped value
+    """
+    v = _check(v)
+    return _ATTR_RE.sub(lambda m: _ATTR_ESCAPES[m.group(0)], v)
+
+
+class StreamingEntry(object):
+    """
+    Atom entry which is serialised as its fields are added
+    """
+    atom_fields = Entry.atom_fields
+
+    def __init__(self, updated=None):
+        """
+        :param updated: value for atom:updated; by default the current time, as for sword2.Entry
+        """
+        # the same namespace map as a fresh sword2.Entry, in the same order, as it determines the order in
+        # which the namespaces are declared
+        self.nsmap = {"dcterms": "http://purl.org/dc/terms/", "atom": ATOM_NS}
+        self._decls = None
+        self._parts = []
+        self._atom = {}
+        self.add_field("updated", updated if updated is not None else datetime.now().isoformat())
+
+    def register_namespace(self, prefix, uri):
+        """
+        Register a namespace, making it available for the fields added subsequently
+
+        :param prefix: namespace prefix
+        :param uri: namespace uri
+        """
+        if prefix not in self.nsmap:
+            self.nsmap[prefix] = uri
+            self._decls = None
+
+    def _declarations(self):
+        # the namespaces each new element declares: those in the map which are not in scope from the root
+        if self._decls is None:
+            self._decls = "".join(' xmlns:{p}="{u}"'.format(p=p, u=escape_attr(u))
+                                  for p, u in self.nsmap.items() if ROOT_NS.get(p) != u)
+        return self._decls
+
+    def _open(self, prefix, tag, attrs=None, decls=True):
+        parts = ["<", prefix, ":", tag]
+        if decls:
+            parts.append(self._declarations())
+        if attrs:
+            for an, av in attrs.items():
+                parts += [" ", an, '="', escape_attr(av), '"']
+        return "".join(parts)
+
+    @staticmethod
+    def _close(opening, prefix, tag, v):
+        if v is None:
+            return opening + "/>"
+        return "".join([opening, ">", escape_text(v), "</", prefix, ":", tag, ">"])
+
+    def add_field(self, k, v, attrs=None):
+        """
+        Add a single field, as sword2.Entry.add_field
+
+        :param k: field name, as namespace prefix and element name separated by an underscore, or one of the atom
+            fields (title, id, updated, summary), of which there may be only one of each
+        :param v: the field's text
+        :param attrs: dict of attributes for the element, if any
+        """
+        if k in self.atom_fields:
+            if k in self._atom:
+                # these are unique, so the existing element keeps its place (and declarations), with the new text
+                index, opening = self._atom[k]
+                self._parts[index] = self._close(opening, "atom", k, v)
+            else:
+                opening = self._open("atom", k)
+                self._atom[k] = (len(self._parts), opening)
+                self._parts.append(self._close(opening, "atom", k, v))
+        elif "_" in k:
+            nmsp, tag = k.split("_", 1)
+            if nmsp in self.nsmap:
+                self._parts.append(self._close(self._open(nmsp, tag, attrs), nmsp, tag, v))
+
+    def add_author(self, name, uri=None, email=None):
+        """
+        Add an atom:author, as sword2.Entry.add_author
+        """
+        self._person("author", name, uri, email)
+
+    def add_contributor(self, name, uri=None, email=None):
+        """
+        Add an atom:contributor, as sword2.Entry.add_contributor
+        """
+        self._person("contributor", name, uri, email)
+
+    def _person(self, tag, name, uri, email):
+        parts = [self._open("atom", tag), ">", self._close("<atom:name", "atom", "name", name)]
+        if uri:
+            parts.append(self._close("<atom:uri", "atom", "uri", uri))
+        if email:
+            parts.append(self._close("<atom:email", "atom", "email", email))
+        parts += ["</atom:", tag, ">"]
+        self._parts.append("".join(parts))
+
+    def __str__(self):
+        return "".join([ROOT_OPEN] + self._parts + [ROOT_CLOSE])
+
+    def to_bytes(self):
+        """
+        The serialised entry, as UTF-8
+
+        :return: bytes
+        """
+        return str(self).encode("utf-8")